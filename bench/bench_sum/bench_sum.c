@@ -0,0 +1,27 @@
+#include <zephyr/kernel.h>
+#include "native_sim_bench.h"
+#include "sum.h"
+
+// sum() itself, including the printk it does on every call
+void bench_sum(uint32_t iterations) {
+    for (uint32_t i = 0; i < iterations; i++) {
+        BENCH_KEEP(sum((int)i, 1));
+    }
+}
+
+// The same printk alone, to tell the addition apart from the logging
+void bench_sum_printk_only(uint32_t iterations) {
+    for (uint32_t i = 0; i < iterations; i++) {
+        printk("Sum %d+%d = %d\n", (int)i, 1, (int)i + 1);
+    }
+}
+
+int main(void)
+{
+    printk("Starting sum benchmarks...\n");
+
+    RUN_BENCH(bench_sum);
+    RUN_BENCH(bench_sum_printk_only);
+
+    BENCH_END();
+}
@@ -0,0 +1,132 @@
+#ifndef NATIVE_SIM_BENCH_H
+#define NATIVE_SIM_BENCH_H
+
+/*
+ * Minimal benchmark harness for the bench/bench_* suites.
+ *
+ * A benchmark is a function running its code `iterations` times:
+ *
+ *     void bench_sum(uint32_t iterations)
+ *     {
+ *         for (uint32_t i = 0; i < iterations; i++) {
+ *             BENCH_KEEP(sum(i, 1));
+ *         }
+ *     }
+ *
+ * RUN_BENCH(bench_sum) from main() first doubles the iteration count
+ * until one sample takes BENCH_SAMPLE_NS, then times BENCH_SAMPLES samples
+ * and prints one line of JSON statistics per benchmark:
+ *
+ *     BENCH {"name":"bench_sum","iterations":4096,"samples":31,"min_ns":12.345,...}
+ *
+ * which scripts/upload_native_sim_bench.py collects. Times are per
+ * iteration. End main() with BENCH_END().
+ *
+ * On hardware samples are timed with the kernel cycle counter. native_sim's
+ * cycle counter follows simulated time, which stands still while code
+ * runs, so there the host's monotonic clock is read instead (see
+ * native_sim_bench_host.c).
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <zephyr/kernel.h>
+
+#ifndef BENCH_SAMPLES
+#define BENCH_SAMPLES 31
+#endif
+
+#ifndef BENCH_SAMPLE_NS
+#define BENCH_SAMPLE_NS 2000000u
+#endif
+
+#define BENCH_MAX_ITERATIONS (1u << 24)
+
+/* Keeps a result alive so the compiler cannot drop the measured code */
+static volatile uint32_t bench_sink;
+#define BENCH_KEEP(value) (bench_sink = (uint32_t)(value))
+
+typedef void (*bench_func_t)(uint32_t iterations);
+
+#ifdef CONFIG_ARCH_POSIX
+uint64_t bench_host_time_ns(void);
+
+static inline uint64_t bench_now(void)
+{
+    return bench_host_time_ns();
+}
+
+static inline uint64_t bench_elapsed_ns(uint64_t start, uint64_t end)
+{
+    return end - start;
+}
+#else
+static inline uint64_t bench_now(void)
+{
+    return k_cycle_get_32();
+}
+
+static inline uint64_t bench_elapsed_ns(uint64_t start, uint64_t end)
+{
+    return k_cyc_to_ns_floor64((uint32_t)((uint32_t)end - (uint32_t)start));
+}
+#endif
+
+static inline uint64_t bench_sample_ns(bench_func_t func, uint32_t iterations)
+{
+    uint64_t start = bench_now();
+
+    func(iterations);
+    return bench_elapsed_ns(start, bench_now());
+}
+
+/* Picoseconds printed as nanoseconds with three decimals */
+static inline void bench_print_ns(const char *key, uint64_t ps)
+{
+    printk(",\"%s\":%u.%03u", key, (uint32_t)(ps / 1000u), (uint32_t)(ps % 1000u));
+}
+
+static inline void bench_run(const char *name, bench_func_t func)
+{
+    uint64_t samples[BENCH_SAMPLES];
+    uint32_t iterations = 1;
+
+    /* Warm up and calibrate */
+    while (bench_sample_ns(func, iterations) < BENCH_SAMPLE_NS &&
+           iterations < BENCH_MAX_ITERATIONS) {
+        iterations *= 2;
+    }
+
+    for (int i = 0; i < BENCH_SAMPLES; i++) {
+        uint64_t ps = bench_sample_ns(func, iterations) * 1000u / iterations;
+        int j = i;
+
+        /* Insertion sort, samples stay ordered */
+        while (j > 0 && samples[j - 1] > ps) {
+            samples[j] = samples[j - 1];
+            j--;
+        }
+        samples[j] = ps;
+    }
+
+    uint64_t median = samples[BENCH_SAMPLES / 2];
+    uint64_t p95 = samples[(BENCH_SAMPLES * 95 + 99) / 100 - 1];
+
+    printk("\nBENCH {\"name\":\"%s\",\"iterations\":%u,\"samples\":%u", name, iterations,
+           BENCH_SAMPLES);
+    bench_print_ns("min_ns", samples[0]);
+    bench_print_ns("median_ns", median);
+    bench_print_ns("p95_ns", p95);
+    printk(",\"ops_per_sec\":%u}\n",
+           median ? (uint32_t)MIN(1000000000000ull / median, UINT32_MAX) : UINT32_MAX);
+}
+
+#define RUN_BENCH(func) bench_run(#func, func)
+
+#define BENCH_END()                  \
+    do {                             \
+        printk("\nBENCH_DONE\n");    \
+        exit(0);                     \
+    } while (0)
+
+#endif /* NATIVE_SIM_BENCH_H */
@@ -0,0 +1,17 @@
+/*
+ * Host clock for the benchmark harness on native_sim.
+ *
+ * Built in the native simulator runner context (against the host C
+ * library), not into the Zephyr image, so it can call clock_gettime().
+ */
+
+#include <stdint.h>
+#include <time.h>
+
+uint64_t bench_host_time_ns(void)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t)now.tv_sec * 1000000000u + (uint64_t)now.tv_nsec;
+}
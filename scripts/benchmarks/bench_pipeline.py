@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the native_sim build and test pipeline, without Zephyr.
+
+    python3 scripts/benchmarks/bench_pipeline.py                  # run, compare to baseline.json
+    python3 scripts/benchmarks/bench_pipeline.py --save-baseline  # record a new baseline
+
+A synthetic project (libraries and test suites) is built by the real build
+and upload scripts against a west workspace whose `west` is fake_west.py,
+so configure, compile and link have fixed simulated costs and any change
+in the timings comes from the scripts. Measured: cold build, no-op build,
+one-file-change build, artifact cache hit, 2000 artifact publishes, test
+runs with and without the result cache and a one-file-change rebuild
+through a build daemon that already built the project, which fails unless
+the daemon really did both builds. Results are written as JSON and
+compared with the stored baseline; a benchmark whose best run is slower
+by more than --threshold (and --min-delta seconds) is a regression: the
+fastest of several runs is the least disturbed by other load.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCH_DIR)
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, '.pio', 'native_sim_bench.json')
+BENCH_VERSION = 1
+
+BENCHMARKS = ('cold_build', 'noop_build', 'one_file_build', 'cached_build', 'publish',
+              'test_run', 'cached_test_run', 'daemon_build')
+
+# Simulated west costs, in seconds, passed to fake_west.py
+FAKE_WEST_COSTS = {
+    'FAKE_WEST_CONFIGURE': '0.5',
+    'FAKE_WEST_KERNEL_OBJECTS': '40',
+    'FAKE_WEST_COMPILE': '0.02',
+    'FAKE_WEST_LINK': '0.1',
+    'FAKE_WEST_TEST_TIME': '0.005',
+}
+
+LIB_TEMPLATE = """#include "{name}.h"
+
+int {name}_value(int x)
+{{
+    return x + {index};
+}}
+"""
+
+TEST_TEMPLATE = """#include <unity.h>
+{includes}
+
+void setUp(void) {{}}
+void tearDown(void) {{}}
+
+{functions}
+
+int main(void)
+{{
+    UNITY_BEGIN();
+{runs}
+    return UNITY_END();
+}}
+"""
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_workspace(root):
+    """Create a west workspace whose west is fake_west.py"""
+    workspace = os.path.join(root, 'zephyrproject')
+    west_path = os.path.join(workspace, '.venv', 'bin', 'west')
+    os.makedirs(os.path.dirname(west_path))
+    os.makedirs(os.path.join(workspace, 'zephyr'))
+    shutil.copy(os.path.join(BENCH_DIR, 'fake_west.py'), west_path)
+    os.chmod(west_path, 0o755)
+    return workspace
+
+
+def make_project(root, suites, libs, tests):
+    """
+    Create a project with `libs` libraries under lib/ and `suites` test
+    suites of `tests` tests each, every suite using every library
+    """
+    project_dir = os.path.join(root, 'project')
+    _write(os.path.join(project_dir, 'platformio.ini'),
+           '[env:native_sim_test]\nplatform = native\n')
+    os.symlink(SCRIPTS_DIR, os.path.join(project_dir, 'scripts'))
+    for index in range(libs):
+        name = f'lib_{index}'
+        _write(os.path.join(project_dir, 'lib', name, f'{name}.c'),
+               LIB_TEMPLATE.format(name=name, index=index))
+        _write(os.path.join(project_dir, 'lib', name, f'{name}.h'),
+               f'int {name}_value(int x);\n')
+    os.makedirs(os.path.join(project_dir, 'test', 'include_shims'))
+    for suite in range(suites):
+        functions = [f'test_{suite}_{test}' for test in range(tests)]
+        _write(os.path.join(project_dir, 'test', f'test_suite_{suite}', f'test_suite_{suite}.c'),
+               TEST_TEMPLATE.format(
+                   includes='\n'.join(f'#include "lib_{index}.h"' for index in range(libs)),
+                   functions='\n\n'.join(
+                       f'void {function}(void)\n{{\n    TEST_ASSERT_EQUAL(1, lib_0_value(1));\n}}'
+                       for function in functions),
+                   runs='\n'.join(f'    RUN_TEST({function});' for function in functions)))
+    _write(os.path.join(project_dir, 'src', 'main.c'), 'int main(void)\n{\n    return 0;\n}\n')
+    _write(os.path.join(project_dir, 'zephyr', 'CMakeLists.txt'),
+           'cmake_minimum_required(VERSION 3.13.1)\n'
+           'find_package(Zephyr REQUIRED HINTS $ENV{ZEPHYR_BASE})\n'
+           'project(bench)\n')
+    _write(os.path.join(project_dir, 'zephyr', 'prj.conf'), 'CONFIG_PRINTK=y\n')
+    unity_src = os.path.join(project_dir, '.pio', 'libdeps', 'native_sim_test', 'Unity', 'src')
+    _write(os.path.join(unity_src, 'unity.c'), '#include "unity.h"\n')
+    _write(os.path.join(unity_src, 'unity.h'), '#define UNITY_BEGIN()\n')
+    return project_dir
+
+
+class Pipeline:
+    """Runs the build and upload scripts for the synthetic project"""
+
+    def __init__(self, root, project_dir, workspace, jobs):
+        self.root = root
+        self.project_dir = project_dir
+        self.build_dir = os.path.join(project_dir, '.pio', 'build', 'native_sim_test')
+        self.log_path = os.path.join(root, 'bench.log')
+        self.env = {key: value for key, value in os.environ.items()
+                    if not key.startswith(('NATIVE_SIM_', 'PIOTEST', 'FAKE_WEST_'))
+                    and key != 'ZEPHYR_BASE'}
+        self.env.update(FAKE_WEST_COSTS, HOME=os.path.join(root, 'home'),
+                        PROJECT_DIR=project_dir, BUILD_DIR=self.build_dir,
+                        NATIVE_SIM_ZEPHYR_WORKSPACE=workspace, NATIVE_SIM_DAEMON='no',
+                        NATIVE_SIM_SUITES='all', NATIVE_SIM_JOBS=str(jobs),
+                        NATIVE_SIM_CACHE='no', NATIVE_SIM_CCACHE='no',
+                        NATIVE_SIM_TEST_CACHE='no', NATIVE_SIM_TRACE='no',
+                        NATIVE_SIM_CACHE_DIR=os.path.join(root, 'artifacts'),
+                        NATIVE_SIM_TEST_CACHE_DIR=os.path.join(root, 'results'))
+
+    def run(self, script, **options):
+        """Run one script with NATIVE_SIM_<NAME> options, return its wall time"""
+        env = dict(self.env, **{f'NATIVE_SIM_{name.upper()}': value
+                                for name, value in options.items()})
+        with open(self.log_path, 'a') as log:
+            log.write(f'\n### {script} {options}\n')
+            log.flush()
+            start = time.perf_counter()
+            returncode = subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, script)],
+                                        cwd=self.project_dir, env=env, stdout=log,
+                                        stderr=subprocess.STDOUT).returncode
+            elapsed = time.perf_counter() - start
+        if returncode != 0:
+            raise RuntimeError(f'{script} exited with {returncode}, see {self.log_path}')
+        return elapsed
+
+    def build(self, **options):
+        return self.run('build_native_sim_test.py', **options)
+
+    def test(self, **options):
+        return self.run('upload_native_sim_test.py', **options)
+
+    def clean(self):
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+
+def bench_cold_build(pipeline):
+    pipeline.clean()
+    return pipeline.build()
+
+
+def bench_noop_build(pipeline):
+    return pipeline.build()
+
+
+def bench_one_file_build(pipeline):
+    path = os.path.join(pipeline.project_dir, 'lib', 'lib_0', 'lib_0.c')
+    with open(path, 'a') as f:
+        f.write(f'/* edit {time.time_ns()} */\n')
+    return pipeline.build()
+
+
+def bench_cached_build(pipeline):
+    # Every input is in the artifact cache after the first round
+    pipeline.build(cache='yes')
+    pipeline.clean()
+    return pipeline.build(cache='yes')
+
+
+def bench_publish(pipeline, iterations=2000):
+    """Time to publish an executable `iterations` times under its two PlatformIO names"""
+    sys.path.insert(0, SCRIPTS_DIR)
+    from native_sim_common import publish_artifact
+
+    publish_dir = os.path.join(pipeline.root, 'publish')
+    os.makedirs(publish_dir, exist_ok=True)
+    source_path = os.path.join(publish_dir, 'zephyr.exe')
+    with open(source_path, 'wb') as f:
+        f.write(os.urandom(4 << 20))
+    dest_paths = [os.path.join(publish_dir, 'test_runner.exe'),
+                  os.path.join(publish_dir, 'firmware.bin')]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        publish_artifact(source_path, dest_paths)
+    return time.perf_counter() - start
+
+
+def bench_daemon_build(pipeline):
+    """
+    One-file-change build of every suite served by a running native_sim
+    daemon that has already built the project once
+    """
+    env = dict(pipeline.env, NATIVE_SIM_DAEMON='auto')
+    daemon_script = os.path.join(SCRIPTS_DIR, 'native_sim_daemon.py')
+    with open(pipeline.log_path, 'a') as log:
+        daemon = subprocess.Popen([sys.executable, daemon_script, '--project-dir',
+                                   pipeline.project_dir, '--idle-timeout', '0'],
+                                  env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        for _ in range(100):
+            status = subprocess.run([sys.executable, daemon_script, '--status', '--project-dir',
+                                     pipeline.project_dir], env=env, capture_output=True)
+            if status.returncode == 0:
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError(f'native_sim daemon did not start, see {pipeline.log_path}')
+        # Earlier benchmarks may have cleaned the build: let the daemon
+        # build everything once, then time the rebuild after one edit
+        log_start = os.path.getsize(pipeline.log_path)
+        pipeline.build(daemon='auto')
+        path = os.path.join(pipeline.project_dir, 'lib', 'lib_0', 'lib_0.c')
+        with open(path, 'a') as f:
+            f.write(f'/* edit {time.time_ns()} */\n')
+        elapsed = pipeline.build(daemon='auto')
+        with open(pipeline.log_path) as log:
+            log.seek(log_start)
+            output = log.read()
+        if output.count('Building through the native_sim daemon') != 2 or \
+                'building directly' in output:
+            raise RuntimeError(f'suites build did not go through the daemon, '
+                               f'see {pipeline.log_path}')
+        return elapsed
+    finally:
+        subprocess.run([sys.executable, daemon_script, '--stop', '--project-dir',
+                        pipeline.project_dir], env=env, capture_output=True)
+        daemon.wait(timeout=30)
+
+
+def bench_test_run(pipeline):
+    return pipeline.test()
+
+
+def bench_cached_test_run(pipeline):
+    pipeline.test(test_cache='yes')
+    return pipeline.test(test_cache='yes')
+
+
+def run_benchmarks(names, repeat, suites, libs, tests, jobs, keep=False):
+    """Run the named benchmarks `repeat` times each, return the results dict"""
+    root = tempfile.mkdtemp(prefix='native_sim_bench_')
+    try:
+        workspace = make_workspace(root)
+        project_dir = make_project(root, suites, libs, tests)
+        pipeline = Pipeline(root, project_dir, workspace, jobs)
+        # Test runs and no-op builds need a build to start from
+        pipeline.build()
+
+        results = {}
+        for name in names:
+            runs = [globals()[f'bench_{name}'](pipeline) for _ in range(repeat)]
+            results[name] = {'median': statistics.median(runs), 'min': min(runs),
+                             'max': max(runs), 'runs': runs}
+            print(f"⏱️  {name:<16} {results[name]['median']:8.3f}s "
+                  f"(min {results[name]['min']:.3f}s, max {results[name]['max']:.3f}s)")
+        return results
+    finally:
+        if keep:
+            print(f"📁 Kept benchmark tree: {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def compare(results, baseline, threshold, min_delta):
+    """
+    Print the results against a baseline and return the names of the
+    benchmarks that regressed
+    """
+    regressions = []
+    print(f"📊 {'benchmark':<16} {'baseline':>9} {'current':>9} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f"   {name:<16} {'-':>9} {result['min']:8.3f}s {'new':>8}")
+            continue
+        delta = result['min'] - base['min']
+        change = delta / base['min'] if base['min'] else 0.0
+        status = ''
+        if delta > min_delta and change > threshold:
+            status = '  ❌ regression'
+            regressions.append(name)
+        elif -delta > min_delta and -change > threshold:
+            status = '  🚀 faster'
+        print(f"   {name:<16} {base['min']:8.3f}s {result['min']:8.3f}s "
+              f"{change:+7.1%}{status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark')
+    parser.add_argument('--suites', type=int, default=4, help='test suites in the project')
+    parser.add_argument('--libs', type=int, default=8, help='libraries in the project')
+    parser.add_argument('--tests', type=int, default=20, help='tests per suite')
+    parser.add_argument('--jobs', type=int, default=2, help='parallel suite builds and runs')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON results file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to the baseline file instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--min-delta', type=float, default=0.05,
+                        help='seconds a slowdown must exceed to be a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary project')
+    options = parser.parse_args()
+    unknown = [name for name in options.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    params = {'suites': options.suites, 'libs': options.libs, 'tests': options.tests,
+              'jobs': options.jobs, 'fake_west': FAKE_WEST_COSTS}
+    print(f"🏁 native_sim pipeline benchmarks: {options.suites} suites, {options.libs} libs, "
+          f"{options.tests} tests per suite, {options.jobs} jobs, {options.repeat} runs each")
+    results = run_benchmarks(options.benchmarks or BENCHMARKS, options.repeat, options.suites,
+                             options.libs, options.tests, options.jobs, options.keep)
+    report = {'version': BENCH_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'repeat': options.repeat,
+              'host': {'python': platform.python_version(), 'system': platform.platform(),
+                       'cpus': os.cpu_count()},
+              'params': params, 'results': results}
+
+    paths = [options.baseline] if options.save_baseline else [options.output]
+    for path in paths:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"📄 Results: {path}")
+    if options.save_baseline:
+        return 0
+
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        print(f"⚠️  No baseline at {options.baseline}, record one with --save-baseline")
+        return 0
+    if baseline.get('params') != params:
+        print("⚠️  Baseline was recorded with other parameters, timings may not compare")
+    regressions = compare(results, baseline, options.threshold, options.min_delta)
+    if regressions:
+        print(f"❌ {len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        return 1
+    print("✅ No regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
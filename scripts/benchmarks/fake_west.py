@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Stand-in for `west build` used by the pipeline benchmarks.
+
+Understands the one command the native_sim scripts run:
+
+    west build -b native_sim -d <build dir> --pristine <auto|always|never> <app dir> [-- ...]
+
+and behaves like a Zephyr build from the scripts' point of view, with
+simulated costs instead of a toolchain:
+
+- configure (first build, --pristine always, or a changed CMakeLists.txt /
+  prj.conf) sleeps FAKE_WEST_CONFIGURE seconds and queues the kernel's
+  FAKE_WEST_KERNEL_OBJECTS objects,
+- every project source that is new or changed since the last build, and
+  every queued kernel object, "compiles" for FAKE_WEST_COMPILE seconds,
+  printed as ninja [n/m] lines and recorded in .ninja_log,
+- anything compiled relinks zephyr/zephyr.exe for FAKE_WEST_LINK seconds.
+
+The sources are the quoted absolute paths in the app's CMakeLists.txt
+(generated test projects) or, for the application, src/ and lib/ next to
+the app dir. zephyr.exe is a script printing Unity output for every
+test_* function those sources define, FAKE_WEST_TEST_TIME seconds apart.
+"""
+
+import json
+import os
+import re
+import stat
+import sys
+import time
+
+CONFIGURE = float(os.environ.get('FAKE_WEST_CONFIGURE', 0.5))
+KERNEL_OBJECTS = int(os.environ.get('FAKE_WEST_KERNEL_OBJECTS', 40))
+COMPILE = float(os.environ.get('FAKE_WEST_COMPILE', 0.02))
+LINK = float(os.environ.get('FAKE_WEST_LINK', 0.1))
+TEST_TIME = float(os.environ.get('FAKE_WEST_TEST_TIME', 0.005))
+
+STATE_FILE = '.fake_west.json'
+SOURCE_PATH_RE = re.compile(r'"(/[^"]+\.(?:c|cc|cpp|S))"')
+TEST_FUNCTION_RE = re.compile(r'^\s*void\s+(test_\w+)\s*\(\s*(?:void)?\s*\)', re.MULTILINE)
+
+EXE_TEMPLATE = """#!/usr/bin/env python3
+import time
+for file, line, test in {tests!r}:
+    time.sleep({test_time!r})
+    print(f'{{file}}:{{line}}:{{test}}:PASS', flush=True)
+print('')
+print('-----------------------')
+print('{count} Tests 0 Failures 0 Ignored')
+print('OK')
+"""
+
+
+def _sources(app_dir):
+    with open(os.path.join(app_dir, 'CMakeLists.txt')) as f:
+        sources = SOURCE_PATH_RE.findall(f.read())
+    if sources:
+        return sources
+    project_dir = os.path.dirname(os.path.abspath(app_dir))
+    for folder in ('src', 'lib'):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(project_dir, folder)):
+            dirnames.sort()
+            sources.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                           if filename.endswith(('.c', '.cc', '.cpp')))
+    return sources
+
+
+def _stamp(path):
+    stat_result = os.stat(path)
+    return [stat_result.st_mtime_ns, stat_result.st_size]
+
+
+def _tests(sources):
+    tests = []
+    for path in sources:
+        with open(path, errors='replace') as f:
+            content = f.read()
+        tests.extend((path, content.count('\n', 0, match.start(1)) + 1, match.group(1))
+                     for match in TEST_FUNCTION_RE.finditer(content))
+    return tests
+
+
+def build(build_dir, pristine, app_dir):
+    state_path = os.path.join(build_dir, STATE_FILE)
+    state = {}
+    if pristine != 'always':
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pass
+    elif os.path.isdir(build_dir):
+        for name in (STATE_FILE, '.ninja_log', 'CMakeCache.txt'):
+            if os.path.exists(os.path.join(build_dir, name)):
+                os.remove(os.path.join(build_dir, name))
+    os.makedirs(os.path.join(build_dir, 'zephyr'), exist_ok=True)
+
+    config = {name: _stamp(os.path.join(app_dir, name))
+              for name in ('CMakeLists.txt', 'prj.conf')
+              if os.path.exists(os.path.join(app_dir, name))}
+    edges = []
+    if state.get('config') != config:
+        print('-- Zephyr version: 0.0.0 (fake west)')
+        time.sleep(CONFIGURE)
+        print('-- Configuring done')
+        print('-- Generating done')
+        with open(os.path.join(build_dir, 'CMakeCache.txt'), 'w') as f:
+            f.write('CMAKE_PROJECT_NAME:STATIC=fake_west\n')
+        if not state:
+            edges.extend(f'zephyr/kernel/kernel_{index}.c.obj' for index in range(KERNEL_OBJECTS))
+        state['config'] = config
+
+    sources = _sources(app_dir)
+    objects = state.get('objects', {})
+    for path in sources:
+        if objects.get(path) != _stamp(path):
+            objects[path] = _stamp(path)
+            edges.append(f'CMakeFiles/app.dir{path}.obj')
+    for path in set(objects) - set(sources):
+        del objects[path]
+    state['objects'] = objects
+
+    exe_path = os.path.join(build_dir, 'zephyr', 'zephyr.exe')
+    if not edges and os.path.exists(exe_path):
+        print('ninja: no work to do.')
+    else:
+        total = len(edges) + 1
+        log_path = os.path.join(build_dir, '.ninja_log')
+        with open(log_path, 'a') as log:
+            if log.tell() == 0:
+                log.write('# ninja log v5\n')
+            start = time.monotonic()
+            for index, edge in enumerate(edges, 1):
+                print(f'[{index}/{total}] Building C object {edge}', flush=True)
+                begin = int((time.monotonic() - start) * 1000)
+                time.sleep(COMPILE)
+                log.write(f'{begin}\t{int((time.monotonic() - start) * 1000)}\t0\t{edge}\t0\n')
+            print(f'[{total}/{total}] Linking C executable zephyr/zephyr.exe', flush=True)
+            begin = int((time.monotonic() - start) * 1000)
+            time.sleep(LINK)
+            log.write(f'{begin}\t{int((time.monotonic() - start) * 1000)}\t0\t'
+                      f'zephyr/zephyr.exe\t0\n')
+        tests = _tests(sources)
+        # The linker replaces the executable, it never writes into it
+        temp_path = f'{exe_path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(EXE_TEMPLATE.format(tests=tests, test_time=TEST_TIME, count=len(tests)))
+        os.chmod(temp_path, os.stat(temp_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        os.replace(temp_path, exe_path)
+
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    return 0
+
+
+def main(argv):
+    args = argv[:argv.index('--')] if '--' in argv else argv
+    if not args or args[0] != 'build':
+        print(f"fake west: unsupported command: {' '.join(argv)}", file=sys.stderr)
+        return 2
+    build_dir = args[args.index('-d') + 1]
+    pristine = args[args.index('--pristine') + 1] if '--pristine' in args else 'auto'
+    return build(build_dir, pristine, args[-1])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
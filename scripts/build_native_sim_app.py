@@ -4,20 +4,36 @@ Simple build script for Zephyr native_sim regular application
 """
 
 import os
-import subprocess
-import shutil
 import sys
 
 # Get environment variables
 PROJECT_DIR = os.environ.get('PROJECT_DIR', os.getcwd())
 BUILD_DIR = os.environ.get('BUILD_DIR', os.path.join(PROJECT_DIR, '.pio', 'build', 'native_sim'))
-ZEPHYR_BASE = os.path.expanduser('~/zephyrproject')
+
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'scripts'))
+from native_sim_common import (acquire_lock, build_app, load_build_options, publish_artifact,
+                               get_option, profile_option, release_lock,
+                               zephyr_workspace_dir)
+from native_sim_daemon import daemon_build
+from native_sim_output import print_build_failure, print_progress
+from native_sim_trace import span, start_trace
 
 # Check if we're being called from SCons
 using_scons = len(sys.argv) > 1 and 'scons' in str(sys.argv)
 if using_scons:
     Import("env")
 
+# Debug builds get their own west build dir so they never clobber release state
+is_debug_build = (
+    (using_scons and 'debug' in env.GetBuildType()) or
+    os.environ.get('DEBUG') == '1'
+)
+variant = 'debug' if is_debug_build else 'release'
+ZEPHYR_BASE = zephyr_workspace_dir(env if using_scons else None, PROJECT_DIR,
+                                   os.path.basename(BUILD_DIR))
+start_trace(get_option('trace', '', env if using_scons else None, PROJECT_DIR,
+                       os.path.basename(BUILD_DIR)), BUILD_DIR, 'build app')
+
 print("🚀 Building Zephyr native_sim application")
 print(f"📁 Project dir: {PROJECT_DIR}")
 print(f"🔨 Build dir: {BUILD_DIR}")
@@ -37,76 +53,68 @@ if not os.path.exists(zephyr_dir):
 
 print("🔧 Building regular application...")
 
-# Run west build for regular application
-print("⚡ Running: west build -b native_sim --pristine always")
-
-# Prepare build command with virtual environment activation
-full_command = (f". {ZEPHYR_BASE}/.venv/bin/activate && "
-               f"cd {ZEPHYR_BASE} && "
-               f"west build -b native_sim --pristine always {zephyr_dir}")
+# Each env/variant builds in its own locked west build dir; the artifact
+# cache and input fingerprints let west skip or shorten the build
+build_options = load_build_options(env if using_scons else None, PROJECT_DIR,
+                                   os.path.basename(BUILD_DIR))
+build_options.update(variant=variant, debug=is_debug_build)
 
+# Profile builds: optimized code with symbols and frame pointers, and -pg
+# for gprof, in their own west build dir (see native_sim_profile.py)
 try:
-    result = subprocess.run(full_command, shell=True, capture_output=True, text=True, timeout=120)
-    
-    if result.returncode == 0:
-        print("✅ Zephyr native_sim build successful!")
+    profile_spec = profile_option(env if using_scons else None, PROJECT_DIR,
+                                  os.path.basename(BUILD_DIR))
+except ValueError as e:
+    print(f"❌ Error: {e}")
+    if using_scons:
+        env.Exit(1)
     else:
-        print("❌ Zephyr build failed!")
-        print("STDOUT:", result.stdout)
-        print("STDERR:", result.stderr)
-        if using_scons:
-            env.Exit(1)
-        else:
-            exit(1)
-except subprocess.TimeoutExpired:
-    print("❌ Build timed out after 120 seconds")
+        exit(1)
+if profile_spec:
+    build_options.update(variant=profile_spec['name'], debug=False, variant_spec=profile_spec)
+
+result = daemon_build(PROJECT_DIR, 'app', env if using_scons else None, os.path.basename(BUILD_DIR),
+                      progress=print_progress, build_dir=BUILD_DIR,
+                      zephyr_workspace=ZEPHYR_BASE, **build_options)
+if result is None:
+    result = build_app(PROJECT_DIR, BUILD_DIR, ZEPHYR_BASE, progress=print_progress,
+                       **build_options)
+
+if result['cached']:
+    print("♻️  Reusing cached application build, west skipped")
+elif result['ok']:
+    print("✅ Zephyr native_sim build successful!")
+else:
+    # The error names the configured build_timeout when the build ran out of time
+    print("⏰ Zephyr build timed out!" if result['error'].startswith('build timed out')
+          else "❌ Zephyr build failed!")
+    print_build_failure(result)
     if using_scons:
         env.Exit(1)
     else:
         exit(1)
 
-# Copy the built executable to PlatformIO expected locations
-zephyr_exe_path = os.path.join(ZEPHYR_BASE, 'build', 'zephyr', 'zephyr.exe')
+# Publish the built executable to PlatformIO expected locations
+zephyr_exe_path = result['exe'] or ''
 firmware_path = os.path.join(BUILD_DIR, 'firmware.bin')
+publish_lock = acquire_lock(BUILD_DIR)
 
 if os.path.exists(zephyr_exe_path):
     print(f"🎯 Application executable: {zephyr_exe_path}")
     
-    # Copy with robust error handling
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            # Remove existing file first if it exists
-            if os.path.exists(firmware_path):
-                try:
-                    os.remove(firmware_path)
-                except OSError:
-                    # If we can't remove it, try atomic replacement
-                    temp_path = firmware_path + '.tmp'
-                    shutil.copy(zephyr_exe_path, temp_path)
-                    os.replace(temp_path, firmware_path)
-                    break
-            
-            # Copy the file
-            shutil.copy(zephyr_exe_path, firmware_path)
-            break
-            
-        except OSError as e:
-            if "Text file busy" in str(e) and attempt < max_retries - 1:
-                print(f"⚠️  File busy, retrying... (attempt {attempt + 1}/{max_retries})")
-                import time
-                time.sleep(0.5)  # Wait before retrying
-                continue
-            else:
-                print(f"❌ Error copying executable: {e}")
-                if using_scons:
-                    env.Exit(1)
-                else:
-                    exit(1)
+    # Link into place and rename atomically, even over a running firmware.bin
+    try:
+        with span('publish'):
+            method = publish_artifact(zephyr_exe_path, [firmware_path])
+    except OSError as e:
+        print(f"❌ Error publishing executable: {e}")
+        if using_scons:
+            env.Exit(1)
+        else:
+            exit(1)
     
-    # Set execute permissions
-    os.chmod(firmware_path, 0o755)
-    print(f"📦 PlatformIO executable: {firmware_path}")
+    print(f"📦 PlatformIO executable: {firmware_path} ({method})")
+    release_lock(publish_lock)
     
 else:
     print(f"❌ Warning: zephyr.exe not found at {zephyr_exe_path}")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Simple build script for the bench/bench_* microbenchmarks on native_sim
+"""
+
+import os
+import sys
+
+# Get environment variables
+PROJECT_DIR = os.environ.get('PROJECT_DIR', os.getcwd())
+BUILD_DIR = os.environ.get('BUILD_DIR', os.path.join(PROJECT_DIR, '.pio', 'build', 'native_sim_bench'))
+
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'scripts'))
+from native_sim_bench import bench_suite_names
+from native_sim_common import (acquire_lock, build_bench_suite, get_option, load_build_options,
+                               publish_artifact, release_lock, zephyr_workspace_dir)
+from native_sim_daemon import daemon_build
+from native_sim_output import print_build_failure, print_progress
+from native_sim_trace import span, start_trace
+
+# Check if we're being called from SCons
+using_scons = len(sys.argv) > 1 and 'scons' in str(sys.argv)
+if using_scons:
+    Import("env")
+
+pio_env_name = os.path.basename(BUILD_DIR)
+ZEPHYR_BASE = zephyr_workspace_dir(env if using_scons else None, PROJECT_DIR, pio_env_name)
+start_trace(get_option('trace', '', env if using_scons else None, PROJECT_DIR, pio_env_name),
+            BUILD_DIR, 'build benchmarks')
+
+print("⏱️  Building Zephyr native_sim microbenchmarks")
+print(f"📁 Project dir: {PROJECT_DIR}")
+print(f"🔨 Build dir: {BUILD_DIR}")
+
+# 'all' (the default) or a comma separated list of bench/bench_* folders
+available = bench_suite_names(PROJECT_DIR)
+bench_option = str(get_option('bench', 'all', env if using_scons else None, PROJECT_DIR,
+                              pio_env_name)).strip()
+if bench_option in ('', 'all'):
+    suites = available
+else:
+    suites = [suite.strip() for suite in bench_option.split(',') if suite.strip()]
+
+unknown_suites = [suite for suite in suites if suite not in available]
+if unknown_suites or not suites:
+    print(f"❌ Error: Unknown benchmark suite(s): {', '.join(unknown_suites) or 'none found'}")
+    print(f"Available suites: {', '.join(available) or 'none'}")
+    if using_scons:
+        env.Exit(1)
+    else:
+        exit(1)
+print(f"📂 Building benchmarks: {', '.join(suites)}")
+
+os.makedirs(BUILD_DIR, exist_ok=True)
+
+# Benchmarks are always release builds: a debug build measures -O0 code
+build_options = load_build_options(env if using_scons else None, PROJECT_DIR, pio_env_name)
+build_options.update(variant='release', debug=False)
+
+publish_lock = acquire_lock(BUILD_DIR)
+for suite in suites:
+    result = daemon_build(PROJECT_DIR, 'bench', env if using_scons else None, pio_env_name,
+                          progress=print_progress, build_dir=BUILD_DIR, suite=suite,
+                          zephyr_workspace=ZEPHYR_BASE, **build_options)
+    if result is None:
+        result = build_bench_suite(PROJECT_DIR, BUILD_DIR, suite, ZEPHYR_BASE,
+                                   progress=print_progress, **build_options)
+    if result['cached']:
+        print(f"♻️  Reusing cached {suite} build, west skipped")
+    elif result['ok']:
+        print(f"✅ {suite} built in {result['duration']:.1f}s")
+    else:
+        print(f"❌ {suite} build failed!")
+        print_build_failure(result)
+        if using_scons:
+            env.Exit(1)
+        else:
+            exit(1)
+
+    # Each suite under <build dir>/<suite>/bench_runner.exe, the first also
+    # as PlatformIO's firmware.bin
+    dest_paths = [os.path.join(BUILD_DIR, suite, 'bench_runner.exe')]
+    if suite == suites[0]:
+        dest_paths.append(os.path.join(BUILD_DIR, 'firmware.bin'))
+    try:
+        with span('publish', suite=suite):
+            method = publish_artifact(result['exe'], dest_paths)
+    except OSError as e:
+        print(f"❌ Error publishing benchmark executable: {e}")
+        if using_scons:
+            env.Exit(1)
+        else:
+            exit(1)
+    print(f"📦 Benchmark executable: {dest_paths[0]} ({method})")
+release_lock(publish_lock)
+
+# Configure SCons environment if available
+if using_scons:
+    # Override the default build process
+    def custom_program_builder(target, source, env):
+        print("✨ Custom Zephyr benchmark build completed")
+        return None
+
+    # Replace the program builder
+    env.Replace(BUILDERS={'BuildProgram': env.Builder(action=custom_program_builder)})
+
+    program_path = os.path.join(BUILD_DIR, 'firmware.bin')
+    env.Replace(PROGPATH=program_path)
+    env.Replace(PROGNAME='firmware.bin')
+
+    # `pio run -e native_sim_bench -t upload` runs the benchmarks
+    env.Replace(UPLOADCMD=f"python3 {PROJECT_DIR}/scripts/upload_native_sim_bench.py")
+
+    if os.path.exists(program_path):
+        print(f"📍 Program path set: {program_path}")
+        env.Default(env.Alias("buildprog", program_path))
+    else:
+        print(f"⚠️  Warning: Program path does not exist yet: {program_path}")
+        env.Default(env.Alias("buildprog", []))
+
+print("🎉 Benchmark build complete!")
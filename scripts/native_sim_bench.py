@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Run the bench/bench_* microbenchmark suites and compare them with a baseline
+"""
+
+import json
+import os
+import platform
+import re
+import subprocess
+import time
+from collections import deque
+
+DEFAULT_BASELINE = os.path.join('bench', 'baseline.json')
+BENCH_REPORT = 'bench_report.json'
+BENCH_OUTPUT = 'bench_output.log'
+BENCH_VERSION = 1
+
+# One benchmark's statistics from native_sim_bench.h, times per iteration
+BENCH_LINE_RE = re.compile(r'^BENCH (\{.*\})\s*$')
+BENCH_DONE = 'BENCH_DONE'
+
+
+def bench_suite_names(project_dir):
+    """Return the sorted bench/bench_* suite folders of a project"""
+    bench_dir = os.path.join(project_dir, 'bench')
+    if not os.path.isdir(bench_dir):
+        return []
+    return sorted(name for name in os.listdir(bench_dir)
+                  if name.startswith('bench_') and os.path.isdir(os.path.join(bench_dir, name)))
+
+
+def run_bench_suite(suite, executable, timeout, args=()):
+    """
+    Run one benchmark executable and collect the statistics it prints.
+
+    Benchmarks run one suite at a time, never concurrently, so they do not
+    compete for the CPU. The output goes to bench_output.log next to the
+    executable and is parsed once the run ends: a reader draining a pipe
+    while the benchmarks run would compete with them for the CPU too.
+    Returns a result dict with the suite name, 'ok' (exited 0 after
+    BENCH_DONE), the 'benchmarks' by name, the 'returncode', the
+    'duration' and the last lines of other output.
+    """
+    benchmarks = {}
+    tail = deque(maxlen=40)
+    done = False
+    log_path = os.path.join(os.path.dirname(executable), BENCH_OUTPUT)
+
+    start = time.monotonic()
+    timed_out = False
+    with open(log_path, 'w+', errors='replace') as log:
+        try:
+            returncode = subprocess.run([executable] + list(args), stdout=log,
+                                        stderr=subprocess.STDOUT, timeout=timeout,
+                                        cwd=os.path.dirname(executable)).returncode
+        except subprocess.TimeoutExpired:
+            returncode = None
+            timed_out = True
+        duration = time.monotonic() - start
+        log.seek(0)
+        for line in log:
+            line = line.rstrip('\n')
+            match = BENCH_LINE_RE.match(line)
+            stats = None
+            if match:
+                try:
+                    stats = json.loads(match.group(1))
+                except ValueError:
+                    pass
+            if stats:
+                benchmarks[stats.pop('name')] = stats
+            elif line.strip() == BENCH_DONE:
+                done = True
+            else:
+                tail.append(line)
+    return {'suite': suite, 'ok': returncode == 0 and done, 'returncode': returncode,
+            'timed_out': timed_out, 'benchmarks': benchmarks, 'duration': duration,
+            'output': list(tail)}
+
+
+def write_bench_report(results, path):
+    """Write the benchmark statistics of a run, and the host they ran on, as JSON"""
+    report = {'version': BENCH_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': {'system': platform.platform(), 'machine': platform.machine(),
+                       'cpus': os.cpu_count()},
+              'suites': {result['suite']: result['benchmarks'] for result in results}}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(temp_path, path)
+
+
+def load_bench_baseline(path):
+    """Return the {suite: {benchmark: stats}} of a baseline file, or None"""
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return baseline.get('suites') if baseline.get('version') == BENCH_VERSION else None
+
+
+def compare_bench(results, baseline, threshold):
+    """
+    Print every benchmark's median against the baseline and return the
+    "suite:benchmark" names that got slower by more than `threshold`
+    """
+    regressions = []
+    print(f"📊 {'benchmark':<40} {'baseline':>12} {'median':>12} {'change':>8}")
+    for result in results:
+        for name, stats in sorted(result['benchmarks'].items()):
+            label = f"{result['suite']}:{name}"
+            base = baseline.get(result['suite'], {}).get(name)
+            if not base:
+                print(f"   {label:<40} {'-':>12} {stats['median_ns']:10.3f}ns {'new':>8}")
+                continue
+            change = (stats['median_ns'] - base['median_ns']) / base['median_ns'] \
+                if base['median_ns'] else 0.0
+            status = ''
+            if change > threshold:
+                status = '  ❌ regression'
+                regressions.append(label)
+            elif -change > threshold:
+                status = '  🚀 faster'
+            print(f"   {label:<40} {base['median_ns']:10.3f}ns {stats['median_ns']:10.3f}ns "
+                  f"{change:+7.1%}{status}")
+    return regressions
+
+
+def print_bench_results(results):
+    """Print the statistics of every benchmark of a run"""
+    for result in results:
+        status = '✅' if result['ok'] else '❌'
+        print(f"{status} {result['suite']} ({result['duration']:.1f}s)")
+        for name, stats in sorted(result['benchmarks'].items()):
+            print(f"   {name:<36} min {stats['min_ns']:10.3f}ns  median {stats['median_ns']:10.3f}ns"
+                  f"  p95 {stats['p95_ns']:10.3f}ns  {stats['ops_per_sec']:>12,} ops/s")
+        if not result['ok']:
+            reason = ('timed out' if result['timed_out'] else
+                      f"exited with {result['returncode']}" if result['returncode'] else
+                      'ended without BENCH_DONE')
+            print(f"   {reason}, last output:")
+            for line in result['output'][-10:]:
+                print(f"   {line}")
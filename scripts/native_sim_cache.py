@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Caches for native_sim builds: a content-addressed cache of built
+executables, the ccache compiler cache west builds run under and a cache
+of passing test results
+"""
+
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pio_native_sim', 'artifacts')
+DEFAULT_MAX_SIZE = '2G'
+DEFAULT_CCACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pio_native_sim', 'ccache')
+CCACHE_STATS_LOG = 'ccache_stats.log'
+DEFAULT_RESULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pio_native_sim',
+                                        'results')
+DEFAULT_RESULT_CACHE_MAX_SIZE = '256M'
+
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """Parse sizes such as '500M' or '2G' into bytes"""
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_signature():
+    """
+    Describe the host toolchain used for native_sim builds.
+
+    Covers the compiler version and the Zephyr toolchain selection from the
+    environment; computed once per process.
+    """
+    parts = [f"{name}={os.environ.get(name, '')}" for name in
+             ('ZEPHYR_TOOLCHAIN_VARIANT', 'ZEPHYR_SDK_INSTALL_DIR', 'CC')]
+    compiler = os.environ.get('CC', 'gcc')
+    try:
+        result = subprocess.run([compiler, '--version'], capture_output=True, text=True, timeout=10)
+        parts.append(result.stdout.strip())
+    except (OSError, subprocess.TimeoutExpired):
+        parts.append(f'{compiler}: unavailable')
+    return '\n'.join(parts)
+
+
+def artifact_key(fingerprint):
+    """Return the cache key of a build from its input fingerprint and the toolchain"""
+    digest = hashlib.sha256()
+    digest.update(fingerprint['config'].encode())
+    digest.update(fingerprint['sources'].encode())
+    digest.update(toolchain_signature().encode())
+    return digest.hexdigest()
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def cache_lookup(cache_dir, key):
+    """
+    Return the cached executable for key, or None.
+
+    A hit refreshes the entry's mtime, which is what eviction orders by.
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    executable = os.path.join(entry_dir, 'zephyr.exe')
+    if not os.path.isfile(executable):
+        return None
+    try:
+        os.utime(entry_dir)
+    except OSError:
+        pass
+    return executable
+
+
+def cache_store(cache_dir, key, executable, metadata, max_size=DEFAULT_MAX_SIZE):
+    """
+    Store a built executable under key and evict old entries.
+
+    Entries are written to a temporary directory and renamed into place, so
+    several workers sharing cache_dir never see a partial entry.
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        return
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    temp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    try:
+        # The linker replaces zephyr.exe instead of rewriting it, so a
+        # hardlink keeps the cached content intact
+        os.link(executable, os.path.join(temp_dir, 'zephyr.exe'))
+    except OSError:
+        shutil.copyfile(executable, os.path.join(temp_dir, 'zephyr.exe'))
+    os.chmod(os.path.join(temp_dir, 'zephyr.exe'), 0o755)
+    with open(os.path.join(temp_dir, 'metadata.json'), 'w') as f:
+        json.dump(dict(metadata, key=key, stored=time.time()), f, indent=2)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Another worker stored the same key first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    cache_evict(cache_dir, parse_size(max_size))
+
+
+def cache_evict(cache_dir, max_bytes):
+    """Remove least recently used entries until the cache fits in max_bytes"""
+    with open(os.path.join(cache_dir, '.evict.lock'), 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        entries = []
+        total = 0
+        for shard in os.listdir(cache_dir):
+            shard_dir = os.path.join(cache_dir, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                entry_dir = os.path.join(shard_dir, key)
+                if key.endswith('.tmp') or not os.path.isdir(entry_dir):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry_dir, name))
+                           for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+                total += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def result_key(parts):
+    """Return the cache key of a test result from the JSON-able inputs that decide it"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def result_lookup(cache_dir, key):
+    """
+    Return (result, entry_dir) of a cached test result, or None.
+
+    entry_dir holds the report files stored with the result. A hit
+    refreshes the entry's mtime, which is what eviction orders by.
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, 'result.json')) as f:
+            result = json.load(f)
+        os.utime(entry_dir)
+    except (OSError, ValueError):
+        return None
+    return result, entry_dir
+
+
+def result_store(cache_dir, key, result, report_dirs, report_files,
+                 max_size=DEFAULT_RESULT_CACHE_MAX_SIZE):
+    """
+    Store a test result with its report files, each concatenated over
+    report_dirs, and evict old entries. Written like cache_store.
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    temp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    for name in report_files:
+        with open(os.path.join(temp_dir, name), 'wb') as out:
+            for report_dir in report_dirs:
+                with open(os.path.join(report_dir, name), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+    with open(os.path.join(temp_dir, 'result.json'), 'w') as f:
+        json.dump(dict(result, key=key, stored=time.time()), f, indent=2)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Another worker stored the same key first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    cache_evict(cache_dir, parse_size(max_size))
+
+
+@functools.lru_cache(maxsize=None)
+def find_ccache():
+    """Return the path of the ccache executable, or None"""
+    return shutil.which('ccache')
+
+
+def ccache_env(ccache_dir, base_dir, stats_log):
+    """
+    Return the environment variables a ccache-enabled build runs with.
+
+    Every work dir has the same depth below .pio/build, so with base_dir
+    covering both the project and the Zephyr workspace, ccache sees the
+    same relative paths from every build dir and suites, variants and
+    branches share cache entries. NOHASHDIR keeps the build dir itself out
+    of the keys of -g builds. Each build logs its own counters to stats_log,
+    so concurrent builds sharing the cache report their own hit rate.
+    """
+    variables = {
+        'CCACHE_DIR': ccache_dir,
+        'CCACHE_NOHASHDIR': '1',
+        'CCACHE_STATSLOG': stats_log,
+    }
+    # ccache ignores a base dir of /, which is all two unrelated trees share
+    if base_dir != os.sep:
+        variables['CCACHE_BASEDIR'] = base_dir
+    return variables
+
+
+def read_ccache_stats(stats_log):
+    """Return (hits, misses) recorded in a ccache stats log, or None"""
+    hits = misses = 0
+    try:
+        with open(stats_log) as f:
+            for line in f:
+                counter = line.strip()
+                if counter in ('direct_cache_hit', 'preprocessed_cache_hit'):
+                    hits += 1
+                elif counter == 'cache_miss':
+                    misses += 1
+    except OSError:
+        return None
+    return hits, misses
@@ -0,0 +1,1339 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the Zephyr native_sim build and upload scripts
+"""
+
+import configparser
+import fcntl
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from native_sim_cache import (CCACHE_STATS_LOG, DEFAULT_CACHE_DIR, DEFAULT_CCACHE_DIR,
+                              DEFAULT_MAX_SIZE, artifact_key, cache_lookup, cache_store,
+                              ccache_env, find_ccache, read_ccache_stats)
+from native_sim_deps import affected_suites, print_selection, record_dependencies
+from native_sim_output import (BuildCancelled, BuildOutput, print_build_failure, print_progress,
+                              stream_command)
+from native_sim_trace import add_ninja_log, add_span, ninja_log_offset, span
+
+FINGERPRINT_FILE = 'native_sim_fingerprint.json'
+LOCK_FILE = '.native_sim.lock'
+DEFAULT_ZEPHYR_WORKSPACE = os.path.expanduser('~/zephyrproject')
+TOOLCHAIN_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'pio_native_sim', 'toolchain.json')
+PRISTINE_MODES = ('auto', 'always', 'never')
+
+# File extensions that feed the compiler or the Kconfig/devicetree steps
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.h', '.hpp', '.S')
+
+# prj.conf used for generated test projects when the caller has none
+TEST_PRJ_CONF = """# Zephyr Test Configuration
+CONFIG_MAIN_STACK_SIZE=4096
+CONFIG_HEAP_MEM_POOL_SIZE=4096
+CONFIG_PRINTK=y
+CONFIG_CONSOLE=y
+CONFIG_SERIAL=y
+CONFIG_UART_CONSOLE=y
+"""
+
+# prj.conf of generated benchmark projects: printk carries the results
+BENCH_PRJ_CONF = """# Zephyr Benchmark Configuration
+CONFIG_MAIN_STACK_SIZE=4096
+CONFIG_PRINTK=y
+CONFIG_CONSOLE=y
+CONFIG_SERIAL=y
+CONFIG_UART_CONSOLE=y
+"""
+
+# Building blocks of named build variants (see parse_variants): Zephyr
+# picks the optimization level and LTO through Kconfig
+VARIANT_PRESETS = {
+    'O0': ['CONFIG_NO_OPTIMIZATIONS=y'],
+    'Og': ['CONFIG_DEBUG_OPTIMIZATIONS=y'],
+    'Os': ['CONFIG_SIZE_OPTIMIZATIONS=y'],
+    'O2': ['CONFIG_SPEED_OPTIMIZATIONS=y'],
+    'lto': ['CONFIG_LTO=y', 'CONFIG_ISR_TABLES_LOCAL_DECLARATION=y'],
+}
+VARIANT_NAME_RE = re.compile(r'^[\w.+-]+$')
+VARIANT_NAME_UNSAFE_RE = re.compile(r'[^\w.+-]')
+
+# Profile builds (see profile_variant): optimized code that keeps frame
+# pointers and symbols so perf can walk the stacks; gprof adds -pg
+PROFILE_MODES = ('perf', 'gprof')
+PROFILE_CFLAGS = ['-g', '-fno-omit-frame-pointer', '-fno-optimize-sibling-calls']
+
+# Extra options of the native simulator's final link, set by variants with
+# ldflags such as the gprof profile build
+NATIVE_SIM_LINK_CMAKE = '''# Link options of the final native_sim executable, e.g. -pg for gprof
+if(NATIVE_SIM_LINK_OPTIONS AND TARGET native_simulator)
+  target_link_options(native_simulator INTERFACE ${NATIVE_SIM_LINK_OPTIONS})
+endif()
+'''
+
+
+# ioctl request that clones file extents (reflink) on btrfs, XFS and friends
+FICLONE = 0x40049409
+
+
+def get_option(name, default=None, env=None, project_dir=None, pio_env=None):
+    """
+    Look up a native_sim option.
+
+    NATIVE_SIM_<NAME> in the process environment wins, then
+    custom_native_sim_<name> from platformio.ini (through SCons when
+    available, otherwise by reading the file for the current env).
+    """
+    value = os.environ.get(f'NATIVE_SIM_{name.upper()}')
+    if value is not None:
+        return value
+
+    option = f'custom_native_sim_{name}'
+    if env is not None:
+        try:
+            return env.GetProjectOption(option, default)
+        except Exception:
+            return default
+
+    project_dir = project_dir or os.environ.get('PROJECT_DIR', os.getcwd())
+    ini_path = os.path.join(project_dir, 'platformio.ini')
+    if not os.path.exists(ini_path):
+        return default
+
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read(ini_path)
+    except configparser.Error:
+        return default
+
+    pio_env = pio_env or os.environ.get('PIOENV')
+    for section in (f'env:{pio_env}' if pio_env else None, 'env'):
+        if section and parser.has_option(section, option):
+            return parser.get(section, option).strip()
+    return default
+
+
+# path -> (mtime_ns, size, digest); lets a long-lived build daemon skip
+# re-hashing files that did not change between builds
+_digest_cache = {}
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of a file's content"""
+    stat = os.stat(path)
+    cached = _digest_cache.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    _digest_cache[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def collect_sources(roots, extensions=SOURCE_EXTENSIONS):
+    """
+    Return a sorted list of files found below the given roots, limited to
+    compiler inputs unless extensions is None
+    """
+    sources = []
+    for root in roots:
+        if os.path.isfile(root):
+            sources.append(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if extensions is None or filename.endswith(extensions):
+                    sources.append(os.path.join(dirpath, filename))
+    return sorted(sources)
+
+
+def zephyr_workspace_dir(env=None, project_dir=None, pio_env=None):
+    """
+    Return the west workspace to build with.
+
+    The zephyr_workspace option wins, then the parent of $ZEPHYR_BASE, then
+    ~/zephyrproject.
+    """
+    workspace = get_option('zephyr_workspace', None, env, project_dir, pio_env)
+    if workspace:
+        return os.path.abspath(os.path.expanduser(workspace))
+    if os.environ.get('ZEPHYR_BASE'):
+        return os.path.dirname(os.path.abspath(os.environ['ZEPHYR_BASE']))
+    return DEFAULT_ZEPHYR_WORKSPACE
+
+
+def _find_west(zephyr_workspace):
+    """Locate west and the Zephyr tree of a workspace without any cache"""
+    venv_dir = os.path.join(zephyr_workspace, '.venv')
+    west_path = os.path.join(venv_dir, 'bin', 'west')
+    if not os.access(west_path, os.X_OK):
+        venv_dir = None
+        west_path = shutil.which('west')
+    if not west_path:
+        return None
+
+    zephyr_base = os.path.join(zephyr_workspace, 'zephyr')
+    west_config = configparser.ConfigParser(interpolation=None)
+    try:
+        west_config.read(os.path.join(zephyr_workspace, '.west', 'config'))
+        zephyr_base = os.path.join(zephyr_workspace, west_config.get('zephyr', 'base'))
+    except configparser.Error:
+        pass
+
+    return {'west': west_path, 'venv': venv_dir, 'zephyr_base': zephyr_base}
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_west(zephyr_workspace):
+    """
+    Return how to invoke west for a workspace: its 'argv' prefix, the 'env'
+    to run it with and the 'zephyr_base'.
+
+    The lookup is cached in memory and in TOOLCHAIN_CACHE, so builds neither
+    source the venv activation script nor search PATH for west. Returns None
+    when no west can be found.
+    """
+    cache = {}
+    try:
+        with open(TOOLCHAIN_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    resolved = cache.get(zephyr_workspace)
+    if not resolved or not os.access(resolved['west'], os.X_OK):
+        resolved = _find_west(zephyr_workspace)
+        if not resolved:
+            return None
+        cache[zephyr_workspace] = resolved
+        try:
+            os.makedirs(os.path.dirname(TOOLCHAIN_CACHE), exist_ok=True)
+            temp_path = f'{TOOLCHAIN_CACHE}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(temp_path, TOOLCHAIN_CACHE)
+        except OSError:
+            pass
+
+    west_env = dict(os.environ, ZEPHYR_BASE=resolved['zephyr_base'])
+    if resolved['venv']:
+        # What sourcing bin/activate would do, so cmake/ninja from the venv are found
+        west_env['VIRTUAL_ENV'] = resolved['venv']
+        west_env['PATH'] = os.pathsep.join([os.path.join(resolved['venv'], 'bin'),
+                                            west_env.get('PATH', '')])
+    return {'argv': [resolved['west']], 'env': west_env, 'zephyr_base': resolved['zephyr_base']}
+
+
+def zephyr_revision(zephyr_workspace):
+    """Return the git revision of the Zephyr tree inside the west workspace"""
+    west = resolve_west(zephyr_workspace)
+    zephyr_tree = west['zephyr_base'] if west else os.path.join(zephyr_workspace, 'zephyr')
+    try:
+        result = subprocess.run(['git', '-C', zephyr_tree, 'rev-parse', 'HEAD'],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unknown'
+    if result.returncode != 0:
+        return 'unknown'
+    return result.stdout.strip()
+
+
+def build_fingerprint(config_files, source_files, settings):
+    """
+    Fingerprint the inputs of one west build.
+
+    The 'config' hash covers everything that needs a fresh CMake/Kconfig/
+    devicetree run: the settings, the content of the configuration files
+    and the list of source files (CMake only sees new or removed files on
+    reconfigure). The 'sources' hash covers source content, which ninja
+    rebuilds incrementally on its own.
+    """
+    config = hashlib.sha256()
+    for key in sorted(settings):
+        config.update(f'{key}={settings[key]}\n'.encode())
+    for path in sorted(config_files):
+        config.update(f'{path}:{file_digest(path)}\n'.encode())
+    for path in source_files:
+        config.update(f'{path}\n'.encode())
+
+    sources = hashlib.sha256()
+    for path in source_files:
+        sources.update(f'{path}:{file_digest(path)}\n'.encode())
+
+    return {'config': config.hexdigest(), 'sources': sources.hexdigest()}
+
+
+def load_fingerprint(fingerprint_path):
+    try:
+        with open(fingerprint_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_fingerprint(fingerprint_path, fingerprint):
+    os.makedirs(os.path.dirname(fingerprint_path), exist_ok=True)
+    temp_path = fingerprint_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(fingerprint, f, indent=2)
+    os.replace(temp_path, fingerprint_path)
+
+
+def choose_pristine(mode, west_build_dir, fingerprint):
+    """
+    Decide the west --pristine value for this build.
+
+    Returns a (pristine, reason) tuple. In 'auto' mode the build only goes
+    pristine when the configuration part of the fingerprint changed, and
+    otherwise leaves the rebuild to ninja.
+    """
+    if mode not in PRISTINE_MODES:
+        print(f"⚠️  Unknown pristine mode '{mode}', using 'auto'")
+        mode = 'auto'
+    if mode != 'auto':
+        return mode, f'pristine mode forced to {mode}'
+
+    if not os.path.exists(os.path.join(west_build_dir, 'CMakeCache.txt')):
+        return 'always', 'no previous build'
+
+    previous = load_fingerprint(os.path.join(west_build_dir, FINGERPRINT_FILE))
+    if not previous:
+        return 'always', 'no previous fingerprint'
+    if previous.get('config') != fingerprint['config']:
+        return 'always', 'configuration changed'
+    if previous.get('sources') != fingerprint['sources']:
+        return 'never', 'sources changed, incremental build'
+    return 'never', 'inputs unchanged'
+
+
+def west_work_dir(build_dir, name, variant):
+    """
+    Return the private work directory of one west build.
+
+    Every env (build_dir), suite or application (name) and debug/release
+    variant gets its own directory, holding the west build dir in 'build'
+    and, for generated test projects, the project itself in 'app'.
+    """
+    return os.path.join(build_dir, 'west', f'{name}-{variant}')
+
+
+def acquire_lock(lock_dir):
+    """
+    Take an exclusive lock on lock_dir, waiting for other builds holding it.
+
+    The lock is released by release_lock() or when the process exits.
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = open(os.path.join(lock_dir, LOCK_FILE), 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"⏳ Waiting for lock on {lock_dir}")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def release_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def find_unity(project_dir):
+    """Return the Unity library installed by PlatformIO, or None"""
+    candidates = [
+        os.path.join(project_dir, '.pio', 'libdeps', 'native_sim_test', 'Unity'),
+        os.path.join(project_dir, '.pio', 'libdeps', 'native_sim', 'Unity'),
+        os.path.join(project_dir, '.pio', 'libdeps', '*', 'Unity'),
+    ]
+    for pattern in candidates:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.exists(os.path.join(path, 'src', 'unity.c')):
+                return path
+    return None
+
+
+def _suite_sources(project_dir, suite):
+    suite_dir = os.path.join(project_dir, 'test', suite)
+    return sorted(os.path.join(suite_dir, name) for name in os.listdir(suite_dir)
+                  if name.endswith('.c'))
+
+
+def lib_source_manifest(project_dir):
+    """
+    Return the (sources, include_dirs) of lib/: every *.c under it and
+    every directory below it, both sorted
+    """
+    lib_dir = os.path.join(project_dir, 'lib')
+    lib_sources = collect_sources([lib_dir], extensions=('.c',)) if os.path.isdir(lib_dir) else []
+    include_dirs = sorted(dirpath for dirpath, _, _ in os.walk(lib_dir) if dirpath != lib_dir)
+    return lib_sources, include_dirs
+
+
+def test_source_manifest(project_dir, suite):
+    """
+    Return the (sources, include_dirs) of a generated test project.
+
+    Sources are the suite's *.c files (every test/**/test_*.c when suite is
+    None) plus every *.c under lib/; include dirs are every directory under
+    lib/. Both lists are sorted so the generated CMakeLists.txt is stable.
+    """
+    if suite:
+        test_sources = _suite_sources(project_dir, suite)
+    else:
+        test_sources = [path for path in collect_sources([os.path.join(project_dir, 'test')],
+                                                         extensions=('.c',))
+                        if os.path.basename(path).startswith('test_')]
+    lib_sources, include_dirs = lib_source_manifest(project_dir)
+    return test_sources + lib_sources, include_dirs
+
+
+def _render_cmake(project_dir, unity_path, source_block, include_dirs, debug):
+    include_lines = ''.join(f'\n    "{path}"' for path in include_dirs)
+    include_block = f'target_include_directories(app PRIVATE{include_lines}\n)\n' if include_dirs else ''
+
+    debug_flags = ""
+    if debug:
+        debug_flags = """
+# Debug build configuration
+target_compile_options(app PRIVATE -g -O0 -DDEBUG)
+target_compile_definitions(app PRIVATE DEBUG=1)
+"""
+
+    return f'''cmake_minimum_required(VERSION 3.13.1)
+find_package(Zephyr REQUIRED HINTS $ENV{{ZEPHYR_BASE}})
+project(zephyr_test_app)
+
+# Include Unity framework
+target_sources(app PRIVATE "{unity_path}/src/unity.c")
+target_include_directories(app PRIVATE "{unity_path}/src")
+
+{source_block}
+# Include directories (EXCLUDE src to avoid main application)
+target_include_directories(app PRIVATE "{project_dir}/test/include_shims")
+
+# Include library directories
+{include_block}
+{NATIVE_SIM_LINK_CMAKE}{debug_flags}'''
+
+
+def render_test_cmake(project_dir, unity_path, suite, debug=False):
+    """Return the CMakeLists.txt of a generated test project"""
+    sources, include_dirs = test_source_manifest(project_dir, suite)
+    source_lines = ''.join(f'\n    "{path}"' for path in sources)
+    source_block = f'''# Test sources of the suite and ONLY library sources (NO main application
+# sources), listed explicitly so CMake never has to glob the tree
+target_sources(app PRIVATE{source_lines}
+)
+'''
+    return _render_cmake(project_dir, unity_path, source_block, include_dirs, debug)
+
+
+def render_runner_cmake(project_dir, unity_path, suites, runner_path, debug=False):
+    """
+    Return the CMakeLists.txt of a test project driven by a generated
+    runner: each suite's main, setUp and tearDown are renamed to
+    <suite>_main, <suite>_setUp and <suite>_tearDown so that any number of
+    suites link into one executable.
+    """
+    lib_sources, include_dirs = lib_source_manifest(project_dir)
+    blocks = [f'''# Generated Unity runner; suites and tests are picked at runtime
+target_sources(app PRIVATE "{runner_path}")
+''']
+    for suite in suites:
+        source_lines = ''.join(f'\n    "{path}"' for path in _suite_sources(project_dir, suite))
+        blocks.append(f'''
+set({suite}_sources{source_lines}
+)
+target_sources(app PRIVATE ${{{suite}_sources}})
+set_source_files_properties(${{{suite}_sources}} PROPERTIES COMPILE_DEFINITIONS
+    "main={suite}_main;setUp={suite}_setUp;tearDown={suite}_tearDown")
+''')
+    if lib_sources:
+        source_lines = ''.join(f'\n    "{path}"' for path in lib_sources)
+        blocks.append(f'''
+# Library sources, compiled once for every suite
+target_sources(app PRIVATE{source_lines}
+)
+''')
+    return _render_cmake(project_dir, unity_path, ''.join(blocks), include_dirs, debug)
+
+
+def bench_source_manifest(project_dir, suite):
+    """
+    Return the (sources, include_dirs) of a generated benchmark project:
+    the *.c files of bench/<suite> plus every *.c under lib/, and
+    bench/include plus every directory under lib/
+    """
+    suite_dir = os.path.join(project_dir, 'bench', suite)
+    bench_sources = sorted(os.path.join(suite_dir, name) for name in os.listdir(suite_dir)
+                           if name.endswith('.c'))
+    lib_sources, include_dirs = lib_source_manifest(project_dir)
+    return bench_sources + lib_sources, [os.path.join(project_dir, 'bench', 'include')] + include_dirs
+
+
+def render_bench_cmake(project_dir, suite, debug=False):
+    """
+    Return the CMakeLists.txt of a generated benchmark project.
+
+    On native_sim the harness's host clock is built into the native
+    simulator runner, which links against the host C library.
+    """
+    sources, include_dirs = bench_source_manifest(project_dir, suite)
+    source_lines = ''.join(f'\n    "{path}"' for path in sources)
+    include_lines = ''.join(f'\n    "{path}"' for path in include_dirs)
+    host_clock = os.path.join(project_dir, 'bench', 'include', 'native_sim_bench_host.c')
+    debug_flags = ''
+    if debug:
+        debug_flags = """
+# Debug build configuration
+target_compile_options(app PRIVATE -g -O0 -DDEBUG)
+target_compile_definitions(app PRIVATE DEBUG=1)
+"""
+
+    return f'''cmake_minimum_required(VERSION 3.13.1)
+find_package(Zephyr REQUIRED HINTS $ENV{{ZEPHYR_BASE}})
+project(zephyr_bench_app)
+
+# Benchmarks of the suite and the library sources they measure
+target_sources(app PRIVATE{source_lines}
+)
+target_include_directories(app PRIVATE{include_lines}
+)
+
+# Host monotonic clock: native_sim's cycle counter does not advance while code runs
+if(TARGET native_simulator)
+  target_sources(native_simulator INTERFACE "{host_clock}")
+endif()
+{debug_flags}'''
+
+
+def render_test_runner(project_dir, suite_index, suites):
+    """
+    Return the C source of a Unity runner for the given suites.
+
+    Tests are the test_* functions the suite index found in each suite, so
+    suites need no hand-written RUN_TEST list. Suites and tests are picked
+    at runtime through native_sim's -testargs, e.g.
+
+        zephyr.exe -testargs --suite=test_sum,test_math --test=test_sum_zero
+
+    and the process exits with 1 when any test failed.
+    """
+    declarations = []
+    runners = []
+    calls = []
+    for suite in suites:
+        entry = suite_index['suites'][suite]
+        hooks = {}
+        for hook in ('setUp', 'tearDown'):
+            if hook in entry['hooks']:
+                declarations.append(f'void {suite}_{hook}(void);')
+                hooks[hook] = f'{suite}_{hook}'
+            else:
+                hooks[hook] = 'NULL'
+        runs = []
+        for relative_path, name, line in entry['test_functions']:
+            declarations.append(f'void {name}(void);')
+            path = os.path.join(entry['folder'], relative_path)
+            runs.append(f'    run_test({name}, "{name}", "{path}", {line});')
+        runs = '\n'.join(runs)
+        runners.append(f'''
+static void run_{suite}(void)
+{{
+    current_setUp = {hooks['setUp']};
+    current_tearDown = {hooks['tearDown']};
+{runs}
+}}
+''')
+        calls.append(f'''    if (selected(suite_filter, "{suite}")) {{
+        run_{suite}();
+    }}''')
+    declarations = '\n'.join(declarations)
+    runners = ''.join(runners)
+    calls = '\n'.join(calls)
+
+    return f'''/* Generated by scripts/native_sim_common.py from the suite index, do not edit */
+#include <stdlib.h>
+#include <string.h>
+#include <unity.h>
+#include <zephyr/kernel.h>
+
+/* native_sim: the arguments given after -testargs */
+extern void native_get_test_cmd_line_args(int *argc, char ***argv);
+
+{declarations}
+
+static void (*current_setUp)(void);
+static void (*current_tearDown)(void);
+static const char *suite_filter;
+static const char *test_filter;
+
+void setUp(void)
+{{
+    if (current_setUp) {{
+        current_setUp();
+    }}
+}}
+
+void tearDown(void)
+{{
+    if (current_tearDown) {{
+        current_tearDown();
+    }}
+}}
+
+/* True when filter is unset or name is one of its comma separated items */
+static int selected(const char *filter, const char *name)
+{{
+    size_t length = strlen(name);
+    const char *match;
+
+    if (filter == NULL) {{
+        return 1;
+    }}
+    for (match = strstr(filter, name); match != NULL; match = strstr(match + 1, name)) {{
+        if ((match == filter || match[-1] == ',') &&
+            (match[length] == ',' || match[length] == '\\0')) {{
+            return 1;
+        }}
+    }}
+    return 0;
+}}
+
+static void run_test(UnityTestFunction test, const char *name, const char *file, int line)
+{{
+    if (selected(test_filter, name)) {{
+        Unity.TestFile = file;
+        UnityDefaultTestRun(test, name, line);
+    }}
+}}
+{runners}
+int main(void)
+{{
+    int argc = 0;
+    char **argv = NULL;
+
+    native_get_test_cmd_line_args(&argc, &argv);
+    for (int i = 0; i < argc; i++) {{
+        if (strncmp(argv[i], "--suite=", 8) == 0) {{
+            suite_filter = argv[i] + 8;
+        }} else if (strncmp(argv[i], "--test=", 7) == 0) {{
+            test_filter = argv[i] + 7;
+        }}
+    }}
+
+    UNITY_BEGIN();
+{calls}
+    exit(UNITY_END() == 0 ? 0 : 1);
+}}
+'''
+
+
+def write_if_changed(path, content):
+    """
+    Write content to path unless the file already holds exactly that.
+
+    Keeping the mtime of unchanged generated files stops ninja from
+    re-running CMake. Returns True when the file was written.
+    """
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+    return True
+
+
+def parse_variants(option, project_dir):
+    """
+    Parse the `variants` option into build variant specs.
+
+    Variants are comma separated, each `name=part+part...` or just
+    `part+part...`, named after itself with every character a name cannot
+    hold replaced by '_' (O2+CONFIG_FOO=y becomes O2+CONFIG_FOO_y). A part is a preset from
+    VARIANT_PRESETS (O0, Og, Os, O2, lto), a Kconfig fragment file
+    relative to the project (*.conf), a CONFIG_*=... line or a compiler
+    flag starting with '-', e.g. "Os, O2, O2+lto, tiny=Os+tiny.conf+-fno-inline".
+    Returns a list of {'name', 'kconfig': [lines], 'cflags': [flags]};
+    raises ValueError for anything else.
+    """
+    variants = []
+    for entry in str(option or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        head = entry.split('+')[0]
+        if '=' in head and not head.startswith(('CONFIG_', '-')):
+            name, parts = entry.split('=', 1)
+            name = name.strip()
+        else:
+            name, parts = VARIANT_NAME_UNSAFE_RE.sub('_', entry), entry
+        if not VARIANT_NAME_RE.match(name) or name in ('release', 'debug'):
+            raise ValueError(f"invalid variant name '{name}'")
+        kconfig, cflags = [], []
+        for part in parts.split('+'):
+            part = part.strip()
+            if part in VARIANT_PRESETS:
+                kconfig.extend(VARIANT_PRESETS[part])
+            elif part.startswith('CONFIG_') and '=' in part:
+                kconfig.append(part)
+            elif part.startswith('-'):
+                cflags.append(part)
+            elif part.endswith('.conf'):
+                try:
+                    with open(os.path.join(project_dir, part)) as f:
+                        kconfig.extend(line.strip() for line in f
+                                       if line.strip() and not line.startswith('#'))
+                except OSError as e:
+                    raise ValueError(f"variant '{name}': cannot read {part}: {e.strerror}")
+            else:
+                raise ValueError(f"variant '{name}': unknown part '{part}', expected one of "
+                                 f"{', '.join(VARIANT_PRESETS)}, a *.conf fragment, "
+                                 f"a CONFIG_ line or a -flag")
+        if any(variant['name'] == name for variant in variants):
+            raise ValueError(f"variant '{name}' is defined twice")
+        variants.append({'name': name, 'kconfig': kconfig, 'cflags': cflags})
+    return variants
+
+
+def profile_variant(mode):
+    """
+    Return the variant spec of a profile build for the `profile` option:
+    'perf' (or yes) gives -O2 code with symbols and frame pointers, which
+    perf can sample and unwind; 'gprof' also instruments every function
+    with -pg and links the executable with -pg so it writes gmon.out.
+    Raises ValueError for anything else.
+    """
+    mode = str(mode).strip().lower()
+    if mode in ('1', 'yes', 'true'):
+        mode = 'perf'
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"unknown profile mode '{mode}', expected one of "
+                         f"{', '.join(PROFILE_MODES)}")
+    gprof = mode == 'gprof'
+    return {'name': 'profile-gprof' if gprof else 'profile',
+            'kconfig': list(VARIANT_PRESETS['O2']),
+            'cflags': PROFILE_CFLAGS + (['-pg'] if gprof else []),
+            'ldflags': ['-pg'] if gprof else []}
+
+
+def profile_option(env=None, project_dir=None, pio_env=None):
+    """
+    Return the variant spec for the `profile` option (see profile_variant),
+    or None when profiling is off. Raises ValueError for an unknown mode.
+    """
+    mode = str(get_option('profile', 'no', env, project_dir, pio_env)).strip().lower()
+    if mode in ('', '0', 'no', 'false'):
+        return None
+    spec = profile_variant(mode)
+    print(f"🔥 Profile build: {spec['name']} ({' '.join(spec['cflags'])})")
+    return spec
+
+
+def select_test_suites(project_dir, suite_index, current_suite, env=None, pio_env=None):
+    """
+    Resolve the test suites a build or run covers.
+
+    The `suites` option is 'all' or a comma separated list of test folders.
+    Without it and without a current_suite (the one PlatformIO is testing)
+    every suite is selected. The build and upload scripts both call this,
+    so a run covers exactly the suites that were built. The `affected`
+    option then drops the suites no change reaches. Returns (suites,
+    selected): suites is the multi-suite list, empty when only
+    current_suite is covered, and selected is False when `affected` left
+    nothing to build or run.
+    Raises ValueError for unknown suites or when there are none.
+    """
+    available = sorted(suite_index['suites'])
+    option = str(get_option('suites', '', env, project_dir, pio_env)).strip()
+    if option == 'all':
+        suites = available
+    else:
+        suites = [suite.strip() for suite in option.split(',') if suite.strip()]
+    if not current_suite and not suites:
+        suites = available
+
+    unknown = [suite for suite in suites if suite not in suite_index['suites']]
+    if unknown or not (suites or current_suite):
+        raise ValueError(f"Unknown test suite(s): {', '.join(unknown) or 'none found'} "
+                         f"(available: {', '.join(available) or 'none'})")
+
+    candidates = suites or ([current_suite] if current_suite else [])
+    affected = get_option('affected', '', env, project_dir, pio_env)
+    selected = affected_suites(project_dir, candidates, affected) if candidates else None
+    if selected is None:
+        return suites, True
+    print_selection(candidates, selected, affected)
+    return (selected if suites else []), bool(selected)
+
+
+def build_tests(project_dir, build_dir, suites, current_suite, suite_index, unity_path,
+                zephyr_workspace, env=None, pio_env=None, **build_options):
+    """
+    Build the test suites chosen by select_test_suites, through the
+    daemon when one is running.
+
+    The test_runner option picks how: 'manual' (the suites' own main()) or
+    'generated' (runners generated from the suite index) build several
+    suites concurrently, each published to <build_dir>/<suite>, or
+    current_suite alone; 'combined' links every suite into one executable.
+    Returns (executable, suite): the executable PlatformIO should run, None
+    when the build failed, and the suite it stands for.
+    """
+    # The daemon module builds on this one
+    from native_sim_daemon import daemon_build
+
+    test_runner_mode = str(get_option('test_runner', 'manual', env, project_dir,
+                                      pio_env)).lower()
+    if test_runner_mode == 'generated':
+        build_options['suite_index'] = suite_index
+    common = dict(build_dir=build_dir, unity_path=unity_path, zephyr_workspace=zephyr_workspace,
+                  **build_options)
+
+    if suites and test_runner_mode != 'combined':
+        # Build every requested suite concurrently, each in its own west build dir
+        jobs = max(1, int(get_option('jobs', os.cpu_count() or 1, env, project_dir, pio_env)))
+        fail_fast = str(get_option('fail_fast', 'no', env, project_dir,
+                                   pio_env)).lower() in ('1', 'yes', 'true')
+        results = daemon_build(project_dir, 'suites', env, pio_env, suites=suites, jobs=jobs,
+                               fail_fast=fail_fast, **common)
+        if results is None:
+            results = build_all_test_suites(project_dir, build_dir, suites, unity_path,
+                                            zephyr_workspace, jobs=jobs, fail_fast=fail_fast,
+                                            **build_options)
+        if not all(result['ok'] for result in results):
+            return None, current_suite
+
+        # PlatformIO runs one suite at a time; expose that suite as the main artifact
+        if current_suite not in suites:
+            current_suite = suites[0]
+        return os.path.join(build_dir, current_suite, 'test_runner.exe'), current_suite
+
+    if test_runner_mode == 'combined':
+        print(f"📋 Linking every suite into one executable: "
+              f"{', '.join(sorted(suite_index['suites']))}")
+        result = daemon_build(project_dir, 'combined', env, pio_env, progress=print_progress,
+                              suite_index=suite_index, **common)
+        if result is None:
+            result = build_combined_tests(project_dir, build_dir, suite_index, unity_path,
+                                          zephyr_workspace, progress=print_progress,
+                                          **build_options)
+    else:
+        print(f"📋 Including tests from: {os.path.join(project_dir, 'test', current_suite)}")
+        result = daemon_build(project_dir, 'test', env, pio_env, progress=print_progress,
+                              suite=current_suite, **common)
+        if result is None:
+            result = build_test_suite(project_dir, build_dir, current_suite, unity_path,
+                                      zephyr_workspace, progress=print_progress, **build_options)
+
+    if result['cached']:
+        print("♻️  Reusing cached test build, west skipped")
+    elif result['ok']:
+        print("✅ Zephyr native_sim test build successful!")
+    else:
+        print("❌ Zephyr test build failed!")
+        print_build_failure(result)
+        return None, current_suite
+    return result['exe'], current_suite
+
+
+def load_build_options(env=None, project_dir=None, pio_env=None):
+    """Return the west_build() keyword options configured for this env"""
+    cache_enabled = str(get_option('cache', 'yes', env, project_dir, pio_env)).lower()
+    ccache_mode = str(get_option('ccache', 'auto', env, project_dir, pio_env)).lower()
+    ccache_dir = None
+    if ccache_mode not in ('0', 'no', 'false'):
+        if find_ccache():
+            ccache_dir = os.path.expanduser(get_option('ccache_dir', DEFAULT_CCACHE_DIR, env,
+                                                       project_dir, pio_env))
+        elif ccache_mode != 'auto':
+            print("⚠️  ccache requested but not found on PATH, building without it")
+    return {
+        'pristine_mode': get_option('pristine', 'auto', env, project_dir, pio_env),
+        'cache_dir': (os.path.expanduser(get_option('cache_dir', DEFAULT_CACHE_DIR, env,
+                                                    project_dir, pio_env))
+                      if cache_enabled in ('1', 'yes', 'true') else None),
+        'cache_max_size': get_option('cache_max_size', DEFAULT_MAX_SIZE, env, project_dir, pio_env),
+        'ccache_dir': ccache_dir,
+        'timeout': float(get_option('build_timeout', 120, env, project_dir, pio_env)),
+    }
+
+
+def _build_result(name):
+    return {'suite': name, 'ok': False, 'exe': None, 'duration': 0.0, 'cached': False,
+            'pristine': None, 'error': None, 'output_tail': [], 'diagnostics': [],
+            'errors': 0, 'warnings': 0, 'log_path': None, 'ccache': None}
+
+
+def _trace_west_phases(name, start, end, marks, pristine):
+    """Split one west run into configure, compile and link trace spans"""
+    boundaries = [('configure', start), ('compile', marks.get('compile')),
+                  ('link', marks.get('link')), (None, end)]
+    boundaries = [(phase, when) for phase, when in boundaries if when is not None]
+    for (phase, phase_start), (_, phase_end) in zip(boundaries, boundaries[1:]):
+        add_span(phase, int(phase_start * 1e6), int(phase_end * 1e6), suite=name,
+                 pristine=pristine)
+    add_span(f'west build {name}', int(start * 1e6), int(end * 1e6), suite=name)
+
+
+def west_build(name, source_dir, west_build_dir, config_files, source_files, settings,
+               zephyr_workspace, pristine_mode='auto', cache_dir=None,
+               cache_max_size=DEFAULT_MAX_SIZE, ccache_dir=None, timeout=120, cancel_event=None,
+               log=print, progress=None, variant_spec=None):
+    """
+    Build one Zephyr project for native_sim, reusing previous work.
+
+    The artifact cache is checked first; on a hit west is not run at all.
+    Otherwise the input fingerprint decides between a pristine and an
+    incremental west build. West output is streamed: ninja's [n/m] counters
+    go to `progress`, the full log to build.log in the work dir, and only
+    a bounded tail and the compiler diagnostics stay in the result. With
+    ccache_dir set, compilers run through ccache and its hit/miss counters
+    for this build end up in result['ccache']. A variant_spec (see
+    parse_variants) adds its Kconfig lines as EXTRA_CONF_FILE, its flags
+    as EXTRA_CFLAGS and its optional ldflags as NATIVE_SIM_LINK_OPTIONS.
+    The caller holds the lock of the work dir.
+    """
+    result = _build_result(name)
+    start = time.monotonic()
+    settings = dict(settings, ccache=bool(ccache_dir))
+    cmake_args = []
+    if variant_spec:
+        variant_conf = os.path.join(os.path.dirname(west_build_dir), 'variant.conf')
+        os.makedirs(os.path.dirname(variant_conf), exist_ok=True)
+        write_if_changed(variant_conf, ''.join(f'{line}\n' for line in variant_spec['kconfig']))
+        config_files = list(config_files) + [variant_conf]
+        settings['variant_spec'] = variant_spec
+        cmake_args.append(f'-DEXTRA_CONF_FILE={variant_conf}')
+        if variant_spec['cflags']:
+            cmake_args.append(f"-DEXTRA_CFLAGS={' '.join(variant_spec['cflags'])}")
+        if variant_spec.get('ldflags'):
+            cmake_args.append(f"-DNATIVE_SIM_LINK_OPTIONS={';'.join(variant_spec['ldflags'])}")
+    try:
+        with span('fingerprint', suite=name):
+            fingerprint = build_fingerprint(config_files, source_files, settings)
+            key = artifact_key(fingerprint) if cache_dir else None
+            cached_exe = cache_lookup(cache_dir, key) if key else None
+        if key:
+            if cached_exe:
+                log(f"♻️  Artifact cache hit: {key[:16]}")
+                result.update(ok=True, exe=cached_exe, cached=True, pristine='skipped (cached)')
+                return result
+
+        pristine, pristine_reason = choose_pristine(pristine_mode, west_build_dir, fingerprint)
+        result['pristine'] = f'{pristine} ({pristine_reason})'
+        log(f"🔍 Pristine: {result['pristine']}")
+
+        west = resolve_west(zephyr_workspace)
+        if not west:
+            result['error'] = f'west not found in {zephyr_workspace}/.venv or on PATH'
+            return result
+
+        log(f"⚡ Running: west build -b native_sim --pristine {pristine}")
+        west_command = west['argv'] + ['build', '-b', 'native_sim', '-d', west_build_dir,
+                                       '--pristine', pristine, source_dir]
+        west_env = west['env']
+        if pristine == 'always':
+            # Only configure needs it; passing CMake args on every build would
+            # make west re-run CMake even for no-op builds
+            west_command += ['--', f'-DUSE_CCACHE={1 if ccache_dir else 0}'] + cmake_args
+        if ccache_dir:
+            stats_log = os.path.join(os.path.dirname(west_build_dir), CCACHE_STATS_LOG)
+            if os.path.exists(stats_log):
+                os.remove(stats_log)
+            base_dir = os.path.commonpath([os.path.abspath(source_dir), zephyr_workspace])
+            west_env = dict(west_env, **ccache_env(ccache_dir, base_dir, stats_log))
+        output = BuildOutput(os.path.join(os.path.dirname(west_build_dir), 'build.log'),
+                             progress=progress)
+        ninja_offset = 0 if pristine == 'always' else ninja_log_offset(west_build_dir)
+        west_start = time.time()
+        try:
+            returncode = stream_command(west_command, timeout, output.feed, cancel_event,
+                                        cwd=zephyr_workspace, env=west_env)
+        except subprocess.TimeoutExpired:
+            result['error'] = f'build timed out after {timeout:g} seconds'
+            return result
+        except BuildCancelled:
+            result['error'] = 'cancelled'
+            return result
+        finally:
+            output.close()
+            result.update(output_tail=list(output.tail), diagnostics=output.diagnostics,
+                          errors=output.errors, warnings=output.warnings,
+                          log_path=output.log_path)
+            _trace_west_phases(name, west_start, time.time(), output.marks, pristine)
+            add_ninja_log(west_build_dir, ninja_offset, int(time.time() * 1e6), name)
+
+        if output.warnings:
+            log(f"⚠️  {output.warnings} compiler warning(s)")
+        if ccache_dir:
+            result['ccache'] = read_ccache_stats(stats_log)
+            if result['ccache'] and sum(result['ccache']):
+                hits, misses = result['ccache']
+                log(f"🗃️  ccache: {hits} hits, {misses} misses "
+                    f"({hits * 100 // (hits + misses)}% hit rate)")
+        if returncode != 0:
+            result['error'] = f'west build exited with {returncode}'
+            return result
+
+        save_fingerprint(os.path.join(west_build_dir, FINGERPRINT_FILE), fingerprint)
+        zephyr_exe_path = os.path.join(west_build_dir, 'zephyr', 'zephyr.exe')
+        if not os.path.exists(zephyr_exe_path):
+            result['error'] = f'zephyr.exe not found at {zephyr_exe_path}'
+            return result
+
+        if key:
+            with span('cache store', suite=name):
+                cache_store(cache_dir, key, zephyr_exe_path, {'name': name, 'settings': settings},
+                            cache_max_size)
+        result['ok'] = True
+        result['exe'] = zephyr_exe_path
+        return result
+    finally:
+        result['duration'] = time.monotonic() - start
+
+
+def build_app(project_dir, build_dir, zephyr_workspace, variant='release', debug=False,
+              log=print, **build_options):
+    """Build the application in <project_dir>/zephyr and return a result dict"""
+    zephyr_dir = os.path.join(project_dir, 'zephyr')
+    work_dir = west_work_dir(build_dir, 'app', variant)
+    west_build_dir = os.path.join(work_dir, 'build')
+    work_lock = acquire_lock(work_dir)
+    try:
+        log(f"🏗️  West build dir: {west_build_dir}")
+        return west_build(
+            'app', zephyr_dir, west_build_dir,
+            config_files=collect_sources([zephyr_dir], extensions=None),
+            source_files=collect_sources([os.path.join(project_dir, d)
+                                          for d in ('src', 'lib', 'include')]),
+            settings={
+                'board': 'native_sim',
+                'app_dir': zephyr_dir,
+                'variant': variant,
+                'debug': debug,
+                'zephyr_revision': zephyr_revision(zephyr_workspace),
+            },
+            zephyr_workspace=zephyr_workspace, log=log, **build_options)
+    finally:
+        release_lock(work_lock)
+
+
+def _build_test_project(project_dir, build_dir, name, suites, unity_path, zephyr_workspace,
+                        prj_conf, variant, debug, log, suite_index, **build_options):
+    """
+    Generate a test project for `suites` in the work dir `name` and build it.
+
+    Without a suite index the suites' own main() runs the tests; with one,
+    a runner is generated from the test_* functions it lists.
+    """
+    work_dir = west_work_dir(build_dir, name, variant)
+    west_build_dir = os.path.join(work_dir, 'build')
+    test_zephyr_dir = os.path.join(work_dir, 'app')
+    work_lock = acquire_lock(work_dir)
+    try:
+        os.makedirs(test_zephyr_dir, exist_ok=True)
+        log(f"🏗️  West build dir: {west_build_dir}")
+
+        settings = {
+            'board': 'native_sim',
+            'app_dir': test_zephyr_dir,
+            'unity_path': unity_path,
+            'test_folder': ','.join(suites) if suites else '*',
+            'variant': variant,
+            'debug': debug,
+            'zephyr_revision': zephyr_revision(zephyr_workspace),
+        }
+        runner_files = []
+        with span('generate project', suite=name):
+            cmake_path = os.path.join(test_zephyr_dir, 'CMakeLists.txt')
+            if suite_index:
+                test_names = [test for suite in suites
+                              for _, test, _ in suite_index['suites'][suite]['test_functions']]
+                duplicates = sorted({test for test in test_names if test_names.count(test) > 1})
+                if duplicates:
+                    return dict(_build_result(name),
+                                error=f"test functions defined by several suites: "
+                                      f"{', '.join(duplicates)}")
+                runner_path = os.path.join(test_zephyr_dir, 'test_runner.c')
+                if write_if_changed(runner_path, render_test_runner(project_dir, suite_index,
+                                                                    suites)):
+                    log(f"📝 Generated test runner: {runner_path}")
+                runner_files = [runner_path]
+                settings['runner'] = 'generated'
+                cmake = render_runner_cmake(project_dir, unity_path, suites, runner_path, debug)
+            else:
+                cmake = render_test_cmake(project_dir, unity_path, suites[0] if suites else None,
+                                          debug)
+            if write_if_changed(cmake_path, cmake):
+                log(f"📝 Created CMakeLists.txt: {cmake_path}")
+            else:
+                log(f"📝 CMakeLists.txt unchanged: {cmake_path}")
+
+            prj_conf_path = os.path.join(test_zephyr_dir, 'prj.conf')
+            if write_if_changed(prj_conf_path, prj_conf):
+                log(f"📝 Created prj.conf: {prj_conf_path}")
+            else:
+                log(f"📝 prj.conf unchanged: {prj_conf_path}")
+
+        test_roots = ([os.path.join(project_dir, 'test', suite) for suite in suites] if suites
+                      else [os.path.join(project_dir, 'test')])
+        result = west_build(
+            name, test_zephyr_dir, west_build_dir,
+            config_files=[cmake_path, prj_conf_path],
+            # The runner changes with the test list, which ninja handles
+            # incrementally, so it counts as a source rather than config
+            source_files=runner_files + collect_sources(test_roots + [
+                os.path.join(project_dir, 'lib'),
+                os.path.join(project_dir, 'test', 'include_shims'),
+                os.path.join(unity_path, 'src'),
+            ]),
+            settings=settings,
+            zephyr_workspace=zephyr_workspace, log=log, **build_options)
+        if result['ok'] and not result['cached'] and suites:
+            with span('record dependencies', suite=name):
+                record_dependencies(project_dir, west_build_dir, suites)
+        return result
+    finally:
+        release_lock(work_lock)
+
+
+def build_test_suite(project_dir, build_dir, suite, unity_path, zephyr_workspace,
+                     prj_conf=TEST_PRJ_CONF, variant='release', debug=False, log=print,
+                     suite_index=None, **build_options):
+    """
+    Generate the Zephyr project of one test suite and build it with west.
+
+    suite=None builds every test/test_*.c into one binary. With a
+    suite_index the suite's runner is generated instead of using its own
+    main(). Returns a result dict with the suite name, 'ok', the path of
+    the built 'exe', the build 'duration', whether it came from the
+    artifact cache and, on failure, the 'error' and captured west output.
+    """
+    return _build_test_project(project_dir, build_dir, suite or 'all_tests',
+                               [suite] if suite else None, unity_path, zephyr_workspace,
+                               prj_conf, variant, debug, log, suite_index, **build_options)
+
+
+def build_combined_tests(project_dir, build_dir, suite_index, unity_path, zephyr_workspace,
+                         prj_conf=TEST_PRJ_CONF, variant='release', debug=False, log=print,
+                         **build_options):
+    """
+    Build every suite of the index into one executable with a generated
+    runner: one kernel build and one link for the whole test tree.
+
+    Run a subset with -testargs --suite=<suite>[,<suite>...] and
+    --test=<test>[,<test>...]. Returns a result dict named 'combined'.
+    """
+    return _build_test_project(project_dir, build_dir, 'combined', sorted(suite_index['suites']),
+                               unity_path, zephyr_workspace, prj_conf, variant, debug, log,
+                               suite_index, **build_options)
+
+
+def build_bench_suite(project_dir, build_dir, suite, zephyr_workspace, prj_conf=BENCH_PRJ_CONF,
+                      variant='release', debug=False, log=print, **build_options):
+    """
+    Generate the Zephyr project of one bench/bench_* suite and build it
+    with west. Returns a result dict like build_test_suite().
+    """
+    work_dir = west_work_dir(build_dir, suite, variant)
+    west_build_dir = os.path.join(work_dir, 'build')
+    bench_zephyr_dir = os.path.join(work_dir, 'app')
+    work_lock = acquire_lock(work_dir)
+    try:
+        os.makedirs(bench_zephyr_dir, exist_ok=True)
+        log(f"🏗️  West build dir: {west_build_dir}")
+        with span('generate project', suite=suite):
+            cmake_path = os.path.join(bench_zephyr_dir, 'CMakeLists.txt')
+            if write_if_changed(cmake_path, render_bench_cmake(project_dir, suite, debug)):
+                log(f"📝 Created CMakeLists.txt: {cmake_path}")
+            prj_conf_path = os.path.join(bench_zephyr_dir, 'prj.conf')
+            if write_if_changed(prj_conf_path, prj_conf):
+                log(f"📝 Created prj.conf: {prj_conf_path}")
+
+        return west_build(
+            suite, bench_zephyr_dir, west_build_dir,
+            config_files=[cmake_path, prj_conf_path],
+            source_files=collect_sources([os.path.join(project_dir, 'bench', suite),
+                                          os.path.join(project_dir, 'bench', 'include'),
+                                          os.path.join(project_dir, 'lib')]),
+            settings={
+                'board': 'native_sim',
+                'app_dir': bench_zephyr_dir,
+                'bench_folder': suite,
+                'variant': variant,
+                'debug': debug,
+                'zephyr_revision': zephyr_revision(zephyr_workspace),
+            },
+            zephyr_workspace=zephyr_workspace, log=log, **build_options)
+    finally:
+        release_lock(work_lock)
+
+
+def _clone_file(source_path, dest_path):
+    """Create dest_path as a reflink (copy-on-write clone) of source_path"""
+    with open(source_path, 'rb') as source, open(dest_path, 'wb') as dest:
+        fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+
+
+def publish_artifact(source_path, dest_paths):
+    """
+    Publish one built executable under every path in dest_paths.
+
+    Each alias is created under a temporary name next to its destination,
+    as a hardlink to the source, else a reflink, else a hardlink to the
+    single physical copy made for the first alias that needed one. It is
+    then renamed over the destination with os.replace, which never fails
+    with "Text file busy": a running executable keeps its old inode.
+    Linking to the west output is safe because the linker unlinks an
+    existing zephyr.exe before writing a new one.
+    Returns how the content was published: 'hardlink', 'reflink' or 'copy'.
+    """
+    os.chmod(source_path, 0o755)
+    method = 'hardlink'
+    physical_copy = None
+    for dest_path in dest_paths:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        if os.path.exists(dest_path) and os.path.samefile(source_path, dest_path):
+            # Already published, e.g. an unchanged cache hit
+            continue
+        temp_path = f'{dest_path}.{os.getpid()}.tmp'
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+        linked = False
+        for target in (source_path, physical_copy):
+            if target is None:
+                continue
+            try:
+                os.link(target, temp_path)
+                linked = True
+                break
+            except OSError:
+                continue
+
+        if not linked:
+            try:
+                _clone_file(source_path, temp_path)
+                method = 'reflink' if method == 'hardlink' else method
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+                physical_copy = dest_path
+                method = 'copy'
+            os.chmod(temp_path, 0o755)
+
+        os.replace(temp_path, dest_path)
+    return method
+
+
+def unpublish_tests(build_dir, suites):
+    """
+    Remove the published test executables: test_runner.exe, firmware.bin
+    and <build_dir>/<suite>/test_runner.exe for each of suites.
+
+    Called when no suite needs building, so that PlatformIO finds nothing
+    to run instead of an executable left over from an earlier build.
+    Returns the removed paths.
+    """
+    paths = [os.path.join(build_dir, 'test_runner.exe'), os.path.join(build_dir, 'firmware.bin')]
+    paths += [os.path.join(build_dir, suite, 'test_runner.exe') for suite in suites]
+    removed = []
+    lock = acquire_lock(build_dir)
+    try:
+        for path in paths:
+            if os.path.lexists(path):
+                os.remove(path)
+                removed.append(path)
+    finally:
+        release_lock(lock)
+    return removed
+
+
+def build_all_test_suites(project_dir, build_dir, suites, unity_path, zephyr_workspace,
+                          jobs, fail_fast=False, cancel_event=None, **build_options):
+    """
+    Build several test suites concurrently, each in its own west build dir.
+
+    At most `jobs` west builds run at a time. With fail_fast the first
+    failure cancels the queued suites and kills the running builds, as does
+    setting cancel_event. Each successful suite is published to
+    <build_dir>/<suite>/test_runner.exe. Returns the list of result dicts
+    in suite order.
+    """
+    cancel_event = cancel_event or threading.Event()
+    results = {}
+
+    def build(suite):
+        if cancel_event.is_set():
+            return dict(_build_result(suite), error='cancelled')
+        return build_test_suite(project_dir, build_dir, suite, unity_path, zephyr_workspace,
+                                cancel_event=cancel_event, log=lambda message: None,
+                                **build_options)
+
+    print(f"🧵 Building {len(suites)} test suites with {jobs} parallel jobs")
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(build, suite): suite for suite in suites}
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['suite']] = result
+            if result['ok']:
+                with span('publish', suite=result['suite']):
+                    publish_artifact(result['exe'],
+                                     [os.path.join(build_dir, result['suite'], 'test_runner.exe')])
+                source = ' (cached)' if result['cached'] else ''
+                print(f"✅ {result['suite']} built in {result['duration']:.1f}s{source}")
+            elif result['error'] != 'cancelled':
+                print(f"❌ {result['suite']} failed: {result['error']}")
+                if fail_fast and not cancel_event.is_set():
+                    print("🛑 Fail-fast: cancelling remaining suites")
+                    cancel_event.set()
+
+    ordered = [results[suite] for suite in suites]
+    print_build_report(ordered)
+    return ordered
+
+
+def print_build_report(results, tail_lines=40):
+    """Print one aggregated report for a multi-suite build"""
+    print("📊 Test suite build report")
+    for result in results:
+        if result['cached']:
+            status = '♻️  CACHED   '
+        elif result['ok']:
+            status = '✅ OK       '
+        elif result['error'] == 'cancelled':
+            status = '⏭️  CANCELLED'
+        else:
+            status = '❌ FAILED   '
+        pristine = f" pristine={result['pristine']}" if result['pristine'] else ''
+        ccache = ''
+        if result['ccache'] and sum(result['ccache']):
+            ccache = f" ccache={result['ccache'][0]}/{sum(result['ccache'])}"
+        print(f"   {status} {result['suite']:<30} {result['duration']:6.1f}s{pristine}{ccache}")
+
+    for result in results:
+        if result['ok'] or result['error'] == 'cancelled':
+            continue
+        print_build_failure(result, tail_lines)
+
+    built = sum(1 for result in results if result['ok'])
+    print(f"🎯 {built}/{len(results)} test suites built")
+    hits = sum(result['ccache'][0] for result in results if result['ccache'])
+    misses = sum(result['ccache'][1] for result in results if result['ccache'])
+    if hits + misses:
+        print(f"🗃️  ccache: {hits} hits, {misses} misses ({hits * 100 // (hits + misses)}% hit rate)")
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Optional build daemon for the native_sim pre-scripts.
+
+Run it once per project and leave it running:
+
+    python3 scripts/native_sim_daemon.py          # serve until idle or stopped
+    python3 scripts/native_sim_daemon.py --stop   # ask a running daemon to exit
+    python3 scripts/native_sim_daemon.py --status
+
+The pre-scripts send their build request over a Unix socket and stream
+the output back; when no daemon is listening they build in-process as
+before. The daemon runs the same builders, so west, CMake and ninja still
+start afresh for every build. What it saves is per-process Python work:
+the west lookup, the compiler version and ccache probes and the digests of
+the sources it fingerprinted, so a rebuild after touching lib/ only hashes
+what changed. On the daemon_build benchmark that is within the noise of
+a direct one-file-change build.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_common import (build_all_test_suites, build_app, build_bench_suite,
+                               build_combined_tests, build_test_suite, get_option)
+
+BUILDERS = {
+    'app': build_app,
+    'test': build_test_suite,
+    'suites': build_all_test_suites,
+    'combined': build_combined_tests,
+    'bench': build_bench_suite,
+}
+
+
+def _socket_dir():
+    """
+    Return this user's socket directory, created with mode 0700 under
+    XDG_RUNTIME_DIR or the temp dir. Raises OSError when the existing one
+    is a symlink, belongs to another user or is open to other users.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    socket_dir = os.path.join(runtime_dir, f'pio_native_sim-{os.getuid()}')
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(socket_dir)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            stat.S_IMODE(info.st_mode) & 0o077):
+        raise OSError(f'{socket_dir} must be a directory owned by uid {os.getuid()} '
+                      f'with mode 0700')
+    return socket_dir
+
+
+def daemon_socket_path(project_dir):
+    """Return the socket of a project's daemon, short enough for AF_UNIX"""
+    project_hash = hashlib.sha256(os.path.abspath(project_dir).encode()).hexdigest()[:12]
+    return os.path.join(_socket_dir(), f'{project_hash}.sock')
+
+
+def _peer_uid(client, socket_path):
+    """Return the uid of the process serving a connected socket"""
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        return struct.unpack('3i', credentials)[1]
+    return os.lstat(socket_path).st_uid
+
+
+def _connect(project_dir):
+    """
+    Connect to the project's daemon. Returns None when none is listening
+    or it is not run by this user, whose results could not be trusted.
+    """
+    try:
+        socket_path = daemon_socket_path(project_dir)
+    except OSError as e:
+        print(f"⚠️  Ignoring the native_sim daemon: {e}")
+        return None
+    if not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        uid = _peer_uid(client, socket_path)
+    except OSError:
+        # Stale socket of a daemon that is gone
+        client.close()
+        return None
+    if uid != os.getuid():
+        print(f"⚠️  Ignoring the native_sim daemon on {socket_path}: run by uid {uid}")
+        client.close()
+        return None
+    return client
+
+
+def daemon_build(project_dir, kind, env=None, pio_env=None, log=print, progress=None, **args):
+    """
+    Run build_app ('app'), build_test_suite ('test'), build_all_test_suites
+    ('suites'), build_combined_tests ('combined') or build_bench_suite
+    ('bench') for project_dir in the project's daemon with the given
+    keyword arguments.
+
+    Output is forwarded to log and ninja progress to progress. Returns the
+    builder's result, or None when the daemon is disabled with the `daemon`
+    option or not running, in which case the caller builds directly.
+    """
+    if str(get_option('daemon', 'auto', env, project_dir, pio_env)).lower() in ('0', 'no', 'false'):
+        return None
+    client = _connect(project_dir)
+    if client is None:
+        return None
+
+    log("🔌 Building through the native_sim daemon")
+    with client, client.makefile('rwb') as stream:
+        request = {'kind': kind, 'args': dict(args, project_dir=project_dir)}
+        stream.write(json.dumps(request).encode() + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'log' in message:
+                log(message['log'])
+            elif 'progress' in message:
+                if progress:
+                    progress(*message['progress'])
+            elif 'result' in message:
+                return message['result']
+            elif 'error' in message:
+                log(f"⚠️  Daemon build failed ({message['error']}), building directly")
+                return None
+    log("⚠️  Daemon closed the connection, building directly")
+    return None
+
+
+class _LineWriter:
+    """File-like object turning print() output into 'log' messages"""
+
+    def __init__(self, send):
+        self.send = send
+        self.pending = ''
+
+    def write(self, text):
+        self.pending += text
+        *lines, self.pending = self.pending.split('\n')
+        for line in lines:
+            self.send({'log': line})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _BuildHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # A client checking the daemon is there, or one that gave up
+            return
+        request = json.loads(line)
+        if request.get('kind') == 'stop':
+            self.server.stopping = True
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            self._send({'result': 'stopping'})
+            return
+        if request.get('kind') == 'status':
+            self._send({'result': {'pid': os.getpid(), 'builds': self.server.builds,
+                                   'started': self.server.started}})
+            return
+
+        cancel_event = threading.Event()
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                try:
+                    self._send(message)
+                except OSError:
+                    # The pre-script went away, e.g. Ctrl-C: stop its build
+                    cancel_event.set()
+
+        args = dict(request['args'], cancel_event=cancel_event)
+        if request['kind'] != 'suites':
+            args.update(log=lambda message: send({'log': message}),
+                        progress=lambda *step: send({'progress': step}))
+
+        # One build at a time: print() output is redirected per request
+        with self.server.build_lock:
+            self.server.last_activity = time.monotonic()
+            try:
+                with contextlib.redirect_stdout(_LineWriter(send)):
+                    result = BUILDERS[request['kind']](**args)
+            except Exception as e:
+                send({'error': f'{type(e).__name__}: {e}'})
+                return
+            finally:
+                self.server.builds += 1
+                self.server.last_activity = time.monotonic()
+        send({'result': result})
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+
+class _DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(project_dir, idle_timeout):
+    """Serve build requests until stopped or idle for idle_timeout seconds"""
+    try:
+        socket_path = daemon_socket_path(project_dir)
+    except OSError as e:
+        print(f"❌ Error: {e}")
+        return 1
+    if _connect(project_dir):
+        print(f"❌ A native_sim daemon is already running on {socket_path}")
+        return 1
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = _DaemonServer(socket_path, _BuildHandler)
+    server.build_lock = threading.Lock()
+    server.builds = 0
+    server.started = time.time()
+    server.last_activity = time.monotonic()
+    server.stopping = False
+
+    def watch_idle():
+        while not server.stopping:
+            time.sleep(5)
+            idle = time.monotonic() - server.last_activity
+            if idle_timeout and idle > idle_timeout and not server.build_lock.locked():
+                print(f"💤 Idle for {idle:.0f}s, stopping")
+                server.stopping = True
+                server.shutdown()
+
+    threading.Thread(target=watch_idle, daemon=True).start()
+    print(f"🔌 native_sim daemon for {project_dir} listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    print(f"👋 native_sim daemon stopped after {server.builds} build(s)")
+    return 0
+
+
+def _request(project_dir, kind):
+    client = _connect(project_dir)
+    if client is None:
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps({'kind': kind}).encode() + b'\n')
+        stream.flush()
+        line = stream.readline()
+    return json.loads(line)['result'] if line else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--project-dir', default=os.environ.get('PROJECT_DIR', os.getcwd()))
+    parser.add_argument('--idle-timeout', type=int, default=3600,
+                        help='exit after this many idle seconds, 0 to never exit')
+    parser.add_argument('--stop', action='store_true', help='stop the running daemon')
+    parser.add_argument('--status', action='store_true', help='show the running daemon')
+    options = parser.parse_args()
+    project_dir = os.path.abspath(options.project_dir)
+
+    if options.stop or options.status:
+        status = _request(project_dir, 'stop' if options.stop else 'status')
+        if status is None:
+            print("💤 No native_sim daemon running")
+            return 1
+        if options.stop:
+            print("👋 native_sim daemon stopping")
+        else:
+            print(f"🔌 native_sim daemon pid {status['pid']}, {status['builds']} build(s) served")
+        return 0
+    return serve(project_dir, options.idle_timeout)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Per-suite dependency graph from the compiler's dependency records, and
+change-impact selection of the test suites to build and run
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+from collections import defaultdict
+
+DEPS_FILE = os.path.join('.pio', 'native_sim_deps.json')
+LAST_RUN_FILE = os.path.join('.pio', 'native_sim_last_run.json')
+DEPS_VERSION = 1
+
+DEPENDENCY_EXTENSIONS = ('.c', '.cc', '.cpp', '.h', '.hpp', '.S')
+# Inputs every suite is built from, besides its sources: a change to one
+# of these selects every suite
+GLOBAL_INPUTS = ('platformio.ini', 'prj.conf', 'CMakeLists.txt')
+GLOBAL_EXTENSIONS = ('.conf', '.overlay', '.cmake')
+GLOBAL_DIRS = ('scripts',)
+
+INCLUDE_RE = re.compile(r'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+
+def _unit(path):
+    """Return the lib/<name> or test/<name> folder a project file belongs to"""
+    parts = path.split('/')
+    if len(parts) > 2 and parts[0] in ('lib', 'test'):
+        return '/'.join(parts[:2])
+    return None
+
+
+def _project_path(path, base_dir, project_dir):
+    path = os.path.normpath(os.path.join(base_dir, path))
+    relative_path = os.path.relpath(path, project_dir)
+    if relative_path.startswith('..') or relative_path.startswith('.pio'):
+        return None
+    return relative_path.replace(os.sep, '/')
+
+
+def _ninja_deps(west_build_dir, project_dir):
+    """
+    Return {source: {files}} from ninja's deps log, the headers the
+    compiler reported (-MD) for every object, limited to project files
+    """
+    ninja = shutil.which('ninja')
+    if not ninja or not os.path.exists(os.path.join(west_build_dir, '.ninja_deps')):
+        return None
+    try:
+        output = subprocess.run([ninja, '-C', west_build_dir, '-t', 'deps'],
+                                capture_output=True, text=True, timeout=60).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    # "<object>: #deps N, ..." then the indented inputs, the source first
+    deps = {}
+    source = None
+    expect_source = False
+    for line in output.splitlines():
+        if not line.strip():
+            source = None
+        elif not line[0].isspace():
+            source = None
+            expect_source = True
+        else:
+            path = _project_path(line.strip(), west_build_dir, project_dir)
+            if expect_source:
+                expect_source = False
+                source = path
+                if source:
+                    deps.setdefault(source, {source})
+            elif source and path:
+                deps[source].add(path)
+    return deps or None
+
+
+def _compile_commands_deps(west_build_dir, project_dir):
+    """
+    Return {source: {files}} from compile_commands.json, following the
+    quoted #includes of project files through the command's -I dirs
+    """
+    try:
+        with open(os.path.join(west_build_dir, 'compile_commands.json')) as f:
+            commands = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    deps = {}
+    for entry in commands:
+        directory = entry.get('directory', west_build_dir)
+        source_path = os.path.normpath(os.path.join(directory, entry['file']))
+        source = _project_path(source_path, directory, project_dir)
+        if not source:
+            continue
+        arguments = entry.get('arguments') or shlex.split(entry.get('command', ''))
+        include_dirs = []
+        for index, argument in enumerate(arguments):
+            if argument == '-I' and index + 1 < len(arguments):
+                include_dirs.append(os.path.join(directory, arguments[index + 1]))
+            elif argument.startswith('-I'):
+                include_dirs.append(os.path.join(directory, argument[2:]))
+
+        files = {source}
+        pending = [source_path]
+        while pending:
+            path = pending.pop()
+            try:
+                with open(path, errors='replace') as f:
+                    includes = INCLUDE_RE.findall(f.read())
+            except OSError:
+                continue
+            for include in includes:
+                for include_dir in [os.path.dirname(path)] + include_dirs:
+                    header_path = os.path.normpath(os.path.join(include_dir, include))
+                    if os.path.isfile(header_path):
+                        header = _project_path(header_path, include_dir, project_dir)
+                        if header and header not in files:
+                            files.add(header)
+                            pending.append(header_path)
+                        break
+        deps[source] = files
+    return deps or None
+
+
+def suite_dependencies(source_deps, suites):
+    """
+    Return {suite: [files]}, the project files each suite is built from.
+
+    A suite depends on the sources under test/<suite> and the headers they
+    include; including a header of lib/<name> pulls in every source of
+    that library and, in turn, what those include. This is also how one
+    combined executable is split back into its suites.
+    """
+    unit_sources = defaultdict(list)
+    for source in source_deps:
+        unit_sources[_unit(source)].append(source)
+
+    graph = {}
+    for suite in suites:
+        files = set()
+        seen = set()
+        pending = [f'test/{suite}']
+        while pending:
+            unit = pending.pop()
+            if unit in seen:
+                continue
+            seen.add(unit)
+            for source in unit_sources.get(unit, ()):
+                for path in source_deps[source]:
+                    files.add(path)
+                    if (_unit(path) or '').startswith('lib/'):
+                        pending.append(_unit(path))
+        graph[suite] = sorted(files)
+    return graph
+
+
+def _update_json(path, update):
+    """Read-modify-write a JSON file under a lock shared by every process"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.lock', 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        data = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            pass
+        data = update(data)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+
+
+def record_dependencies(project_dir, west_build_dir, suites):
+    """
+    Record the files `suites` were built from, after a west build of them.
+
+    ninja's deps log (the compiler's -MD output) is read first; without
+    ninja, compile_commands.json and the sources' quoted #includes are
+    used. Suites whose build left neither keep their previous entry.
+    """
+    source_deps = (_ninja_deps(west_build_dir, project_dir) or
+                   _compile_commands_deps(west_build_dir, project_dir))
+    if not source_deps or not suites:
+        return None
+    graph = suite_dependencies(source_deps, suites)
+
+    def update(data):
+        if data.get('version') != DEPS_VERSION:
+            data = {'version': DEPS_VERSION, 'suites': {}}
+        data['suites'].update(graph)
+        return data
+
+    _update_json(os.path.join(project_dir, DEPS_FILE), update)
+    return graph
+
+
+def load_dependencies(project_dir):
+    """Return the recorded {suite: [files]} graph of a project"""
+    try:
+        with open(os.path.join(project_dir, DEPS_FILE)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data.get('suites', {}) if data.get('version') == DEPS_VERSION else {}
+
+
+def _is_global_input(path):
+    return (path in GLOBAL_INPUTS or path.endswith(GLOBAL_EXTENSIONS) or
+            path.split('/')[0] in GLOBAL_DIRS)
+
+
+def _global_inputs(project_dir):
+    return sorted(name for name in os.listdir(project_dir)
+                  if os.path.isfile(os.path.join(project_dir, name)) and _is_global_input(name))
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _lib_sources(project_dir):
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(project_dir, 'lib')):
+        dirnames.sort()
+        sources.extend(os.path.relpath(os.path.join(dirpath, filename), project_dir)
+                       .replace(os.sep, '/')
+                       for filename in sorted(filenames)
+                       if filename.endswith(DEPENDENCY_EXTENSIONS))
+    return sources
+
+
+def git_changed_files(project_dir, revision):
+    """
+    Return the project files changed since a git revision, committed or
+    not, plus untracked ones; None when git cannot tell
+    """
+    try:
+        changed = subprocess.run(['git', 'diff', '--name-only', '--relative', revision, '--'],
+                                 cwd=project_dir, capture_output=True, text=True, check=True)
+        untracked = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard'],
+                                   cwd=project_dir, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return sorted(set(changed.stdout.split()) | set(untracked.stdout.split()))
+
+
+def _affected_by_files(graph, suites, changed):
+    """Return the suites whose build reads one of the `changed` files"""
+    known_files = {path for files in graph.values() for path in files}
+    affected = {suite for suite in suites if suite not in graph}
+    for path in changed:
+        if _is_global_input(path) or (path.endswith(DEPENDENCY_EXTENSIONS) and
+                                      path not in known_files and
+                                      not path.startswith('test/')):
+            return set(suites)
+        unit = _unit(path)
+        affected.update(suite for suite in suites
+                        if path in graph.get(suite, ()) or unit == f'test/{suite}')
+    return affected
+
+
+def _affected_since_last_run(project_dir, graph, suites):
+    """Return the suites with an input that differs from their last passing run"""
+    try:
+        with open(os.path.join(project_dir, LAST_RUN_FILE)) as f:
+            last_run = json.load(f)
+    except (OSError, ValueError):
+        return set(suites)
+    if last_run.get('lib_sources') != _lib_sources(project_dir):
+        return set(suites)
+
+    digests = {}
+    affected = set()
+    for suite in suites:
+        recorded = last_run.get('suites', {}).get(suite)
+        files = graph.get(suite)
+        if recorded is None or files is None:
+            affected.add(suite)
+            continue
+        for path in sorted(set(files) | set(recorded) | set(_global_inputs(project_dir))):
+            if path not in digests:
+                digests[path] = _digest(os.path.join(project_dir, path))
+            if recorded.get(path) != digests[path]:
+                affected.add(suite)
+                break
+    return affected
+
+
+def affected_suites(project_dir, suites, since):
+    """
+    Return the subset of `suites` the changes since `since` can affect,
+    in order, or None to select every suite.
+
+    `since` is the `affected` option: '' selects everything, 'last'
+    compares each suite's inputs with its last passing run (see
+    record_last_run) and anything else is a git revision to diff the tree
+    against. Suites the graph does not know yet are always selected;
+    changes to global inputs (platformio.ini, *.conf, CMakeLists.txt and,
+    against a revision, scripts/) or to lib/ sources no suite has been
+    built from select every suite.
+    """
+    since = str(since or '').strip()
+    if since.lower() in ('', '0', 'no', 'false'):
+        return None
+    graph = load_dependencies(project_dir)
+    if since == 'last':
+        affected = _affected_since_last_run(project_dir, graph, suites)
+    else:
+        changed = git_changed_files(project_dir, since)
+        if changed is None:
+            print(f"⚠️  Cannot diff against {since}, selecting every suite")
+            return None
+        affected = _affected_by_files(graph, suites, changed)
+    return [suite for suite in suites if suite in affected]
+
+
+def record_last_run(project_dir, results):
+    """
+    Record the input digests of every suite that passed (or was reused
+    from the result cache) and forget those that did not, for
+    affected=last
+    """
+    graph = load_dependencies(project_dir)
+    global_inputs = _global_inputs(project_dir)
+
+    def update(data):
+        suites = data.get('suites', {})
+        for result in results:
+            files = graph.get(result['suite'])
+            if result['ok'] and files is not None:
+                suites[result['suite']] = {
+                    path: _digest(os.path.join(project_dir, path))
+                    for path in sorted(set(files) | set(global_inputs))}
+            else:
+                suites.pop(result['suite'], None)
+        return {'suites': suites, 'lib_sources': _lib_sources(project_dir)}
+
+    _update_json(os.path.join(project_dir, LAST_RUN_FILE), update)
+
+
+def print_selection(suites, selected, since):
+    """Print which suites the change-impact selection kept"""
+    skipped = [suite for suite in suites if suite not in selected]
+    label = 'the last passing run' if since == 'last' else since
+    print(f"🎯 {len(selected)} of {len(suites)} suites affected by changes since {label}")
+    if skipped:
+        print(f"⏭️  Unaffected, not run: {', '.join(skipped)}")
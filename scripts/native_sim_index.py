@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Persistent index of the project's Unity test suites
+"""
+
+import base64
+import json
+import os
+import re
+
+from native_sim_common import SOURCE_EXTENSIONS, file_digest
+
+INDEX_FILE = os.path.join('.pio', 'native_sim_suites.json')
+INDEX_VERSION = 2
+
+RUN_TEST_RE = re.compile(r'\bRUN_TEST\s*\(\s*(\w+)')
+# "void test_something(void)" definitions and the Unity hooks a suite defines
+TEST_FUNCTION_RE = re.compile(r'^\s*void\s+(test_\w+)\s*\(\s*(?:void)?\s*\)\s*\{?\s*$', re.MULTILINE)
+HOOK_RE = re.compile(r'^\s*void\s+(setUp|tearDown)\s*\(\s*(?:void)?\s*\)', re.MULTILINE)
+
+
+def _scan_source(path):
+    """
+    Return the test functions a C file passes to RUN_TEST, the
+    [name, line] of the test_* functions it defines and its Unity hooks
+    """
+    with open(path, errors='replace') as f:
+        content = f.read()
+    functions = [[match.group(1), content.count('\n', 0, match.start(1)) + 1]
+                 for match in TEST_FUNCTION_RE.finditer(content)]
+    return RUN_TEST_RE.findall(content), functions, sorted(set(HOOK_RE.findall(content)))
+
+
+def _index_suite(suite_dir, previous):
+    """
+    Index one suite folder, reusing the entries of files whose mtime and
+    size did not change since `previous`.
+    """
+    previous_files = previous.get('files', {}) if previous else {}
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(suite_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(SOURCE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(path, suite_dir)
+            stat = os.stat(path)
+            entry = previous_files.get(relative_path)
+            if not entry or (entry['mtime_ns'], entry['size']) != (stat.st_mtime_ns, stat.st_size):
+                tests, functions, hooks = (_scan_source(path) if filename.endswith('.c')
+                                           else ([], [], []))
+                entry = {
+                    'mtime_ns': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'sha256': file_digest(path),
+                    'tests': tests,
+                    'test_functions': functions,
+                    'hooks': hooks,
+                }
+            files[relative_path] = entry
+    return {
+        'files': files,
+        'tests': [test for entry in files.values() for test in entry['tests']],
+        'test_functions': [[relative_path, name, line]
+                           for relative_path, entry in files.items()
+                           for name, line in entry['test_functions']],
+        'hooks': sorted({hook for entry in files.values() for hook in entry['hooks']}),
+    }
+
+
+def load_suite_index(project_dir):
+    """
+    Return the suite index of a project, refreshed against the tree.
+
+    The index maps every test/test_* folder to its source files (with
+    content hashes), the RUN_TEST functions found in them, the test_*
+    functions they define and the Unity hooks (setUp/tearDown). It is kept
+    in .pio/native_sim_suites.json; only files whose mtime or size changed
+    are re-read, and the file is only rewritten when something changed.
+    """
+    index_path = os.path.join(project_dir, INDEX_FILE)
+    previous = {}
+    try:
+        with open(index_path) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if previous.get('version') != INDEX_VERSION:
+        previous = {}
+    previous_suites = previous.get('suites', {})
+
+    test_dir = os.path.join(project_dir, 'test')
+    suites = {}
+    if os.path.isdir(test_dir):
+        for name in sorted(os.listdir(test_dir)):
+            suite_dir = os.path.join(test_dir, name)
+            if name.startswith('test_') and os.path.isdir(suite_dir):
+                suites[name] = dict(_index_suite(suite_dir, previous_suites.get(name)),
+                                    folder=os.path.join('test', name))
+
+    index = {'version': INDEX_VERSION, 'suites': suites}
+    if index != previous:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(temp_path, index_path)
+    return index
+
+
+def suite_names(index):
+    """Return the sorted names of the indexed suites"""
+    return sorted(index['suites'])
+
+
+def resolve_suite(index, scons_env=None, argv=None):
+    """
+    Return the suite PlatformIO is building or testing, or None.
+
+    PIOTEST_RUNNING_NAME (raw or base64 encoded, from the SCons env or the
+    process environment) is checked first, then the command line; only
+    names present in the index are accepted. A project with a single suite
+    resolves to it.
+    """
+    suites = index['suites']
+    candidates = []
+    for running_name in ((scons_env.get('PIOTEST_RUNNING_NAME', '') if scons_env else ''),
+                         os.environ.get('PIOTEST_RUNNING_NAME', '')):
+        if not running_name:
+            continue
+        candidates.append(running_name)
+        try:
+            candidates.append(base64.b64decode(running_name, validate=True).decode())
+        except (ValueError, UnicodeDecodeError):
+            pass
+    candidates.extend(argv or [])
+
+    for candidate in candidates:
+        name = os.path.basename(candidate.strip().rstrip(os.sep))
+        if name in suites:
+            return name
+    if len(suites) == 1:
+        return next(iter(suites))
+    return None
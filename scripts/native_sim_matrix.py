@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Build the app, the test suites or the benchmarks under several build
+variants and compare them.
+
+    python3 scripts/native_sim_matrix.py bench                      # variants from platformio.ini
+    python3 scripts/native_sim_matrix.py test --variants "Os, O2, O2+lto"
+    python3 scripts/native_sim_matrix.py app --variants "Os, tiny=Os+tiny.conf"
+
+Variants come from --variants or the `variants` option (see
+parse_variants in native_sim_common). Each one builds in its own west
+build dir, .pio/build/<env>/west/<name>-<variant>, and goes through the
+artifact cache like any other build, so re-running the matrix only
+rebuilds what changed. The comparison table shows the size of every
+executable and, for tests and benchmarks, their run times; it is also
+written to matrix_report.json in the env's build dir.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_bench import bench_suite_names, run_bench_suite
+from native_sim_common import (BENCH_PRJ_CONF, TEST_PRJ_CONF, build_app, build_bench_suite,
+                               build_test_suite, find_unity, get_option, load_build_options,
+                               parse_variants, zephyr_workspace_dir)
+from native_sim_index import load_suite_index, suite_names
+from native_sim_runner import run_suite, suite_run_options
+
+DEFAULT_ENVS = {'app': 'native_sim', 'test': 'native_sim_test', 'bench': 'native_sim_bench'}
+MATRIX_REPORT = 'matrix_report.json'
+
+SIZE_RE = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\d+)\s+\d+')
+
+
+def executable_size(path):
+    """
+    Return the {'text', 'data', 'bss'} section sizes of an ELF executable
+    from binutils' size, or just its 'file' size when size is unavailable
+    """
+    try:
+        output = subprocess.run(['size', path], capture_output=True, text=True,
+                                timeout=30).stdout.splitlines()
+    except (OSError, subprocess.SubprocessError):
+        output = []
+    match = SIZE_RE.match(output[1]) if len(output) > 1 else None
+    if match:
+        return dict(zip(('text', 'data', 'bss'), (int(value) for value in match.groups())))
+    return {'file': os.path.getsize(path)}
+
+
+def build_target(kind, target, variant, project_dir, build_dir, zephyr_workspace, build_options):
+    """Build one app/suite/benchmark for one variant, return the build result"""
+    options = dict(build_options, variant=variant['name'], variant_spec=variant, debug=False,
+                   log=lambda message: None)
+    if kind == 'app':
+        return build_app(project_dir, build_dir, zephyr_workspace, **options)
+    if kind == 'bench':
+        return build_bench_suite(project_dir, build_dir, target, zephyr_workspace,
+                                 prj_conf=BENCH_PRJ_CONF, **options)
+    return build_test_suite(project_dir, build_dir, target, find_unity(project_dir),
+                            zephyr_workspace, prj_conf=TEST_PRJ_CONF, **options)
+
+
+def time_target(kind, target, executable, run_dir, run_options):
+    """Return {column: seconds or ns} of one run of a built test suite or benchmark"""
+    if kind == 'bench':
+        result = run_bench_suite(target, executable, run_options['timeout'])
+        if not result['ok']:
+            return None
+        return {name: stats['median_ns'] for name, stats in result['benchmarks'].items()}
+    result = run_suite(target, executable, run_dir, run_options['timeout'],
+                       sim_time=run_options['sim_time'], stop_at=run_options['stop_at'],
+                       stop_pattern=run_options['stop_pattern'],
+                       idle_timeout=run_options['idle_timeout'])
+    if not result['ok']:
+        return None
+    return {'run': result['duration']}
+
+
+def print_matrix(kind, rows):
+    """Print the comparison table, one section per app/suite"""
+    unit = 'ns' if kind == 'bench' else 's'
+    print(f"📊 Variant matrix ({kind}, sizes of the native_sim executables)")
+    for target in dict.fromkeys(row['target'] for row in rows):
+        target_rows = [row for row in rows if row['target'] == target]
+        columns = list(dict.fromkeys(column for row in target_rows
+                                     for column in (row['timings'] or {})))
+        size_keys = next((list(row['size']) for row in target_rows if row['size']), [])
+        header = (f"   {'variant':<16}" + ''.join(f'{key:>10}' for key in size_keys) +
+                  f"{'Δsize':>8}" + ''.join(f'{column[-22:]:>24}' for column in columns))
+        print(f"🎯 {target}")
+        print(header)
+        reference = next((row for row in target_rows if row['size']), None)
+        for row in target_rows:
+            if not row['ok']:
+                print(f"   {row['variant']:<16} ❌ {row['error']}")
+                continue
+            line = f"   {row['variant']:<16}" + ''.join(f"{row['size'].get(key, 0):>10}"
+                                                       for key in size_keys)
+            reference_total = sum(reference['size'].values())
+            change = (sum(row['size'].values()) - reference_total) / reference_total \
+                if reference_total else 0.0
+            line += f"{'-' if row is reference else f'{change:+.1%}':>8}"
+            for column in columns:
+                value = (row['timings'] or {}).get(column)
+                line += f"{'-' if value is None else f'{value:.3f}{unit}':>24}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('kind', choices=sorted(DEFAULT_ENVS), help='what to build')
+    parser.add_argument('--variants', help='variants to build, default: the variants option')
+    parser.add_argument('--suites', help='comma separated suites or benchmarks, default: all')
+    parser.add_argument('--env', help='PlatformIO env whose options and build dir are used')
+    parser.add_argument('--no-run', action='store_true', help='only build and compare sizes')
+    parser.add_argument('--project-dir', default=os.environ.get('PROJECT_DIR', os.getcwd()))
+    options = parser.parse_args()
+
+    project_dir = os.path.abspath(options.project_dir)
+    pio_env = options.env or DEFAULT_ENVS[options.kind]
+    build_dir = os.path.join(project_dir, '.pio', 'build', pio_env)
+    try:
+        variants = parse_variants(options.variants or get_option('variants', '', None,
+                                                                 project_dir, pio_env),
+                                  project_dir)
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        return 1
+    if not variants:
+        print("❌ Error: No variants given, use --variants or custom_native_sim_variants")
+        return 1
+
+    if options.kind == 'app':
+        targets = ['app']
+    else:
+        available = (bench_suite_names(project_dir) if options.kind == 'bench'
+                     else suite_names(load_suite_index(project_dir)))
+        targets = ([suite.strip() for suite in options.suites.split(',') if suite.strip()]
+                   if options.suites else available)
+        unknown = [target for target in targets if target not in available]
+        if unknown or not targets:
+            print(f"❌ Error: Unknown suite(s): {', '.join(unknown) or 'none found'}")
+            return 1
+    if options.kind == 'test' and not find_unity(project_dir):
+        print("❌ Error: Unity library not found. Please ensure Unity is installed.")
+        return 1
+
+    zephyr_workspace = zephyr_workspace_dir(None, project_dir, pio_env)
+    build_options = load_build_options(None, project_dir, pio_env)
+    try:
+        run_options = suite_run_options(targets, project_dir, pio_env, timeout=120)
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        return 1
+    print(f"🧮 Building {', '.join(targets)} in {len(variants)} variants: "
+          f"{', '.join(variant['name'] for variant in variants)}")
+
+    rows = []
+    for target in targets:
+        for variant in variants:
+            row = {'target': target, 'variant': variant['name'], 'spec': variant, 'ok': False,
+                   'size': None, 'timings': None, 'error': None, 'cached': False}
+            rows.append(row)
+            result = build_target(options.kind, target, variant, project_dir, build_dir,
+                                  zephyr_workspace, build_options)
+            if not result['ok']:
+                row['error'] = f"build failed: {result['error']}"
+                print(f"❌ {target} [{variant['name']}] {row['error']}")
+                continue
+            row.update(ok=True, size=executable_size(result['exe']), cached=result['cached'])
+            source = ' (cached)' if result['cached'] else ''
+            print(f"✅ {target} [{variant['name']}] built in {result['duration']:.1f}s{source}")
+            if options.kind == 'app' or options.no_run:
+                continue
+            # Benchmarks and tests run one at a time so the timings do not interfere
+            row['timings'] = time_target(options.kind, target, result['exe'],
+                                         os.path.join(build_dir, 'matrix', target,
+                                                      variant['name']),
+                                         run_options[target])
+            if row['timings'] is None:
+                row.update(ok=False, error='run failed')
+                print(f"❌ {target} [{variant['name']}] run failed")
+
+    print_matrix(options.kind, rows)
+    report_path = os.path.join(build_dir, MATRIX_REPORT)
+    os.makedirs(build_dir, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump({'kind': options.kind, 'rows': rows}, f, indent=2)
+        f.write('\n')
+    print(f"📄 Matrix report: {report_path}")
+    return 0 if all(row['ok'] for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
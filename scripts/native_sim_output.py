@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Streaming handling of west/ninja build output for the native_sim scripts
+"""
+
+import os
+import re
+import selectors
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+
+# "[12/345] Building C object ..." as printed by ninja
+NINJA_PROGRESS_RE = re.compile(r'^\[(\d+)/(\d+)\]\s*(.*)$')
+
+# GCC/Clang diagnostics: "path/file.c:12:5: error: message"
+DIAGNOSTIC_RE = re.compile(
+    r'^(?P<file>[^\s:][^:]*):(?P<line>\d+):(?:(?P<column>\d+):)?\s*'
+    r'(?P<severity>fatal error|error|warning):\s*(?P<message>.*)$')
+
+# Linker and CMake failures that do not follow the compiler format
+OTHER_ERROR_RE = re.compile(r'undefined reference to|multiple definition of|^CMake Error')
+
+
+class BuildCancelled(Exception):
+    """Raised when a build is stopped because another suite failed"""
+
+
+class OutputIdle(Exception):
+    """Raised when a command printed nothing for idle_timeout seconds"""
+
+
+class BuildOutput:
+    """
+    Consume build output one line at a time.
+
+    Keeps only the last `tail_lines` lines in memory, collects up to
+    `max_diagnostics` compiler errors and warnings, forwards ninja's [n/m]
+    counters to `progress` and writes the full log to `log_path`. The
+    wall-clock times of the first ninja step and of the link step are kept
+    in `marks` to split the build into configure, compile and link phases.
+    """
+
+    def __init__(self, log_path=None, tail_lines=200, max_diagnostics=100, progress=None):
+        self.tail = deque(maxlen=tail_lines)
+        self.diagnostics = []
+        self.max_diagnostics = max_diagnostics
+        self.errors = 0
+        self.warnings = 0
+        self.steps = None
+        self.marks = {}
+        self.progress = progress
+        self.log_path = log_path
+        self.log_file = None
+        if log_path:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self.log_file = open(log_path, 'w')
+
+    def feed(self, line):
+        self.tail.append(line)
+        if self.log_file:
+            self.log_file.write(line + '\n')
+
+        match = NINJA_PROGRESS_RE.match(line)
+        if match:
+            self.steps = (int(match.group(1)), int(match.group(2)))
+            self.marks.setdefault('compile', time.time())
+            if match.group(3).startswith('Linking'):
+                self.marks.setdefault('link', time.time())
+            if self.progress:
+                self.progress(self.steps[0], self.steps[1], match.group(3))
+            return
+
+        match = DIAGNOSTIC_RE.match(line)
+        if match:
+            severity = 'warning' if match.group('severity') == 'warning' else 'error'
+            self._add_diagnostic({
+                'file': match.group('file'),
+                'line': int(match.group('line')),
+                'column': int(match.group('column')) if match.group('column') else None,
+                'severity': severity,
+                'message': match.group('message'),
+            })
+        elif OTHER_ERROR_RE.search(line):
+            self._add_diagnostic({'file': None, 'line': None, 'column': None,
+                                  'severity': 'error', 'message': line.strip()})
+
+    def _add_diagnostic(self, diagnostic):
+        if diagnostic['severity'] == 'warning':
+            self.warnings += 1
+        else:
+            self.errors += 1
+        if len(self.diagnostics) < self.max_diagnostics:
+            self.diagnostics.append(diagnostic)
+
+    def close(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+
+def print_progress(done, total, description):
+    """Show ninja progress: one live line on a terminal, every 10% otherwise"""
+    percent = done * 100 // total if total else 100
+    if sys.stdout.isatty():
+        end = '\n' if done == total else ''
+        print(f"\r\033[K🔨 [{done}/{total}] {percent:3d}% {description[:70]}", end=end, flush=True)
+    elif done == total or percent // 10 != (done - 1) * 100 // total // 10:
+        print(f"🔨 [{done}/{total}] {percent}%", flush=True)
+
+
+def _stop_process_group(process, grace=2):
+    """SIGTERM a process group, then SIGKILL it if it is still there after `grace` seconds"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            return process.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            pass
+    return process.wait()
+
+
+def stream_command(command, timeout, on_line, cancel_event=None, idle_timeout=None, **kwargs):
+    """
+    Run a command (an argv list) and hand every output line to on_line as
+    it arrives.
+
+    stderr is merged into stdout. The command runs in its own process group
+    so that a timeout or a cancellation stops everything it started, not
+    only the direct child. Returns the exit code.
+
+    When on_line returns True the command is asked to stop (SIGTERM, then
+    SIGKILL) and None is returned. With idle_timeout, a command that prints
+    nothing for that many seconds is killed and OutputIdle is raised.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, start_new_session=True, **kwargs)
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    deadline = time.monotonic() + timeout
+    last_output = time.monotonic()
+    pending = b''
+    try:
+        while True:
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            idle = idle_timeout and time.monotonic() - last_output > idle_timeout
+            if cancelled or idle or time.monotonic() > deadline:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+                if cancelled:
+                    raise BuildCancelled(command)
+                if idle:
+                    raise OutputIdle(command, idle_timeout)
+                raise subprocess.TimeoutExpired(command, timeout)
+
+            if not selector.select(timeout=0.5):
+                continue
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            last_output = time.monotonic()
+            *lines, pending = (pending + chunk).split(b'\n')
+            for line in lines:
+                if on_line(line.decode(errors='replace').rstrip('\r')):
+                    _stop_process_group(process)
+                    return None
+        if pending and on_line(pending.decode(errors='replace').rstrip('\r')):
+            _stop_process_group(process)
+            return None
+        return process.wait()
+    finally:
+        selector.close()
+        process.stdout.close()
+
+
+def print_build_failure(result, tail_lines=40):
+    """Print the diagnostics summary and the output tail of a failed build"""
+    print(f"❌ {result['suite']}: {result['error']}")
+    if result['diagnostics']:
+        print(f"🩺 {result['errors']} error(s), {result['warnings']} warning(s):")
+        for diagnostic in result['diagnostics']:
+            if diagnostic['severity'] != 'error':
+                continue
+            location = ''
+            if diagnostic['file']:
+                location = f"{diagnostic['file']}:{diagnostic['line']}: "
+            print(f"   {location}{diagnostic['message']}")
+    if result['output_tail']:
+        print(f"--- last {min(tail_lines, len(result['output_tail']))} lines of build output ---")
+        for line in result['output_tail'][-tail_lines:]:
+            print(line)
+    if result['log_path']:
+        print(f"📄 Full build log: {result['log_path']}")
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Profile the native_sim application or a test suite on the host.
+
+    python3 scripts/native_sim_profile.py app                     # perf, 999 Hz
+    python3 scripts/native_sim_profile.py test --suite test_sum --profiler gprof
+    python3 scripts/native_sim_profile.py app --exe .pio/build/native_sim/firmware.bin
+
+native_sim is an ordinary host process, so the firmware logic can be
+profiled with the host's own tools. The profile variant (see
+profile_variant in native_sim_common) is built first, through the
+artifact cache, unless --exe names an executable already built with
+NATIVE_SIM_PROFILE. The executable then runs under perf (sampling,
+unwinding through frame pointers) or writes gmon.out for gprof (-pg
+instrumentation), with the env's sim_time and stop_at options so it ends
+on its own. The result goes to .pio/build/<env>/profile/<target>/:
+
+    profile.folded   folded stacks, one "root;...;leaf count" line each,
+                     for flamegraph.pl, speedscope or inferno
+    flamegraph.svg   a flamegraph, hover a frame for its time; src/ and
+                     lib/ functions are drawn in blue
+    profile.json     the time of every src/ and lib/ function
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_common import (PROFILE_MODES, TEST_PRJ_CONF, build_app, build_test_suite,
+                               find_unity, get_option, load_build_options, profile_variant,
+                               zephyr_workspace_dir)
+from native_sim_index import load_suite_index, suite_names
+from native_sim_runner import native_sim_args, suite_run_options
+
+DEFAULT_ENVS = {'app': 'native_sim', 'test': 'native_sim_test'}
+PROJECT_SOURCE_DIRS = ('src', 'lib')
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp')
+
+# A function definition starting at the beginning of a line, its body
+# opening after the parameter list (possibly on the next line)
+FUNCTION_DEF_RE = re.compile(r'^[A-Za-z_][\w \t\*]*?\b([A-Za-z_]\w*)\s*\([^;{}()]*\)\s*\{',
+                             re.MULTILINE)
+NOT_FUNCTIONS = {'if', 'for', 'while', 'switch', 'return', 'sizeof'}
+
+# `perf script` call chain line: address, symbol+offset, (dso)
+PERF_FRAME_RE = re.compile(r'^\s+[0-9a-f]+\s+(.+?)\s+\((.*)\)\s*$')
+PERF_OFFSET_RE = re.compile(r'\+0x[0-9a-f]+$')
+# gprof call graph: primary line "[3]  40.0  0.02  0.00  5  sum [3]" and
+# parent/child lines "0.02  0.00  5/5  main [1]"
+GPROF_PRIMARY_RE = re.compile(r'^\[(\d+)\]\s+[\d.]+\s+([\d.]+)\s+([\d.]+)\s+'
+                              r'(?:[\d+]+\s+)?(.+?) \[\d+\]$')
+GPROF_RELATIVE_RE = re.compile(r'^\s+(?:[\d.]+\s+[\d.]+\s+)?(\d+)(?:/\d+)?\s+(.+?) \[\d+\]$')
+
+SVG_WIDTH = 1200
+SVG_FRAME_HEIGHT = 16
+SVG_MIN_WIDTH = 0.1
+
+
+def base_symbol(name):
+    """Return a symbol without GCC's clone suffixes, e.g. sum.constprop.0 -> sum"""
+    return name.split('.', 1)[0] if not name.startswith('.') else name
+
+
+def project_functions(project_dir):
+    """Return {function: path relative to the project} for src/ and lib/"""
+    functions = {}
+    for top in PROJECT_SOURCE_DIRS:
+        for root, dirs, files in os.walk(os.path.join(project_dir, top)):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith(SOURCE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path, errors='replace') as f:
+                        source = f.read()
+                except OSError:
+                    continue
+                for match in FUNCTION_DEF_RE.finditer(source):
+                    if match.group(1) not in NOT_FUNCTIONS:
+                        functions.setdefault(match.group(1), os.path.relpath(path, project_dir))
+    return functions
+
+
+def fold_perf_script(text):
+    """Fold `perf script` output into {'root;...;leaf': samples}"""
+    folded = {}
+    frames = []
+    for line in text.splitlines() + ['']:
+        match = PERF_FRAME_RE.match(line)
+        if match:
+            symbol = PERF_OFFSET_RE.sub('', match.group(1))
+            if symbol == '[unknown]':
+                symbol = f'[{os.path.basename(match.group(2))}]'
+            frames.append(symbol.replace(';', ':'))
+        elif not line.strip() and frames:
+            stack = ';'.join(reversed(frames))
+            folded[stack] = folded.get(stack, 0) + 1
+            frames = []
+    return folded
+
+
+def parse_gprof_graph(text):
+    """
+    Parse the call graph of `gprof -b -q` into {function: {'self': seconds,
+    'parents': {parent: calls}}}
+    """
+    graph = {}
+    parents = {}
+    primary_seen = False
+    for line in text.splitlines():
+        if line.startswith('-----'):
+            parents, primary_seen = {}, False
+            continue
+        primary = GPROF_PRIMARY_RE.match(line)
+        if primary:
+            graph[primary.group(4)] = {'self': float(primary.group(2)), 'parents': parents}
+            primary_seen = True
+            continue
+        relative = GPROF_RELATIVE_RE.match(line)
+        if relative and not primary_seen:
+            parents[relative.group(2)] = parents.get(relative.group(2), 0) + int(relative.group(1))
+    return graph
+
+
+def fold_gprof(graph, max_depth=64):
+    """
+    Fold a gprof call graph into {'root;...;leaf': microseconds}.
+
+    gprof records only caller/callee pairs, so like gprof itself this
+    assumes every call to a function costs the same: its self time is
+    split over its callers in proportion to their calls, recursively.
+    """
+    folded = {}
+
+    def walk(function, path, weight):
+        parents = {parent: calls for parent, calls in graph[function]['parents'].items()
+                   if parent in graph and parent not in path}
+        total = sum(parents.values())
+        if not total or len(path) >= max_depth:
+            stack = ';'.join(reversed(path))
+            folded[stack] = folded.get(stack, 0) + weight
+            return
+        for parent, calls in parents.items():
+            walk(parent, path + [parent], weight * calls / total)
+
+    for function, node in graph.items():
+        if node['self'] > 0:
+            walk(function, [function], node['self'] * 1e6)
+    return {stack: int(round(value)) for stack, value in folded.items() if round(value) > 0}
+
+
+def attribute(folded, functions):
+    """
+    Return the time of every src/ and lib/ function in the folded stacks,
+    most expensive first: 'self' where it is the leaf, 'total' where it is
+    anywhere in the stack
+    """
+    total = sum(folded.values()) or 1
+    rows = {}
+    for stack, count in folded.items():
+        frames = [base_symbol(frame) for frame in stack.split(';')]
+        for position, frame in enumerate(frames):
+            if frame not in functions or frame in frames[:position]:
+                continue
+            row = rows.setdefault(frame, {'function': frame, 'file': functions[frame],
+                                          'self': 0, 'total': 0})
+            row['total'] += count
+        if frames[-1] in functions:
+            rows[frames[-1]]['self'] += count
+    for row in rows.values():
+        row.update(self_pct=row['self'] / total, total_pct=row['total'] / total)
+    return sorted(rows.values(), key=lambda row: (-row['self'], -row['total'], row['function']))
+
+
+def render_flamegraph(folded, functions, title, unit):
+    """Return an SVG flamegraph of folded stacks, root at the bottom"""
+    root = {'value': 0, 'children': {}}
+    for stack, count in folded.items():
+        root['value'] += count
+        node = root
+        for frame in stack.split(';'):
+            node = node['children'].setdefault(frame, {'value': 0, 'children': {}})
+            node['value'] += count
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node['children'].values()), default=0)
+
+    levels = depth(root)
+    height = (levels + 2) * SVG_FRAME_HEIGHT
+    scale = SVG_WIDTH / (root['value'] or 1)
+    rects = []
+
+    def draw(name, node, x, level):
+        width = node['value'] * scale
+        if width < SVG_MIN_WIDTH:
+            return
+        y = height - (level + 1) * SVG_FRAME_HEIGHT
+        if name is None:
+            name, fill = 'all', 'rgb(200,200,200)'
+        elif base_symbol(name) in functions:
+            fill = f'rgb(80,{130 + zlib.crc32(name.encode()) % 60},220)'
+        else:
+            seed = zlib.crc32(name.encode())
+            fill = f'rgb({205 + seed % 50},{80 + (seed >> 8) % 130},{(seed >> 16) % 55})'
+        label = name if name == 'all' else \
+            f"{name}{f' ({functions[base_symbol(name)]})' if base_symbol(name) in functions else ''}"
+        share = node['value'] / (root['value'] or 1)
+        text = label[:int(width / 7)] if width > 21 else ''
+        if text != label and text:
+            text = text[:-2] + '..'
+        rects.append(f'<g><title>{html.escape(label)} ({node["value"]:,} {unit}, {share:.2%})'
+                     f'</title><rect x="{x:.2f}" y="{y}" width="{width:.2f}" '
+                     f'height="{SVG_FRAME_HEIGHT - 1}" fill="{fill}" rx="2"/>'
+                     f'<text x="{x + 3:.2f}" y="{y + SVG_FRAME_HEIGHT - 4}">'
+                     f'{html.escape(text)}</text></g>')
+        child_x = x
+        for child_name, child in sorted(node['children'].items()):
+            draw(child_name, child, child_x, level + 1)
+            child_x += child['value'] * scale
+
+    draw(None, root, 0.0, 0)
+    return (f'<?xml version="1.0" standalone="no"?>\n'
+            f'<svg version="1.1" width="{SVG_WIDTH}" height="{height}" '
+            f'xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="11">\n'
+            f'<rect width="100%" height="100%" fill="rgb(250,250,245)"/>\n'
+            f'<text x="{SVG_WIDTH / 2}" y="{SVG_FRAME_HEIGHT}" text-anchor="middle" '
+            f'font-size="14">{html.escape(title)}</text>\n' + '\n'.join(rects) + '\n</svg>\n')
+
+
+def run_perf(executable, args, out_dir, timeout, frequency, call_graph):
+    """Sample one run with perf, return the folded stacks in samples"""
+    data_path = os.path.join(out_dir, 'perf.data')
+    record = subprocess.run(['perf', 'record', '-F', str(frequency), '--call-graph', call_graph,
+                             '-o', data_path, '--', executable] + args,
+                            cwd=out_dir, capture_output=True, text=True, timeout=timeout)
+    if not os.path.exists(data_path):
+        raise RuntimeError(f"perf record failed ({record.returncode}): "
+                           f"{record.stderr.strip()[-500:]}")
+    script = subprocess.run(['perf', 'script', '-i', data_path], cwd=out_dir,
+                            capture_output=True, text=True, timeout=timeout)
+    if script.returncode:
+        raise RuntimeError(f"perf script failed: {script.stderr.strip()[-500:]}")
+    return fold_perf_script(script.stdout)
+
+
+def run_gprof(executable, args, out_dir, timeout):
+    """Run a -pg executable, return gprof's folded call graph in microseconds"""
+    gmon_path = os.path.join(out_dir, 'gmon.out')
+    if os.path.exists(gmon_path):
+        os.remove(gmon_path)
+    subprocess.run([executable] + args, cwd=out_dir, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, timeout=timeout)
+    if not os.path.exists(gmon_path):
+        raise RuntimeError("no gmon.out written: the executable must be built with -pg "
+                           "(profile = gprof) and exit on its own, e.g. with stop_at")
+    report = subprocess.run(['gprof', '-b', '-q', executable, gmon_path], cwd=out_dir,
+                            capture_output=True, text=True, timeout=timeout)
+    if report.returncode:
+        raise RuntimeError(f"gprof failed: {report.stderr.strip()[-500:]}")
+    with open(os.path.join(out_dir, 'gprof.txt'), 'w') as f:
+        f.write(report.stdout)
+    return fold_gprof(parse_gprof_graph(report.stdout))
+
+
+def print_attribution(rows, unit, total):
+    """Print the time of the src/ and lib/ functions"""
+    print(f"📊 {'function':<32} {'file':<32} {'self':>8} {'total':>8}")
+    for row in rows[:25]:
+        print(f"   {row['function']:<32} {row['file']:<32} {row['self_pct']:>8.1%} "
+              f"{row['total_pct']:>8.1%}")
+    own = sum(row['self'] for row in rows)
+    print(f"   src/ and lib/ code: {own / (total or 1):.1%} of {total:,} {unit} "
+          f"(self time); the rest is Zephyr, the native simulator and libc")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('kind', choices=sorted(DEFAULT_ENVS), help='what to profile')
+    parser.add_argument('--suite', help='test suite to profile, required with several suites')
+    parser.add_argument('--profiler', choices=PROFILE_MODES,
+                        help='default: the profile option when it names one, else perf')
+    parser.add_argument('--exe', help='profile this executable instead of building one')
+    parser.add_argument('--env', help='PlatformIO env whose options and build dir are used')
+    parser.add_argument('--frequency', type=int, default=999, help='perf samples per second')
+    parser.add_argument('--call-graph', default='fp',
+                        help="perf's unwinder: fp (frame pointers) or dwarf")
+    parser.add_argument('--timeout', type=float, default=300, help='wall-clock limit of the run')
+    parser.add_argument('--project-dir', default=os.environ.get('PROJECT_DIR', os.getcwd()))
+    parser.add_argument('args', nargs='*', help='extra native_sim args, after --')
+    options = parser.parse_args()
+
+    project_dir = os.path.abspath(options.project_dir)
+    pio_env = options.env or DEFAULT_ENVS[options.kind]
+    build_dir = os.path.join(project_dir, '.pio', 'build', pio_env)
+    profiler = options.profiler or str(get_option('profile', '', None, project_dir,
+                                                  pio_env)).strip().lower()
+    if profiler not in PROFILE_MODES:
+        profiler = 'perf'
+    if not shutil.which(profiler):
+        print(f"❌ Error: {profiler} not found on PATH")
+        return 1
+
+    target = 'app'
+    if options.kind == 'test':
+        available = suite_names(load_suite_index(project_dir))
+        if options.suite:
+            target = options.suite
+        elif len(available) == 1:
+            target = available[0]
+        else:
+            print(f"❌ Error: Pick a suite with --suite: {', '.join(available) or 'none found'}")
+            return 1
+        if target not in available:
+            print(f"❌ Error: Unknown suite: {target}")
+            return 1
+
+    executable = os.path.abspath(options.exe) if options.exe else None
+    if not executable:
+        spec = profile_variant(profiler)
+        build_options = dict(load_build_options(None, project_dir, pio_env),
+                             variant=spec['name'], variant_spec=spec, debug=False)
+        zephyr_workspace = zephyr_workspace_dir(None, project_dir, pio_env)
+        print(f"🔨 Building {target} [{spec['name']}]: {' '.join(spec['cflags'])}")
+        if options.kind == 'app':
+            result = build_app(project_dir, build_dir, zephyr_workspace, **build_options)
+        else:
+            unity_path = find_unity(project_dir)
+            if not unity_path:
+                print("❌ Error: Unity library not found. Please ensure Unity is installed.")
+                return 1
+            result = build_test_suite(project_dir, build_dir, target, unity_path,
+                                      zephyr_workspace, prj_conf=TEST_PRJ_CONF, **build_options)
+        if not result['ok']:
+            print(f"❌ Build failed: {result['error']}")
+            for line in result['output_tail'][-20:]:
+                print(f"   {line}")
+            return 1
+        executable = result['exe']
+    if not os.path.isfile(executable):
+        print(f"❌ Error: Executable not found: {executable}")
+        return 1
+
+    try:
+        run_options = suite_run_options([] if target == 'app' else [target], project_dir,
+                                        pio_env, timeout=options.timeout)
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        return 1
+    target_options = run_options[None if target == 'app' else target]
+    args = native_sim_args(target_options) + options.args
+    out_dir = os.path.join(build_dir, 'profile', target)
+    os.makedirs(out_dir, exist_ok=True)
+
+    print(f"🔥 Profiling {target} with {profiler}: {executable} {' '.join(args)}")
+    try:
+        if profiler == 'perf':
+            folded = run_perf(executable, args, out_dir, target_options['timeout'],
+                              options.frequency, options.call_graph)
+            unit = 'samples'
+        else:
+            folded = run_gprof(executable, args, out_dir, target_options['timeout'])
+            unit = 'µs'
+    except subprocess.TimeoutExpired:
+        print(f"❌ Error: {target} still running after {target_options['timeout']:g}s; "
+              f"set stop_at or run_timeout")
+        return 1
+    except RuntimeError as e:
+        print(f"❌ Error: {e}")
+        return 1
+    if not folded:
+        print("❌ Error: The profile is empty")
+        return 1
+
+    functions = project_functions(project_dir)
+    rows = attribute(folded, functions)
+    total = sum(folded.values())
+    folded_path = os.path.join(out_dir, 'profile.folded')
+    with open(folded_path, 'w') as f:
+        f.writelines(f'{stack} {count}\n' for stack, count in sorted(folded.items()))
+    svg_path = os.path.join(out_dir, 'flamegraph.svg')
+    with open(svg_path, 'w') as f:
+        f.write(render_flamegraph(folded, functions, f'{target} ({profiler})', unit))
+    with open(os.path.join(out_dir, 'profile.json'), 'w') as f:
+        json.dump({'target': target, 'profiler': profiler, 'executable': executable,
+                   'unit': unit, 'total': total, 'functions': rows}, f, indent=2)
+        f.write('\n')
+
+    print_attribution(rows, unit, total)
+    print(f"📄 Folded stacks: {folded_path}")
+    print(f"📄 Flamegraph: {svg_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
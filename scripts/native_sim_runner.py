@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""
+Concurrent runner for native_sim Unity test executables
+"""
+
+import json
+import math
+import os
+import re
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from native_sim_cache import DEFAULT_RESULT_CACHE_DIR, result_key, result_lookup, result_store
+from native_sim_common import file_digest, get_option
+from native_sim_output import OutputIdle, stream_command
+from native_sim_trace import add_span
+from native_sim_unity import (CASES_JSON, CASES_XML, UNITY_FOOTER_LINES, UNITY_LOG,
+                              UNITY_SUMMARY_RE, UnityOutput)
+
+# Durations kept for every suite and test in the history file
+DURATION_HISTORY = 20
+DURATIONS_FILE = 'test_durations.json'
+# Recorded runs needed before a suite's limits are derived from its history
+HANG_MIN_SAMPLES = 3
+# Environment variables that are part of a test result's cache key
+RESULT_ENV_PREFIXES = ('TEST_', 'UNITY_', 'ZEPHYR_')
+RESULT_ENV_NAMES = ('TZ', 'LANG', 'LC_ALL')
+# Result fields that are not stored in the result cache
+RESULT_CACHE_SKIP = ('executable', 'report_dirs', 'truncated')
+
+
+def find_suite_executables(build_dir, suites=None):
+    """
+    Return (suite, executable) pairs for the per-suite test_runner.exe files
+    published by a multi-suite build, limited to `suites` when given
+    """
+    if not os.path.isdir(build_dir):
+        return []
+    names = suites if suites else sorted(os.listdir(build_dir))
+    executables = []
+    for name in names:
+        executable = os.path.join(build_dir, name, 'test_runner.exe')
+        if name.startswith('test_') and os.path.isfile(executable):
+            executables.append((name, executable))
+    return executables
+
+
+def combined_suite_args(suites):
+    """
+    Return the args that make a combined test executable run only one
+    suite, for every suite: native_sim hands what follows -testargs to the
+    generated runner
+    """
+    return {suite: ['-testargs', f'--suite={suite}'] for suite in suites}
+
+
+def sim_time_args(mode):
+    """
+    Return the native_sim command line args for a `sim_time` mode: 'rt'
+    paces simulated time to wall-clock time (the native_sim default),
+    'no-rt' runs it as fast as possible and a number such as '10' runs it
+    that many times faster than real time
+    """
+    mode = str(mode or 'rt').strip().lower()
+    if mode == 'rt':
+        return []
+    if mode == 'no-rt':
+        return ['--no-rt']
+    try:
+        ratio = float(mode.rstrip('x'))
+    except ValueError:
+        ratio = 0
+    if ratio <= 0:
+        raise ValueError(f"invalid sim_time '{mode}': expected rt, no-rt or a speed-up ratio")
+    return ['--rt', f'--rt-ratio={ratio:g}']
+
+
+def native_sim_args(options):
+    """Return the native_sim args for the sim_time and stop_at run options"""
+    args = sim_time_args(options.get('sim_time'))
+    if options.get('stop_at'):
+        args.append(f"-stop_at={options['stop_at']:g}")
+    return args
+
+
+def suite_run_options(suites, project_dir, pio_env, timeout):
+    """
+    Return {suite: run options} for run_suite, and the env's own options
+    for the key None. Every option can be set per suite with a _<suite>
+    suffix, e.g. custom_native_sim_stop_at_test_sum:
+
+    sim_time: see sim_time_args
+    stop_at: simulated seconds after which native_sim exits on its own
+    stop_pattern: regular expression; the run stops cleanly when an output
+        line matches it
+    idle_timeout: wall-clock seconds without output after which the run is
+        killed and fails
+    run_timeout: wall-clock limit of the run, `timeout` by default
+    hang_factor, hang_min: tighten the limits from the run history, see
+        hang_limits; a hang_factor of 0 keeps the configured limits
+
+    Raises ValueError for an invalid value.
+    """
+    def option(name, default, suite):
+        value = get_option(name, default, project_dir=project_dir, pio_env=pio_env)
+        if suite:
+            value = get_option(f'{name}_{suite}', value, project_dir=project_dir, pio_env=pio_env)
+        return str(value).strip() if value is not None else None
+
+    def seconds(name, default, suite):
+        value = option(name, default, suite)
+        if not value or value.lower() in ('0', 'no', 'none'):
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"invalid {name} '{value}': expected seconds")
+
+    options = {}
+    for suite in [None] + list(suites):
+        pattern = option('stop_pattern', '', suite)
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"invalid stop_pattern '{pattern}': {e}")
+        options[suite] = {
+            'sim_time': option('sim_time', 'rt', suite).lower(),
+            'stop_at': seconds('stop_at', None, suite),
+            'stop_pattern': pattern or None,
+            'idle_timeout': seconds('idle_timeout', None, suite),
+            'timeout': seconds('run_timeout', timeout, suite) or timeout,
+            'hang_factor': seconds('hang_factor', 3, suite),
+            'hang_min': seconds('hang_min', 5, suite) or 0,
+        }
+        native_sim_args(options[suite])
+    return options
+
+
+def suite_test_names(suite_index, suites):
+    """
+    Return {suite: [test function, ...]} from the suite index, the names a
+    generated runner accepts in --test=
+    """
+    return {suite: [name for _, name, _ in suite_index['suites'][suite]['test_functions']]
+            for suite in suites if suite in suite_index['suites']}
+
+
+def run_suite(suite, executable, work_dir, timeout, args=(), echo=False, sim_time='rt',
+              stop_at=None, stop_pattern=None, idle_timeout=None):
+    """
+    Run one test executable, with extra command line args, in its own
+    working directory, parsing its Unity output as it arrives.
+
+    Returns a result dict with the tail of the 'output', the 'returncode',
+    the Unity counters, 'ok', how the run was 'stopped' ('timeout',
+    'idle', 'pattern' or None), whether it 'hung' (stopped by a timeout or
+    for lack of output) and the 'test_times' of every test. The full
+    output and the per-test report files are written to work_dir (see
+    UnityOutput); with echo the output is printed live. The sim_time and
+    stop options are described in suite_run_options.
+    """
+    result = {'suite': suite, 'executable': executable, 'ok': False, 'returncode': None,
+              'timed_out': False, 'stopped': None, 'output': '', 'duration': 0.0,
+              'tests': 0, 'failures': 0, 'ignored': 0, 'errors': 0, 'test_times': {},
+              'report_dirs': [work_dir], 'truncated': False, 'sim_time': sim_time,
+              'hung': False, 'limits': {'timeout': timeout, 'idle_timeout': idle_timeout},
+              'cached': False}
+    command = [executable] + native_sim_args({'sim_time': sim_time, 'stop_at': stop_at})
+    stop_re = re.compile(stop_pattern) if stop_pattern else None
+    output = UnityOutput(suite, work_dir, echo=echo)
+
+    def on_line(line):
+        output.feed(line)
+        return bool(stop_re and stop_re.search(line))
+
+    start = time.monotonic()
+    wall_start = time.time()
+    try:
+        result['returncode'] = stream_command(command + list(args), timeout, on_line,
+                                              idle_timeout=idle_timeout, cwd=work_dir)
+        if result['returncode'] is None:
+            # Stopped on request: a clean end of the run
+            result['returncode'] = 0
+            result['stopped'] = 'pattern'
+    except subprocess.TimeoutExpired:
+        result['returncode'] = -signal.SIGKILL
+        result['timed_out'] = True
+        result['stopped'] = 'timeout'
+    except OutputIdle:
+        result['returncode'] = -signal.SIGKILL
+        result['stopped'] = 'idle'
+    finally:
+        output.close(result['returncode'], result['stopped'])
+    result['duration'] = time.monotonic() - start
+    result['hung'] = result['stopped'] in ('timeout', 'idle')
+    add_span(f'run {suite}', int(wall_start * 1e6), int(time.time() * 1e6), category='test',
+             suite=suite)
+
+    result['output'] = ''.join(line + '\n' for line in output.tail)
+    result['truncated'] = output.lines > len(output.tail)
+    result['test_times'] = output.test_times
+    result['errors'] = output.errors
+    result['tests'], result['failures'], result['ignored'] = output.counters()
+    result['ok'] = (result['stopped'] in (None, 'pattern') and result['returncode'] == 0 and
+                    output.summary is not None and result['failures'] == 0)
+    return result
+
+
+def load_test_durations(history_path):
+    """
+    Return the durations recorded by earlier runs: {'suites': {suite:
+    [seconds, ...]}, 'tests': {suite: {test: [seconds, ...]}}}
+    """
+    history = {}
+    try:
+        with open(history_path) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if not isinstance(history.get('tests'), dict):
+        history = {}
+    history.setdefault('suites', {})
+    history.setdefault('tests', {})
+    return history
+
+
+def record_test_durations(history_path, results, keep=DURATION_HISTORY):
+    """
+    Append the per-test durations of a run to the history file, and the
+    duration of every whole suite run that ended normally
+    """
+    history = load_test_durations(history_path)
+    for result in results:
+        suite_history = history['tests'].setdefault(result['suite'], {})
+        for test, seconds in result['test_times'].items():
+            suite_history[test] = (suite_history.get(test, []) + [round(seconds, 4)])[-keep:]
+        if not result.get('shard') and result['stopped'] in (None, 'pattern'):
+            history['suites'][result['suite']] = (history['suites'].get(result['suite'], []) +
+                                                  [round(result['duration'], 4)])[-keep:]
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    temp_path = f'{history_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+    os.replace(temp_path, history_path)
+
+
+def result_cache_options(project_dir, pio_env):
+    """
+    Return (cache_dir, force) for the `test_cache` option: yes (default),
+    no, or force to re-run every suite and refresh its cached result
+    """
+    mode = str(get_option('test_cache', 'yes', project_dir=project_dir, pio_env=pio_env)).lower()
+    if mode in ('0', 'no', 'false'):
+        return None, False
+    cache_dir = get_option('test_cache_dir', DEFAULT_RESULT_CACHE_DIR, project_dir=project_dir,
+                           pio_env=pio_env)
+    return os.path.expanduser(cache_dir), mode == 'force'
+
+
+def result_cache_key(suite, executable, args, options):
+    """
+    Return the result cache key of a suite run: the executable's content,
+    its native_sim and test args, its stop_pattern and the environment
+    variables that tests may read
+    """
+    env = {name: value for name, value in os.environ.items()
+           if name.startswith(RESULT_ENV_PREFIXES) or name in RESULT_ENV_NAMES}
+    return result_key({'suite': suite, 'executable': file_digest(executable),
+                       'args': native_sim_args(options) + list(args),
+                       'stop_pattern': options.get('stop_pattern'), 'env': env})
+
+
+def cached_result(cache_dir, key):
+    """Return the cached passing result of a suite run, marked 'cached', or None"""
+    hit = result_lookup(cache_dir, key)
+    if not hit:
+        return None
+    result, entry_dir = hit
+    return dict(result, cached=True, report_dirs=[entry_dir], truncated=False)
+
+
+def store_result(cache_dir, key, result):
+    """Cache a passing suite result with its test case reports"""
+    if result['ok'] and not result['cached']:
+        result_store(cache_dir, key, {name: value for name, value in result.items()
+                                      if name not in RESULT_CACHE_SKIP},
+                     result['report_dirs'], (CASES_XML, CASES_JSON))
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of values, e.g. fraction=0.99 for p99"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def hang_limits(options, history, suite):
+    """
+    Return the run_suite keyword args of a suite from its run options,
+    with limits derived from its history when hang_factor is set.
+
+    A suite with HANG_MIN_SAMPLES recorded runs gets a deadline of the p99
+    of its durations times hang_factor, when that is below its timeout.
+    Without a configured idle_timeout, a suite whose tests have history is
+    killed after printing nothing for the p99 of its slowest test times
+    hang_factor. Both limits are at least hang_min seconds.
+    """
+    kwargs = {key: value for key, value in options.items() if not key.startswith('hang_')}
+    factor = options.get('hang_factor')
+    if not factor:
+        return kwargs
+    durations = history['suites'].get(suite, [])
+    if len(durations) >= HANG_MIN_SAMPLES:
+        deadline = max(options['hang_min'], percentile(durations, 0.99) * factor)
+        kwargs['timeout'] = min(kwargs['timeout'], deadline)
+    test_times = [times for times in history['tests'].get(suite, {}).values()
+                  if len(times) >= HANG_MIN_SAMPLES]
+    if test_times and not kwargs.get('idle_timeout'):
+        slowest = max(percentile(times, 0.99) for times in test_times)
+        kwargs['idle_timeout'] = max(options['hang_min'], slowest * factor)
+    return kwargs
+
+
+def plan_shards(tests, durations, shards):
+    """
+    Split tests into at most `shards` disjoint lists of similar total
+    duration: longest first, each onto the least loaded shard. Tests
+    without history count as the mean of the known ones.
+    """
+    means = {test: sum(times) / len(times) for test, times in durations.items() if times}
+    default = sum(means.values()) / len(means) if means else 1.0
+    loads = [[0.0, []] for _ in range(min(shards, len(tests)))]
+    for test in sorted(tests, key=lambda test: -means.get(test, default)):
+        load = min(loads, key=lambda load: load[0])
+        load[0] += means.get(test, default)
+        load[1].append(test)
+    return [sorted(subset, key=tests.index) for _, subset in loads]
+
+
+def merge_shard_results(suite, shard_results):
+    """
+    Merge the results of the shards of one suite into one result whose
+    output ends with a single Unity summary
+    """
+    merged = dict(shard_results[0], suite=suite, test_times={}, output='')
+    outputs = []
+    for index, shard in enumerate(shard_results):
+        outputs.append(f'--- shard {index + 1}/{len(shard_results)} ---\n')
+        outputs.extend(line + '\n' for line in shard['output'].splitlines()
+                       if not UNITY_SUMMARY_RE.search(line) and line not in UNITY_FOOTER_LINES)
+        merged['test_times'].update(shard['test_times'])
+    for key in ('tests', 'failures', 'ignored', 'errors'):
+        merged[key] = sum(shard[key] for shard in shard_results)
+    merged['report_dirs'] = [path for shard in shard_results for path in shard['report_dirs']]
+    merged['truncated'] = any(shard['truncated'] for shard in shard_results)
+    merged['duration'] = max(shard['duration'] for shard in shard_results)
+    merged['timed_out'] = any(shard['timed_out'] for shard in shard_results)
+    merged['stopped'] = next((shard['stopped'] for shard in shard_results if shard['stopped']),
+                             None)
+    merged['hung'] = any(shard['hung'] for shard in shard_results)
+    merged['shard'] = None
+    merged['returncode'] = next((shard['returncode'] for shard in shard_results
+                                 if shard['returncode'] != 0), 0)
+    merged['ok'] = all(shard['ok'] for shard in shard_results)
+    outputs.append('-----------------------\n')
+    outputs.append(f"{merged['tests']} Tests {merged['failures']} Failures "
+                   f"{merged['ignored']} Ignored\n")
+    outputs.append('OK\n' if merged['ok'] else 'FAIL\n')
+    merged['output'] = ''.join(outputs)
+    return merged
+
+
+def run_suites(executables, run_root, jobs, timeout, suite_args=None, shards=1,
+               suite_tests=None, history_path=None, run_options=None, result_cache_dir=None,
+               force=False):
+    """
+    Run (suite, executable) pairs with at most `jobs` processes at a time.
+
+    Each suite runs in <run_root>/<suite>, with the command line args given
+    for it in suite_args. With shards > 1, a suite whose tests are listed in
+    suite_tests is split into that many instances of its executable, each
+    running a disjoint --test= subset balanced by the durations recorded in
+    history_path, and their results are merged. run_options gives the
+    run_suite options of each suite (see suite_run_options), whose own
+    timeout wins over `timeout`. With result_cache_dir, a suite whose
+    executable and runtime inputs passed before is not run and its cached
+    result is returned instead, unless `force`. Results come back in the
+    order of `executables`.
+    """
+    suite_args = suite_args or {}
+    run_options = run_options or {}
+    suite_tests = suite_tests or {}
+    history = load_test_durations(history_path) if history_path else {'suites': {}, 'tests': {}}
+    cache_keys = {}
+    cached = {}
+    runs = []
+    for suite, executable in executables:
+        if result_cache_dir:
+            cache_keys[suite] = result_cache_key(suite, executable, suite_args.get(suite, ()),
+                                                 run_options.get(suite, {}))
+            hit = None if force else cached_result(result_cache_dir, cache_keys[suite])
+            if hit:
+                cached[suite] = hit
+                continue
+        tests = suite_tests.get(suite, [])
+        if shards > 1 and len(tests) > 1:
+            plan = plan_shards(tests, history['tests'].get(suite, {}), shards)
+            for index, subset in enumerate(plan):
+                args = list(suite_args.get(suite, ()))
+                if '-testargs' not in args:
+                    args.append('-testargs')
+                args.append(f"--test={','.join(subset)}")
+                runs.append((suite, executable, os.path.join(run_root, suite, f'shard{index}'),
+                             args, f'{suite} shard {index + 1}/{len(plan)}'))
+        else:
+            runs.append((suite, executable, os.path.join(run_root, suite),
+                         suite_args.get(suite, ()), suite))
+
+    results = [None] * len(runs)
+    run_count = len(executables) - len(cached)
+    if cached:
+        print(f"♻️  {len(cached)} test suites passed before with the same executable and inputs, "
+              f"not re-running them")
+    if runs:
+        print(f"🧵 Running {run_count} test suites"
+              f"{f' as {len(runs)} shards' if len(runs) != run_count else ''} "
+              f"with {jobs} parallel jobs")
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for index, (suite, executable, work_dir, args, _) in enumerate(runs):
+            options = dict({'timeout': timeout}, **run_options.get(suite, {}))
+            futures[executor.submit(run_suite, suite, executable, work_dir, args=args,
+                                    **hang_limits(options, history, suite))] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            results[index] = result = future.result()
+            result['shard'] = runs[index][4] if runs[index][4] != result['suite'] else None
+            status = '⏳' if result['hung'] else '✅' if result['ok'] else '❌'
+            print(f"{status} {runs[index][4]} finished in {result['duration']:.1f}s")
+
+    if history_path:
+        record_test_durations(history_path, results)
+    merged = []
+    for suite, _ in executables:
+        if suite in cached:
+            merged.append(cached[suite])
+            continue
+        shard_results = [result for result in results if result['suite'] == suite]
+        merged.append(merge_shard_results(suite, shard_results) if len(shard_results) > 1
+                      else shard_results[0])
+        if suite in cache_keys:
+            store_result(result_cache_dir, cache_keys[suite], merged[-1])
+    return merged
+
+
+def hang_message(result):
+    """Describe why a hung run was killed"""
+    if result['stopped'] == 'idle':
+        return (f"⏳ {result['suite']} hung: no output for "
+                f"{result['limits']['idle_timeout']:.1f}s, killed after {result['duration']:.1f}s")
+    return (f"⏳ {result['suite']} hung: still running at its "
+            f"{result['limits']['timeout']:.1f}s deadline")
+
+
+def failure_message(result):
+    """Describe why a run that did not hang failed"""
+    if result['failures']:
+        return f"❌ {result['suite']}: {result['failures']} of {result['tests']} tests failed"
+    if result['returncode'] not in (0, None):
+        return f"❌ {result['suite']} exited with code {result['returncode']}"
+    return f"❌ {result['suite']} ended without a Unity summary"
+
+
+def print_run_report(results):
+    """
+    Print every suite's output followed by one merged Unity-style summary.
+
+    Returns the process exit code: 0 when every suite passed, 1 otherwise.
+    """
+    for result in results:
+        print(f"===== {result['suite']} =====")
+        if result['truncated']:
+            print(f"[output truncated, full output in "
+                  f"{', '.join(os.path.join(path, UNITY_LOG) for path in result['report_dirs'])}]")
+        print(result['output'], end='' if result['output'].endswith('\n') else '\n')
+        if result['hung']:
+            print(hang_message(result))
+        elif result['returncode'] != 0:
+            print(f"❌ {result['suite']} exited with code {result['returncode']}")
+
+    tests = sum(result['tests'] for result in results)
+    failures = sum(result['failures'] for result in results)
+    ignored = sum(result['ignored'] for result in results)
+    hung_suites = [result['suite'] for result in results if result['hung']]
+    failed_suites = [result['suite'] for result in results
+                     if not result['ok'] and not result['hung']]
+
+    print("-----------------------")
+    for result in results:
+        status = 'HANG' if result['hung'] else 'PASS' if result['ok'] else 'FAIL'
+        if result['cached']:
+            status += ', cached'
+        print(f"{result['suite']}: {status} ({result['tests']} Tests {result['failures']} Failures "
+              f"{result['ignored']} Ignored, {result['duration']:.1f}s, "
+              f"sim time {result['sim_time']})")
+    print("-----------------------")
+    print(f"{tests} Tests {failures} Failures {ignored} Ignored")
+    if hung_suites:
+        print(f"HANG ({', '.join(hung_suites)})")
+    if failed_suites:
+        print(f"FAIL ({', '.join(failed_suites)})")
+    if hung_suites or failed_suites:
+        return 1
+    print("OK")
+    return 0
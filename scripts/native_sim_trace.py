@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Opt-in Chrome/Perfetto trace of the native_sim build and test phases
+"""
+
+import atexit
+import contextlib
+import fcntl
+import itertools
+import json
+import os
+import threading
+import time
+
+DEFAULT_TRACE_FILE = 'native_sim_trace.json'
+
+_lock = threading.Lock()
+_events = []
+_thread_names = {}
+_lane_tids = {}
+_lane_ids = itertools.count(1 << 20)
+_trace_path = None
+_run_id = None
+
+
+def now_us():
+    return int(time.time() * 1e6)
+
+
+def start_trace(option, build_dir, process_name):
+    """
+    Enable tracing when the `trace` option is set.
+
+    'yes' writes native_sim_trace.json next to the per-env build dirs
+    (.pio/build), any other value is used as the trace path. Events are
+    kept in memory and appended to the file when the process exits, so the
+    build and upload scripts of every env in one pio invocation end up in
+    one trace; the first script of the next invocation replaces it.
+    """
+    global _trace_path, _run_id
+    option = str(option or '').strip()
+    if option.lower() in ('', '0', 'no', 'false'):
+        return None
+    if option.lower() in ('1', 'yes', 'true'):
+        _trace_path = os.path.join(os.path.dirname(os.path.abspath(build_dir)), DEFAULT_TRACE_FILE)
+    else:
+        _trace_path = os.path.abspath(os.path.expanduser(option))
+    _run_id = current_run_id()
+    _events.append({'ph': 'M', 'name': 'process_name', 'pid': os.getpid(), 'tid': 0,
+                    'args': {'name': process_name}})
+    atexit.register(save_trace)
+    print(f"⏱️  Tracing to {_trace_path}")
+    return _trace_path
+
+
+def _proc_stat(pid):
+    """Return (parent pid, start time) of a process from /proc, or None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[1]), int(fields[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _is_pio(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            argv = f.read().decode(errors='replace').split('\0')
+    except OSError:
+        return False
+    return any(os.path.basename(arg) in ('pio', 'platformio') for arg in argv[:3])
+
+
+def current_run_id():
+    """
+    Identify the top-level pio invocation this process runs under: the
+    outermost pio ancestor, else the process group leader, as
+    '<pid>-<start time>' so that a reused pid is still a new run
+    """
+    run_pid = None
+    pid = os.getpid()
+    while pid > 1:
+        stat = _proc_stat(pid)
+        if stat is None:
+            break
+        if _is_pio(pid):
+            run_pid = pid
+        pid = stat[0]
+    if run_pid is None:
+        run_pid = os.getpgrp()
+    stat = _proc_stat(run_pid)
+    return f'{run_pid}-{stat[1] if stat else 0}'
+
+
+def tracing():
+    return _trace_path is not None
+
+
+def _thread_id():
+    thread = threading.current_thread()
+    tid = threading.get_native_id()
+    if tid not in _thread_names:
+        _thread_names[tid] = thread.name
+        _events.append({'ph': 'M', 'name': 'thread_name', 'pid': os.getpid(), 'tid': tid,
+                        'args': {'name': thread.name}})
+    return tid
+
+
+def add_span(name, start_us, end_us, category='build', tid=None, **args):
+    """Record a finished span given as wall-clock microseconds"""
+    if not tracing():
+        return
+    with _lock:
+        _events.append({'ph': 'X', 'name': name, 'cat': category, 'ts': start_us,
+                        'dur': max(0, end_us - start_us), 'pid': os.getpid(),
+                        'tid': _thread_id() if tid is None else tid, 'args': args})
+
+
+@contextlib.contextmanager
+def span(name, category='build', **args):
+    """Record the duration of a with-block; a no-op unless tracing is on"""
+    if not tracing():
+        yield
+        return
+    start = now_us()
+    try:
+        yield
+    finally:
+        add_span(name, start, now_us(), category, **args)
+
+
+def ninja_log_offset(west_build_dir):
+    """Return the current size of .ninja_log, where a new build's entries start"""
+    try:
+        return os.path.getsize(os.path.join(west_build_dir, '.ninja_log'))
+    except OSError:
+        return 0
+
+
+def add_ninja_log(west_build_dir, offset, end_us, label):
+    """
+    Add the ninja edges recorded after `offset` in .ninja_log as spans.
+
+    Ninja logs milliseconds relative to its own start, so the edges are
+    aligned to end when the build ended. Overlapping edges are spread over
+    lanes, shown as threads named after `label`.
+    """
+    if not tracing():
+        return
+    edges = []
+    try:
+        with open(os.path.join(west_build_dir, '.ninja_log')) as f:
+            f.seek(offset)
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 4 and fields[0].isdigit() and fields[1].isdigit():
+                    edges.append((int(fields[0]), int(fields[1]), fields[3]))
+    except OSError:
+        return
+    if not edges:
+        return
+
+    base_us = end_us - max(end for _, end, _ in edges) * 1000
+    lanes = []
+    with _lock:
+        for start, end, output in sorted(edges):
+            for index, lane_end in enumerate(lanes):
+                if lane_end <= start:
+                    break
+            else:
+                index = len(lanes)
+                lanes.append(0)
+            lanes[index] = end
+            tid = f'{label}#{index}'
+            if tid not in _lane_tids:
+                _lane_tids[tid] = next(_lane_ids)
+                _events.append({'ph': 'M', 'name': 'thread_name', 'pid': os.getpid(),
+                                'tid': _lane_tids[tid],
+                                'args': {'name': f'ninja {label} #{index}'}})
+            _events.append({'ph': 'X', 'name': os.path.basename(output), 'cat': 'ninja',
+                            'ts': base_us + start * 1000, 'dur': (end - start) * 1000,
+                            'pid': os.getpid(), 'tid': _lane_tids[tid],
+                            'args': {'output': output}})
+
+
+def save_trace():
+    """
+    Append this process's events to the trace file, replacing the events
+    of an earlier pio invocation
+    """
+    if not tracing() or not _events:
+        return
+    os.makedirs(os.path.dirname(_trace_path), exist_ok=True)
+    with open(f'{_trace_path}.lock', 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        events = []
+        try:
+            with open(_trace_path) as f:
+                data = json.load(f)
+            if data.get('otherData', {}).get('run') == _run_id:
+                events = data.get('traceEvents', [])
+        except (OSError, ValueError, AttributeError):
+            pass
+        with _lock:
+            events.extend(_events)
+            _events.clear()
+        temp_path = f'{_trace_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'run': _run_id}}, f)
+        os.replace(temp_path, _trace_path)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Streaming parser for Unity test output, with JUnit XML and JSON reports
+"""
+
+import json
+import os
+import re
+import time
+from collections import deque
+from xml.sax.saxutils import escape, quoteattr
+
+# Unity's closing line, e.g. "4 Tests 0 Failures 0 Ignored"
+UNITY_SUMMARY_RE = re.compile(r'(\d+)\s+Tests\s+(\d+)\s+Failures\s+(\d+)\s+Ignored')
+# One Unity test result, e.g. "test/test_sum/test_sum.c:12:test_add:PASS"
+UNITY_RESULT_RE = re.compile(
+    r'^(?P<file>[^:]+):(?P<line>\d+):(?P<test>\w+):(?P<status>PASS|FAIL|IGNORE)(?::(?P<message>.*))?$')
+UNITY_FOOTER_LINES = ('-----------------------', 'OK', 'FAIL')
+
+# Control characters XML 1.0 does not allow, e.g. from raw printk output
+XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# How a run that stopped early is described in its error test case
+STOP_REASONS = {
+    'timeout': 'hung: still running at its deadline',
+    'idle': 'hung: stopped printing output',
+    'pattern': 'stopped by stop_pattern',
+}
+
+UNITY_LOG = 'unity.log'
+CASES_XML = 'testcases.xml'
+CASES_JSON = 'testcases.jsonl'
+
+
+def _xml_text(text):
+    return escape(XML_INVALID_RE.sub('?', text))
+
+
+def _xml_attr(text):
+    return quoteattr(XML_INVALID_RE.sub('?', str(text)))
+
+
+class UnityOutput:
+    """
+    Consume the output of a Unity test executable one line at a time, while
+    it runs.
+
+    Every "file:line:test:STATUS[:message]" line ends a test case, timed
+    from the previous result line (or the start), and takes the printk
+    output seen since then, up to `max_test_output` lines. Finished test
+    cases are appended to a JUnit <testcase> fragment and a JSON lines file
+    in `report_dir` right away, the full output goes to unity.log there and
+    only the last `tail_lines` lines stay in memory, so memory use does not
+    grow with the output.
+    """
+
+    def __init__(self, suite, report_dir, tail_lines=1000, max_test_output=200, echo=False):
+        self.suite = suite
+        self.report_dir = report_dir
+        self.tail = deque(maxlen=tail_lines)
+        self.lines = 0
+        self.echo = echo
+        self.pending = deque(maxlen=max_test_output)
+        self.pending_dropped = 0
+        self.summary = None
+        self.errors = 0
+        self.counts = {'PASS': 0, 'FAIL': 0, 'IGNORE': 0}
+        self.test_times = {}
+        self.start = self.last_result = time.monotonic()
+        os.makedirs(report_dir, exist_ok=True)
+        self.log_path = os.path.join(report_dir, UNITY_LOG)
+        self.log_file = open(self.log_path, 'w')
+        self.xml_file = open(os.path.join(report_dir, CASES_XML), 'w')
+        self.json_file = open(os.path.join(report_dir, CASES_JSON), 'w')
+
+    def feed(self, line):
+        if self.echo:
+            print(line, flush=True)
+        self.tail.append(line)
+        self.lines += 1
+        self.log_file.write(line + '\n')
+
+        match = UNITY_RESULT_RE.match(line)
+        if match:
+            now = time.monotonic()
+            self._add_case(match.group('test'), match.group('status'), match.group('message'),
+                           match.group('file'), int(match.group('line')), now)
+            return
+        match = UNITY_SUMMARY_RE.search(line)
+        if match:
+            self.summary = tuple(int(value) for value in match.groups())
+        elif line not in UNITY_FOOTER_LINES:
+            if len(self.pending) == self.pending.maxlen:
+                self.pending_dropped += 1
+            self.pending.append(line)
+
+    def _add_case(self, test, status, message, file=None, line=None, now=None):
+        now = time.monotonic() if now is None else now
+        seconds = now - self.last_result
+        output = list(self.pending)
+        if self.pending_dropped:
+            output.insert(0, f'[{self.pending_dropped} earlier lines dropped, see {UNITY_LOG}]')
+        case = {'suite': self.suite, 'name': test, 'status': status, 'message': message or '',
+                'file': file, 'line': line, 'start': round(self.last_result - self.start, 6),
+                'time': round(seconds, 6), 'output': output}
+        self.json_file.write(json.dumps(case) + '\n')
+
+        xml = [f'    <testcase classname={_xml_attr(self.suite)} name={_xml_attr(test)} '
+               f'time="{seconds:.6f}"']
+        if file:
+            xml.append(f' file={_xml_attr(file)} line="{line}"')
+        xml.append('>\n' if status != 'PASS' or output else '/>\n')
+        if status == 'FAIL':
+            xml.append(f'      <failure message={_xml_attr(message or "")}/>\n')
+        elif status == 'IGNORE':
+            xml.append(f'      <skipped message={_xml_attr(message or "")}/>\n')
+        elif status == 'ERROR':
+            xml.append(f'      <error message={_xml_attr(message or "")}/>\n')
+        if output:
+            xml.append(f"      <system-out>{_xml_text(chr(10).join(output))}</system-out>\n")
+        if status != 'PASS' or output:
+            xml.append('    </testcase>\n')
+        self.xml_file.write(''.join(xml))
+
+        if status != 'ERROR':
+            self.counts[status] += 1
+            self.test_times[test] = seconds
+        self.pending.clear()
+        self.pending_dropped = 0
+        self.last_result = now
+
+    def counters(self):
+        """
+        Return (tests, failures, ignored) from Unity's summary, or counted
+        from the result lines when the run stopped before it
+        """
+        if self.summary:
+            return self.summary
+        return (sum(self.counts.values()), self.counts['FAIL'], self.counts['IGNORE'])
+
+    def close(self, returncode, stopped=None):
+        """
+        Finish the report. A run that ends without Unity's summary, e.g. a
+        crash or a stop condition (`stopped`: 'timeout', 'idle' or
+        'pattern'), is reported as an error test case holding the output it
+        left behind.
+        """
+        if self.summary is None:
+            reason = STOP_REASONS.get(stopped, f'exited with code {returncode}')
+            self._add_case('(runner)', 'ERROR', f'{reason} before the Unity summary')
+            self.errors += 1
+        for f in (self.log_file, self.xml_file, self.json_file):
+            f.close()
+
+
+def test_report_path(option, build_dir):
+    """
+    Return the report path (without extension) for the `test_report`
+    option, or None when reports are disabled
+    """
+    option = str(option or '').strip()
+    if option.lower() in ('0', 'no', 'false'):
+        return None
+    if option.lower() in ('', '1', 'yes', 'true'):
+        return os.path.join(build_dir, 'test_report')
+    return os.path.splitext(os.path.abspath(os.path.expanduser(option)))[0]
+
+
+def write_test_report(results, path):
+    """
+    Write <path>.xml (JUnit) and <path>.json from the test case files of
+    run results, one test suite per result, copying them line by line
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.xml.tmp', 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<testsuites tests="{sum(result["tests"] for result in results)}" '
+                f'failures="{sum(result["failures"] for result in results)}" '
+                f'errors="{sum(result["errors"] for result in results)}" '
+                f'skipped="{sum(result["ignored"] for result in results)}">\n')
+        for result in results:
+            f.write(f'  <testsuite name={_xml_attr(result["suite"])} tests="{result["tests"]}" '
+                    f'failures="{result["failures"]}" errors="{result["errors"]}" '
+                    f'skipped="{result["ignored"]}" time="{result["duration"]:.6f}">\n')
+            for report_dir in result['report_dirs']:
+                with open(os.path.join(report_dir, CASES_XML)) as cases:
+                    for line in cases:
+                        f.write(line)
+            f.write('  </testsuite>\n')
+        f.write('</testsuites>\n')
+    os.replace(f'{path}.xml.tmp', f'{path}.xml')
+
+    with open(f'{path}.json.tmp', 'w') as f:
+        f.write('{"suites": [')
+        for index, result in enumerate(results):
+            suite = {key: result.get(key) for key in ('suite', 'ok', 'returncode', 'timed_out',
+                                                      'stopped', 'hung', 'tests', 'failures',
+                                                      'ignored', 'errors', 'sim_time',
+                                                      'limits', 'cached')}
+            suite['duration'] = round(result['duration'], 6)
+            f.write(('\n  ' if index == 0 else ',\n  ') + json.dumps(suite)[:-1] + ', "testcases": [')
+            first = True
+            for report_dir in result['report_dirs']:
+                with open(os.path.join(report_dir, CASES_JSON)) as cases:
+                    for line in cases:
+                        f.write(('\n    ' if first else ',\n    ') + line.rstrip('\n'))
+                        first = False
+            f.write(']}')
+        f.write('\n]}\n')
+    os.replace(f'{path}.json.tmp', f'{path}.json')
+
+
+def print_slowest_tests(results, count=5):
+    """Print the slowest test cases of a run"""
+    times = sorted(((seconds, result['suite'], test) for result in results
+                    for test, seconds in result['test_times'].items()), reverse=True)[:count]
+    if times:
+        print("🐢 Slowest tests:")
+        for seconds, suite, test in times:
+            print(f"   {seconds:8.3f}s  {suite}:{test}")
+
+
+def publish_test_report(results, report_path, slowest=5):
+    """Write the reports of a run, when enabled, and show its slowest tests"""
+    if report_path:
+        write_test_report(results, report_path)
+        print(f"📄 Test report: {report_path}.xml, {report_path}.json")
+    print_slowest_tests(results, slowest)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Upload script for the native_sim microbenchmarks: runs every built
+bench/bench_* suite, writes the statistics and compares them with the
+committed baseline
+"""
+
+import os
+import sys
+
+# Get environment variables
+PROJECT_DIR = os.environ.get('PROJECT_DIR', os.getcwd())
+BUILD_DIR = os.environ.get('BUILD_DIR', os.path.join(PROJECT_DIR, '.pio', 'build', 'native_sim_bench'))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_bench import (BENCH_REPORT, DEFAULT_BASELINE, bench_suite_names, compare_bench,
+                              load_bench_baseline, print_bench_results, run_bench_suite,
+                              write_bench_report)
+from native_sim_common import get_option
+from native_sim_trace import span, start_trace
+
+print("⏱️  Running native_sim microbenchmarks")
+print(f"📁 Project dir: {PROJECT_DIR}")
+print(f"🔨 Build dir: {BUILD_DIR}")
+
+pio_env_name = os.path.basename(BUILD_DIR)
+start_trace(get_option('trace', '', project_dir=PROJECT_DIR, pio_env=pio_env_name), BUILD_DIR,
+            'bench')
+
+bench_option = str(get_option('bench', 'all', project_dir=PROJECT_DIR,
+                              pio_env=pio_env_name)).strip()
+suites = (bench_suite_names(PROJECT_DIR) if bench_option in ('', 'all') else
+          [suite.strip() for suite in bench_option.split(',') if suite.strip()])
+timeout = float(get_option('run_timeout', 120, project_dir=PROJECT_DIR, pio_env=pio_env_name))
+baseline_path = os.path.join(PROJECT_DIR, get_option('bench_baseline', DEFAULT_BASELINE,
+                                                     project_dir=PROJECT_DIR,
+                                                     pio_env=pio_env_name))
+threshold = float(get_option('bench_threshold', 0.25, project_dir=PROJECT_DIR,
+                             pio_env=pio_env_name))
+save_baseline = str(get_option('bench_save_baseline', 'no', project_dir=PROJECT_DIR,
+                               pio_env=pio_env_name)).lower() in ('1', 'yes', 'true')
+
+results = []
+for suite in suites:
+    executable = os.path.join(BUILD_DIR, suite, 'bench_runner.exe')
+    if not os.path.isfile(executable):
+        print(f"❌ Error: Benchmark executable not found: {executable}")
+        exit(1)
+    print(f"⏱️  Running {suite}...")
+    try:
+        with span(f'bench {suite}', category='test'):
+            results.append(run_bench_suite(suite, executable, timeout))
+    except OSError as e:
+        print(f"❌ Error: Could not execute {executable}: {e}")
+        exit(1)
+
+print_bench_results(results)
+report_path = os.path.join(BUILD_DIR, BENCH_REPORT)
+write_bench_report(results, report_path)
+print(f"📄 Benchmark report: {report_path}")
+if not all(result['ok'] for result in results):
+    exit(1)
+
+if save_baseline:
+    write_bench_report(results, baseline_path)
+    print(f"📌 Baseline saved: {baseline_path}")
+    exit(0)
+
+baseline = load_bench_baseline(baseline_path)
+if baseline is None:
+    print(f"⚠️  No baseline at {baseline_path}; record one with "
+          f"NATIVE_SIM_BENCH_SAVE_BASELINE=yes and commit it")
+    exit(0)
+regressions = compare_bench(results, baseline, threshold)
+if regressions:
+    print(f"❌ {len(regressions)} benchmark(s) slower than the baseline by more than "
+          f"{threshold:.0%}: {', '.join(regressions)}")
+    exit(1)
+print("✅ No benchmark regressions")
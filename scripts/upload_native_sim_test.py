@@ -4,40 +4,148 @@ Simple upload script for Zephyr native_sim Unity tests
 """
 
 import os
-import subprocess
 import sys
 
 # Get environment variables
 PROJECT_DIR = os.environ.get('PROJECT_DIR', os.getcwd())
 BUILD_DIR = os.environ.get('BUILD_DIR', os.path.join(PROJECT_DIR, '.pio', 'build', 'native_sim_test'))
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_common import get_option, select_test_suites
+from native_sim_deps import record_last_run
+from native_sim_index import load_suite_index, resolve_suite, suite_names
+from native_sim_runner import (DURATIONS_FILE, cached_result, combined_suite_args,
+                               failure_message, find_suite_executables, hang_limits,
+                               hang_message, load_test_durations, print_run_report,
+                               record_test_durations, result_cache_key, result_cache_options,
+                               run_suite, run_suites, store_result, suite_run_options,
+                               suite_test_names)
+from native_sim_trace import start_trace
+from native_sim_unity import publish_test_report, test_report_path
+
 print("🧪 Running native_sim Unity tests")
 print(f"📁 Project dir: {PROJECT_DIR}")
 print(f"🔨 Build dir: {BUILD_DIR}")
 
-# Look for the test executable
+pio_env_name = os.path.basename(BUILD_DIR)
+start_trace(get_option('trace', '', project_dir=PROJECT_DIR, pio_env=pio_env_name), BUILD_DIR,
+            'test')
+
+suite_index = load_suite_index(PROJECT_DIR)
 test_runner_path = os.path.join(BUILD_DIR, 'test_runner.exe')
+test_runner_mode = get_option('test_runner', 'manual', project_dir=PROJECT_DIR,
+                              pio_env=pio_env_name).lower()
+# A combined test executable holds every suite; suites are picked at runtime
+combined = test_runner_mode == 'combined'
+history_path = os.path.join(BUILD_DIR, DURATIONS_FILE)
+# JUnit XML and JSON reports with per-test timings
+report_path = test_report_path(get_option('test_report', 'yes', project_dir=PROJECT_DIR,
+                                          pio_env=pio_env_name), BUILD_DIR)
+jobs = max(1, int(get_option('jobs', os.cpu_count() or 1, project_dir=PROJECT_DIR,
+                             pio_env=pio_env_name)))
+# Suites that passed before with the same executable and inputs are not re-run
+result_cache_dir, force_rerun = result_cache_options(PROJECT_DIR, pio_env_name)
 
-if not os.path.exists(test_runner_path):
-    print(f"❌ Error: Test executable not found: {test_runner_path}")
+# Simulated time and stop conditions of the runs, per suite
+try:
+    run_options = suite_run_options(suite_names(suite_index), PROJECT_DIR, pio_env_name,
+                                    timeout=30)
+except ValueError as e:
+    print(f"❌ Error: {e}")
     exit(1)
 
-print(f"🧪 Running test executable: {test_runner_path}")
+# Sharding: split the tests of a suite over several instances of its executable
+shards = max(1, int(get_option('shards', 1, project_dir=PROJECT_DIR, pio_env=pio_env_name)))
+if shards > 1 and test_runner_mode not in ('generated', 'combined'):
+    print("⚠️  shards needs test_runner = generated or combined, running suites unsharded")
+    shards = 1
 
+# Multi-suite mode: run every suite built by a multi-suite build concurrently;
+# the `affected` option skips the suites no change reaches
+current_suite = resolve_suite(suite_index, argv=sys.argv)
 try:
-    # Run the test executable with a reasonable timeout
-    result = subprocess.run([test_runner_path], timeout=30, capture_output=False, text=True)
-    
-    # Exit with the same code as the test executable
-    exit(result.returncode)
-    
-except subprocess.TimeoutExpired:
-    print("❌ Test execution timed out after 30 seconds")
+    suites, selected = select_test_suites(PROJECT_DIR, suite_index, current_suite,
+                                          pio_env=pio_env_name)
+except ValueError as e:
+    print(f"❌ Error: {e}")
     exit(1)
-except FileNotFoundError:
-    print(f"❌ Error: Could not execute {test_runner_path}")
+if not selected:
+    print("✅ No suite affected, nothing to run")
+    exit(0)
+if suites:
+    if combined:
+        executables = ([(suite, test_runner_path) for suite in suites]
+                       if os.path.isfile(test_runner_path) else [])
+    else:
+        executables = find_suite_executables(BUILD_DIR, suites)
+    if not executables:
+        print(f"❌ Error: No suite executables found in {BUILD_DIR}")
+        exit(1)
+    results = run_suites(executables, os.path.join(BUILD_DIR, 'runs'), jobs, timeout=30,
+                         suite_args=combined_suite_args(suites) if combined else None,
+                         shards=shards, suite_tests=suite_test_names(suite_index, suites),
+                         history_path=history_path, run_options=run_options,
+                         result_cache_dir=result_cache_dir, force=force_rerun)
+    exit_code = print_run_report(results)
+    publish_test_report(results, report_path)
+    record_last_run(PROJECT_DIR, results)
+    exit(exit_code)
+
+# Look for the test executable
+
+if not os.path.exists(test_runner_path):
+    print(f"❌ Error: Test executable not found: {test_runner_path}")
     exit(1)
-except Exception as e:
-    print(f"❌ Error running tests: {e}")
+
+test_args = []
+if combined and current_suite:
+    test_args = combined_suite_args([current_suite])[current_suite]
+
+if shards > 1 and current_suite:
+    results = run_suites([(current_suite, test_runner_path)], os.path.join(BUILD_DIR, 'runs'),
+                         jobs, timeout=30, suite_args={current_suite: test_args}, shards=shards,
+                         suite_tests=suite_test_names(suite_index, [current_suite]),
+                         history_path=history_path, run_options=run_options,
+                         result_cache_dir=result_cache_dir, force=force_rerun)
+    exit_code = print_run_report(results)
+    publish_test_report(results, report_path)
+    record_last_run(PROJECT_DIR, results)
+    exit(exit_code)
+
+run_name = current_suite or 'test_runner'
+cache_key = (result_cache_key(run_name, test_runner_path, test_args, run_options[current_suite])
+             if result_cache_dir else None)
+result = cached_result(result_cache_dir, cache_key) if cache_key and not force_rerun else None
+if result:
+    print(f"♻️  {run_name} passed before with the same executable and inputs, not re-running it "
+          f"(test_cache = force re-runs)")
+    print(result['output'], end='')
+    publish_test_report([result], report_path)
+    record_last_run(PROJECT_DIR, [result])
+    exit(0)
+
+print(f"🧪 Running test executable: {test_runner_path} {' '.join(test_args)}".rstrip())
+print(f"⏱️  Simulated time: {run_options[current_suite]['sim_time']}")
+
+try:
+    # Run the test executable with a reasonable timeout, parsing its output as it runs
+    result = run_suite(run_name, test_runner_path, os.path.join(BUILD_DIR, 'runs', run_name),
+                       args=test_args, echo=True,
+                       **hang_limits(run_options[current_suite], load_test_durations(history_path),
+                                     run_name))
+except OSError as e:
+    print(f"❌ Error: Could not execute {test_runner_path}: {e}")
     exit(1)
 
+record_test_durations(history_path, [result])
+if cache_key:
+    store_result(result_cache_dir, cache_key, result)
+publish_test_report([result], report_path)
+record_last_run(PROJECT_DIR, [result])
+if result['hung']:
+    print(hang_message(result))
+elif not result['ok']:
+    print(failure_message(result))
+
+# The suites exit(0) after UNITY_END(), so the parsed Unity results decide
+exit(0 if result['ok'] else 1)
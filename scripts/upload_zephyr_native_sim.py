@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import subprocess
 import sys
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from native_sim_common import get_option, select_test_suites
+from native_sim_deps import record_last_run
+from native_sim_index import load_suite_index, resolve_suite, suite_names
+from native_sim_output import OutputIdle, stream_command
+from native_sim_runner import (DURATIONS_FILE, cached_result, combined_suite_args,
+                               failure_message, find_suite_executables, hang_limits,
+                               hang_message, load_test_durations, native_sim_args,
+                               print_run_report, record_test_durations, result_cache_key,
+                               result_cache_options, run_suite, run_suites, store_result,
+                               suite_run_options, suite_test_names)
+from native_sim_trace import span, start_trace
+from native_sim_unity import publish_test_report, test_report_path
+
 def main():
     """
     PlatformIO-compatible upload script for Zephyr native_sim
@@ -29,6 +44,78 @@ def main():
     # The build script already handles directory naming, so use BUILD_DIR as-is
     # No need to modify it here
     
+    pio_env_name = os.path.basename(build_dir)
+    start_trace(get_option('trace', '', project_dir=project_dir, pio_env=pio_env_name), build_dir,
+                'test' if is_test_run else 'run')
+
+    test_runner_mode = get_option('test_runner', 'manual', project_dir=project_dir,
+                                  pio_env=pio_env_name).lower()
+    # A combined test executable holds every suite; suites are picked at runtime
+    combined = is_test_run and test_runner_mode == 'combined'
+    combined_path = os.path.join(build_dir, 'test_runner.exe')
+    jobs = max(1, int(get_option('jobs', os.cpu_count() or 1, project_dir=project_dir,
+                                 pio_env=pio_env_name)))
+    history_path = os.path.join(build_dir, DURATIONS_FILE)
+    # Suites that passed before with the same executable and inputs are not re-run
+    result_cache_dir, force_rerun = result_cache_options(project_dir, pio_env_name)
+    # JUnit XML and JSON reports with per-test timings
+    report_path = test_report_path(get_option('test_report', 'yes', project_dir=project_dir,
+                                              pio_env=pio_env_name), build_dir)
+
+    # Simulated time and stop conditions of the runs, per suite
+    try:
+        run_options = suite_run_options(
+            suite_names(load_suite_index(project_dir)) if is_test_run else [], project_dir,
+            pio_env_name, timeout=60 if is_test_run else 30)
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        return 1
+
+    # Sharding: split the tests of a suite over several instances of its executable
+    shards = max(1, int(get_option('shards', 1, project_dir=project_dir, pio_env=pio_env_name)))
+    if is_test_run and shards > 1 and test_runner_mode not in ('generated', 'combined'):
+        print("⚠️  shards needs test_runner = generated or combined, running suites unsharded")
+        shards = 1
+    
+    # Multi-suite mode: run every suite built by a multi-suite build concurrently;
+    # the `affected` option skips the suites no change reaches
+    suites = []
+    current_suite = None
+    if is_test_run:
+        suite_index = load_suite_index(project_dir)
+        current_suite = resolve_suite(suite_index, argv=sys.argv)
+        try:
+            suites, selected = select_test_suites(project_dir, suite_index, current_suite,
+                                                  pio_env=pio_env_name)
+        except ValueError as e:
+            print(f"❌ Error: {e}")
+            return 1
+        if not selected:
+            print("✅ No suite affected, nothing to run")
+            return 0
+    if suites:
+        if combined:
+            executables = ([(suite, combined_path) for suite in suites]
+                           if os.path.isfile(combined_path) else [])
+        else:
+            executables = find_suite_executables(build_dir, suites)
+        if not executables:
+            print(f"❌ Error: No suite executables found in {build_dir}")
+            return 1
+        results = run_suites(executables, os.path.join(build_dir, 'runs'), jobs, timeout=60,
+                             suite_args=combined_suite_args(suites) if combined else None,
+                             shards=shards, suite_tests=suite_test_names(suite_index, suites),
+                             history_path=history_path, run_options=run_options,
+                             result_cache_dir=result_cache_dir, force=force_rerun)
+        exit_code = print_run_report(results)
+        publish_test_report(results, report_path)
+        record_last_run(project_dir, results)
+        return exit_code
+    
+    test_args = []
+    if combined and current_suite:
+        test_args = combined_suite_args([current_suite])[current_suite]
+    
     # Look for the executable (try different names based on run type)
     if is_test_run:
         # For test runs, prioritize test_runner.exe which contains the actual Unity tests
@@ -67,47 +154,87 @@ def main():
         print(f"🧪 Running native_sim tests: {os.path.basename(executable)}")
     else:
         print(f"🚀 Running native_sim application: {os.path.basename(executable)}")
+
+    if shards > 1 and current_suite and os.path.basename(executable) == 'test_runner.exe':
+        results = run_suites([(current_suite, executable)], os.path.join(build_dir, 'runs'), jobs,
+                             timeout=60, suite_args={current_suite: test_args}, shards=shards,
+                             suite_tests=suite_test_names(suite_index, [current_suite]),
+                             history_path=history_path, run_options=run_options,
+                             result_cache_dir=result_cache_dir, force=force_rerun)
+        exit_code = print_run_report(results)
+        publish_test_report(results, report_path)
+        record_last_run(project_dir, results)
+        return exit_code
     
+    if is_test_run:
+        # Parse the Unity output while the tests run, printing it as it arrives
+        run_name = current_suite or 'test_runner'
+        options = run_options[current_suite]
+        cache_key = (result_cache_key(run_name, executable, test_args, options)
+                     if result_cache_dir else None)
+        result = (cached_result(result_cache_dir, cache_key)
+                  if cache_key and not force_rerun else None)
+        if result:
+            print(f"♻️  {run_name} passed before with the same executable and inputs, "
+                  f"not re-running it (test_cache = force re-runs)")
+            print(result['output'], end='')
+            publish_test_report([result], report_path)
+            record_last_run(project_dir, [result])
+            return 0
+        print(f"⏱️  Simulated time: {options['sim_time']}")
+        try:
+            result = run_suite(run_name, executable, os.path.join(build_dir, 'runs', run_name),
+                               args=test_args, echo=True,
+                               **hang_limits(options, load_test_durations(history_path), run_name))
+        except OSError as e:
+            print(f"❌ Executable not found or not executable: {executable} ({e})")
+            return 1
+        record_test_durations(history_path, [result])
+        if cache_key:
+            store_result(result_cache_dir, cache_key, result)
+        publish_test_report([result], report_path)
+        record_last_run(project_dir, [result])
+        if result['hung']:
+            print(hang_message(result))
+            return 1
+        print(f"📊 Test summary: {result['tests']} Tests {result['failures']} Failures "
+              f"{result['ignored']} Ignored")
+        if not result['ok']:
+            print(failure_message(result))
+            return 1
+        return 0
+
+    # The application ends at stop_at, on stop_pattern or, failing, at a stop condition
+    options = run_options[None]
+    stop_re = re.compile(options['stop_pattern']) if options['stop_pattern'] else None
+    print(f"⏱️  Simulated time: {options['sim_time']}"
+          + (f", stopping at {options['stop_at']:g}s simulated" if options['stop_at'] else ''))
+
+    def on_line(line):
+        print(line, flush=True)
+        return bool(stop_re and stop_re.search(line))
+
     try:
-        # Use a unified approach for both test and regular runs
-        # Set a reasonable timeout for both test and regular runs
-        timeout = 60 if is_test_run else 30
-        
-        # Run the executable with proper output handling
-        result = subprocess.run(
-            [executable],
-            cwd=os.path.dirname(executable),
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
-        
-        # Forward all output to PlatformIO
-        if result.stdout:
-            print(result.stdout, end='', flush=True)
-        if result.stderr:
-            print(result.stderr, end='', flush=True)
-        
-        # For test runs, look for Unity test results
-        if is_test_run and result.returncode == 0:
-            output_lines = result.stdout.split('\n') if result.stdout else []
-            for line in output_lines:
-                if "Tests" in line and "Failures" in line and "Ignored" in line:
-                    print(f"📊 Test summary: {line}")
-                    break
-        
-        return result.returncode
-        
+        with span(f'run {os.path.basename(executable)}', category='test'):
+            returncode = stream_command([executable] + native_sim_args(options),
+                                        options['timeout'], on_line,
+                                        idle_timeout=options['idle_timeout'],
+                                        cwd=os.path.dirname(executable))
     except subprocess.TimeoutExpired:
-        print(f"⏰ Execution timed out after {timeout} seconds")
+        print(f"⏰ Execution timed out after {options['timeout']:g} seconds")
         return 1
-    except FileNotFoundError:
-        print(f"❌ Executable not found or not executable: {executable}")
+    except OutputIdle:
+        print(f"💤 No output for {options['idle_timeout']:g} seconds, execution stopped")
         return 1
-    except Exception as e:
-        print(f"❌ Error during execution: {e}")
+    except OSError as e:
+        print(f"❌ Executable not found or not executable: {executable} ({e})")
         return 1
 
+    if returncode is None:
+        print(f"🛑 Output matched stop_pattern '{options['stop_pattern']}', execution stopped")
+        return 0
+    return returncode
+
 if __name__ == "__main__":
     exit_code = main()
     sys.exit(exit_code)